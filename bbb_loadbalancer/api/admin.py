@@ -34,12 +34,13 @@ def disable_server(modeladmin, request, queryset):
 
 @admin.register(BBBServer)
 class BBBServerAdmin(CommonAdmin):
-    list_display = ("bbb_server", "enabled", "reachable", "unreachable", "api_mate")
+    list_display = ("bbb_server", "enabled", "reachable", "unreachable", "running_load", "capacity",
+                    "participants", "video_streams", "cpu_load", "api_mate")
     list_filter = ("state", "unreachable")
     ordering = ("server_id", )
     actions = (enable_server, disable_server)
-    fields = ("server_id", "secret", "state")
-    readonly_fields = ("state", )
+    fields = ("server_id", "secret", "state", "running_load", "capacity", "connect_timeout", "read_timeout")
+    readonly_fields = ("state", "running_load")
 
     def enabled(self, obj: BBBServer) -> bool:
         return obj.state == BBBServer.ENABLED
@@ -51,6 +52,13 @@ class BBBServerAdmin(CommonAdmin):
     def bbb_server(self, obj: BBBServer) -> str:
         return f"#{obj.server_id} {obj}"
 
+    # Don't overwrite the running_load maintained by the database with the stale value loaded for the form
+    def save_model(self, request, obj, form, change):
+        if change:
+            obj.save(update_fields=form.changed_data)
+        else:
+            obj.save()
+
     # You can't add servers using the admin interface, please use the cli
     def has_add_permission(self, request):
         return False
@@ -66,7 +74,7 @@ class BBBServerAdmin(CommonAdmin):
 
 @admin.action(description='Mark a meeting as ended')
 def mark_ended(modeladmin, request, queryset):
-    queryset.update(ended=True)
+    queryset.mark_ended()
 
 
 @admin.register(Meeting)
@@ -74,3 +82,17 @@ class MeetingAdmin(CommonAdmin):
     list_display = ("__str__", "created", "server", "ended")
     ordering = ("ended", "-created")
     actions = (mark_ended,)
+
+
+@admin.register(ArchivedMeeting)
+class ArchivedMeetingAdmin(CommonAdmin):
+    list_display = ("__str__", "created", "archived", "server")
+    ordering = ("-created", )
+    search_fields = ("meeting_id", "internal_id")
+
+    # Archived meetings are only moved here by the archive
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
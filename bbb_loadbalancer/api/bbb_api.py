@@ -1,14 +1,189 @@
+import asyncio
 import hashlib
 import logging
+import os
+import threading
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import Dict, Iterable, List, Tuple
 from urllib.parse import urlencode
-from urllib.request import urlopen
+from xml.parsers.expat import ExpatError
 
+import httpx
+from asgiref.sync import sync_to_async
 from jxmlease import parse
 
+from api import timing
 from api.response import EarlyResponse, respond
+from common_files import health, metrics
+from common_files.config import LoadBalancerConfig
 
 logger = logging.getLogger("bbb_api")
 
+config = LoadBalancerConfig.from_json("../config.json")
+
+
+class _PoolStatistics:
+    """Counters describing how the worker's http client has been used"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.failures = 0
+        self.rejected = 0
+        self.tcp_connects = 0
+        self.tls_handshakes = 0
+        self.http2_connections = 0
+
+    def increment(self, counter: str):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def trace(self, event_name: str, info: dict):
+        """Trace hook for httpcore counting new connections and handshakes"""
+        if event_name == "connection.connect_tcp.complete":
+            self.increment("tcp_connects")
+        elif event_name == "connection.start_tls.complete":
+            self.increment("tls_handshakes")
+        elif event_name == "http2.send_connection_init.complete":
+            self.increment("http2_connections")
+
+    async def atrace(self, event_name: str, info: dict):
+        """Trace hook for httpcore's async interface"""
+        self.trace(event_name, info)
+
+
+_client = None
+_client_pid = None
+_client_lock = threading.Lock()
+_async_clients = weakref.WeakKeyDictionary()
+_statistics = _PoolStatistics()
+
+
+def _client_options() -> dict:
+    return dict(
+        http2=config.upstream.http2,
+        timeout=httpx.Timeout(config.upstream.timeout, connect=config.upstream.connect_timeout),
+        limits=httpx.Limits(
+            max_connections=config.upstream.max_connections,
+            max_keepalive_connections=config.upstream.max_keepalive_connections,
+            keepalive_expiry=config.upstream.keepalive_expiry,
+        ),
+        headers={"user-agent": "bbb-loadbalancer"},
+    )
+
+
+def get_client() -> httpx.Client:
+    """
+    Get this worker's pooled http client
+
+    The client is created lazily and recreated after a fork,
+    so each gunicorn worker gets its own pool of keep-alive connections.
+
+    :return: the worker's http client
+    :rtype: httpx.Client
+    """
+    global _client, _client_pid
+    if _client is None or _client_pid != os.getpid():
+        with _client_lock:
+            if _client is None or _client_pid != os.getpid():
+                _client = httpx.Client(**_client_options())
+                _client_pid = os.getpid()
+    return _client
+
+
+async def _close_with_loop(client: httpx.AsyncClient):
+    # Event loops finalize their unfinished async generators before closing (asyncio.run and
+    # asgiref's async_to_sync both call shutdown_asyncgens), which runs this finally block
+    try:
+        yield
+    finally:
+        await client.aclose()
+
+
+def get_async_client() -> httpx.AsyncClient:
+    """
+    Get the pooled http client of the running event loop
+
+    Connections can't be shared between event loops, so every loop gets its own client,
+    which is closed when the loop shuts down.
+    When served by an asgi worker this is one client per worker,
+    short lived loops like the ones of async_to_sync close theirs after each call.
+
+    :return: the event loop's http client
+    :rtype: httpx.AsyncClient
+    """
+    loop = asyncio.get_running_loop()
+    entry = _async_clients.get(loop)
+    if entry is None:
+        client = httpx.AsyncClient(**_client_options())
+        closer = _close_with_loop(client)
+        # Start the generator, so the loop knows it. It doesn't await anything before its yield.
+        try:
+            closer.asend(None).send(None)
+        except StopIteration:
+            pass
+        # The loop only keeps a weak reference to the generator
+        entry = _async_clients[loop] = (client, closer)
+    return entry[0]
+
+
+def get_pool_statistics() -> dict:
+    """
+    Get statistics about this worker's connection pool
+
+    :return: dict of counters and the current state of the pool's connections
+    :rtype: dict
+    """
+    statistics = {
+        "pid": os.getpid(),
+        "requests": _statistics.requests,
+        "failures": _statistics.failures,
+        "rejected": _statistics.rejected,
+        "tcp_connects": _statistics.tcp_connects,
+        "tls_handshakes": _statistics.tls_handshakes,
+        "http2_connections": _statistics.http2_connections,
+        "open_connections": 0,
+        "idle_connections": 0,
+    }
+
+    # httpx doesn't expose its pool, so this relies on httpcore's ConnectionPool
+    clients = [client for client, _ in _async_clients.values()]
+    if _client_pid == os.getpid():
+        clients.append(_client)
+    for client in clients:
+        pool = getattr(getattr(client, "_transport", None), "_pool", None)
+        if pool is not None:
+            connections = list(pool.connections)
+            statistics["open_connections"] += len(connections)
+            statistics["idle_connections"] += sum(1 for connection in connections if connection.is_idle())
+
+    return statistics
+
+
+def get_timeout(server, budget: float = None) -> httpx.Timeout:
+    """
+    Get the timeouts to use for a server
+
+    :param server: server to get the timeouts for
+    :type server: BBBServer
+    :param budget: seconds left for the call, which caps the timeouts
+    :type budget: float
+    :return: the server's timeouts falling back to the ones configured under upstream
+    :rtype: httpx.Timeout
+    """
+    read_timeout = getattr(server, "read_timeout", None)
+    connect_timeout = getattr(server, "connect_timeout", None)
+    if read_timeout is None:
+        read_timeout = config.upstream.timeout
+    if connect_timeout is None:
+        connect_timeout = config.upstream.connect_timeout
+    if budget is not None:
+        read_timeout = min(read_timeout, max(budget, 0))
+        connect_timeout = min(connect_timeout, max(budget, 0))
+    return httpx.Timeout(read_timeout, connect=connect_timeout)
+
 
 def build_api_url(self, api_call, params=None):
     if params is None:
@@ -30,24 +205,226 @@ def build_api_url(self, api_call, params=None):
     return self.api_url + api_call + "?" + param_string + "&checksum=" + checksum
 
 
-def send_api_request(self, api_call, params=None, data=None, **kwargs):
-    url = build_api_url(self, api_call, params)
+def _no_response_message() -> EarlyResponse:
+    return EarlyResponse(respond(
+        False, "noResponse",
+        "An internal server didn't respond. Try again in some seconds or contact your admin."
+    ))
+
+
+def _no_response(self) -> EarlyResponse:
+    _statistics.increment("failures")
+    if getattr(self, "id", None) is not None:
+        metrics.upstream_errors.labels(str(self.server_id)).inc()
+    logger.exception(f"Couldn't call a bbb's api: {self}")
+    return _no_response_message()
+
 
+def _failed(self):
+    if getattr(self, "id", None) is not None:
+        health.record_failure(self.id)
+
+
+def _check_circuit(self) -> bool:
+    """
+    Fail fast if a server's circuit is open
+
+    :return: whether a success has to be reported to health.record_success and the call's end to health.end_probe
+    :rtype: bool
+    :raises EarlyResponse: noResponse if the server's circuit is open
+    """
+    if getattr(self, "id", None) is None:
+        return False
     try:
-        # GET request
-        if data is None:
-            response = urlopen(url, **kwargs).read()
-        # POST request
-        else:
-            response = urlopen(url, data=urlencode(data).encode(), **kwargs).read()
-    except:
-        logger.exception(f"Couldn't call a bbb's api: {self}")
-        raise EarlyResponse(respond(
-            False, "noResponse",
-            "An internal server didn't respond. Try again in some seconds or contact your admin."
-        )) from None
+        return health.before_request(self.id)
+    except health.CircuitOpen:
+        _statistics.increment("rejected")
+        metrics.upstream_rejected.labels(str(self.server_id)).inc()
+        logger.info(f"Didn't call {self}, its circuit is open")
+        raise _no_response_message() from None
+
+
+def _succeeded(self, seconds: float, report_success: bool):
+    if getattr(self, "id", None) is None:
+        return
+    metrics.upstream_duration.labels(str(self.server_id)).observe(seconds)
+    health.record_latency(self.id, seconds)
+    if report_success:
+        health.record_success(self.id)
+
+
+def _ended(self, report_success: bool):
+    if report_success:
+        health.end_probe(self.id)
+
 
+def _parse(content: bytes) -> dict:
     try:
-        return parse(response)["response"]
+        return parse(content)["response"]
     except Exception as e:
         raise RuntimeError("XMLSyntaxError", str(e))
+
+
+def send_api_request(self, api_call, params=None, data=None, timeout=None, parser=None):
+    """
+    Call a bbb's api and parse its response
+
+    :param self: the server to call
+    :type self: BBBServer
+    :param api_call: name of the api call
+    :type api_call: str
+    :param params: the call's query parameters
+    :type params: dict
+    :param data: form data to post (if None a GET request is sent)
+    :type data: dict
+    :param timeout: timeouts overwriting the server's
+    :param parser: an incremental parser from api.xml_stream which is fed the response while it is received
+                   (if None the whole response is parsed with jxmlease)
+    :return: the content of the response's root element
+    :rtype: dict
+    :raises EarlyResponse: noResponse if the server couldn't be reached
+    """
+    url = build_api_url(self, api_call, params)
+    if timeout is None:
+        timeout = get_timeout(self)
+
+    report_success = _check_circuit(self)
+    try:
+        timing.set_server(getattr(self, "server_id", None))
+        _statistics.increment("requests")
+        start = time.monotonic()
+        try:
+            method, kwargs = ("GET", {}) if data is None else ("POST", {"data": data})
+            with get_client().stream(method, url, timeout=timeout, extensions={"trace": _statistics.trace},
+                                     **kwargs) as response:
+                response.raise_for_status()
+                if parser is None:
+                    response.read()
+                else:
+                    for chunk in response.iter_bytes():
+                        parser.feed(chunk)
+                    parsed = parser.close()
+        except ExpatError as e:
+            raise RuntimeError("XMLSyntaxError", str(e))
+        except:
+            _failed(self)
+            raise _no_response(self) from None
+        finally:
+            timing.record("upstream", time.monotonic() - start)
+
+        _succeeded(self, time.monotonic() - start, report_success)
+        return _parse(response.content) if parser is None else parsed
+    finally:
+        # Also after errors raised while parsing or the call being cancelled
+        _ended(self, report_success)
+
+
+async def asend_api_request(self, api_call, params=None, data=None, timeout=None, parser=None):
+    """
+    Call a bbb's api and parse its response without blocking the event loop
+
+    See send_api_request for the parameters.
+    The server's health is read and updated in a thread, as the cache might block.
+
+    :return: the content of the response's root element
+    :rtype: dict
+    :raises EarlyResponse: noResponse if the server couldn't be reached
+    """
+    url = build_api_url(self, api_call, params)
+    if timeout is None:
+        timeout = get_timeout(self)
+
+    report_success = await sync_to_async(_check_circuit, thread_sensitive=False)(self)
+    try:
+        timing.set_server(getattr(self, "server_id", None))
+        _statistics.increment("requests")
+        start = time.monotonic()
+        try:
+            method, kwargs = ("GET", {}) if data is None else ("POST", {"data": data})
+            async with get_async_client().stream(method, url, timeout=timeout,
+                                                 extensions={"trace": _statistics.atrace}, **kwargs) as response:
+                response.raise_for_status()
+                if parser is None:
+                    await response.aread()
+                else:
+                    async for chunk in response.aiter_bytes():
+                        parser.feed(chunk)
+                    parsed = parser.close()
+        except ExpatError as e:
+            raise RuntimeError("XMLSyntaxError", str(e))
+        except Exception:
+            error = _no_response(self)
+            await sync_to_async(_failed, thread_sensitive=False)(self)
+            raise error from None
+        finally:
+            timing.record("upstream", time.monotonic() - start)
+
+        await sync_to_async(_succeeded, thread_sensitive=False)(self, time.monotonic() - start, report_success)
+        return _parse(response.content) if parser is None else parsed
+    finally:
+        # Also after errors raised while parsing or the call being cancelled
+        if report_success:
+            await sync_to_async(health.end_probe, thread_sensitive=False)(self.id)
+
+
+def send_api_requests(servers: Iterable, api_call: str, params: dict = None,
+                      timeout: float = None, deadline: float = None,
+                      parser_factory=None, server_params: Dict[object, dict] = None
+                      ) -> Tuple[Dict[object, dict], List[object]]:
+    """
+    Send the same api call to several servers concurrently
+
+    A server which fails, exceeds its timeout or doesn't answer before the deadline is given up on
+    and reported as missing instead of failing the whole call.
+
+    :param servers: servers to call
+    :type servers: Iterable[BBBServer]
+    :param api_call: the api call to send to every server
+    :type api_call: str
+    :param params: parameters for the api call (copied for every server)
+    :type params: dict
+    :param timeout: seconds a single server may take (defaults to the server's own timeouts)
+    :type timeout: float
+    :param deadline: seconds after which all unanswered servers are given up on (defaults to upstream.fanout_deadline)
+    :type deadline: float
+    :param parser_factory: callable creating a new incremental parser for each server (see send_api_request)
+    :param server_params: dict mapping servers to additional parameters only sent to them
+    :type server_params: Dict[BBBServer, dict]
+    :return: dict mapping each answering server to its response and a list of the missing servers
+    :rtype: Tuple[Dict[BBBServer, dict], List[BBBServer]]
+    """
+    servers = list(servers)
+    if deadline is None:
+        deadline = config.upstream.fanout_deadline
+    if not servers:
+        return {}, []
+
+    executor = ThreadPoolExecutor(max_workers=min(len(servers), config.upstream.fanout_workers))
+    branches = {}
+    try:
+        futures = {}
+        for server in servers:
+            # Executor threads don't inherit the request's context, so the calls' timings would be lost
+            context, branches[server] = timing.branch()
+            future = executor.submit(context.run, send_api_request, server, api_call,
+                                     dict(params or {}, **(server_params or {}).get(server, {})), timeout=timeout,
+                                     parser=parser_factory() if parser_factory else None)
+            futures[future] = server
+        wait(futures, timeout=deadline)
+    finally:
+        # Don't let stragglers hold the response
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    responses = {}
+    missing = []
+    for future, server in futures.items():
+        if future.done():
+            timing.merge(branches[server])
+        if future.done() and not future.cancelled() and future.exception() is None:
+            responses[server] = future.result()
+        else:
+            if not future.done():
+                logger.warning(f"{api_call} on {server} exceeded the deadline of {deadline}s")
+            missing.append(server)
+
+    return responses, missing
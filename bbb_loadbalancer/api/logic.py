@@ -1,16 +1,27 @@
 """
 The core logic of the loadbalancer
 """
-import random
+import asyncio
+import logging
+import time
+from datetime import datetime, timedelta, timezone
 
-from django.db.models import QuerySet, Sum, Q
-from typing import Tuple
+from asgiref.sync import sync_to_async
+from django.core.cache import cache
+from django.db import IntegrityError
+from django.db.models import QuerySet
+from typing import List, Optional, Sequence, Tuple
 
-from api.bbb_api import send_api_request, build_api_url
+from api import placement, timing
+from api.bbb_api import send_api_request, asend_api_request, build_api_url, get_timeout
+from api.response import EarlyResponse, respond
+from common_files import health
 from common_files.config import LoadBalancerConfig
 from common_files.models import BBBServer, Meeting
 
 
+logger = logging.getLogger("api")
+
 config = LoadBalancerConfig.from_json("../config.json")
 
 
@@ -20,65 +31,312 @@ class Loadbalancer:
     secret = config.secret
 
 
-def get_next_server(queryset: QuerySet = None) -> BBBServer:
+def get_next_server(queryset: QuerySet = None, load: int = 1) -> BBBServer:
     """
     Get the next server to create a meeting on.
 
-    Get a list of the servers with the smallest load total and return one at random
     :param queryset: optional queryset to limit the search (state and load will be handled)
-    :return: a server with the smallest load total
+    :param load: the new meeting's load
+    :return: the best server according to the configured placement strategy
+    """
+    return get_server_candidates(queryset, load)[0]
+
+
+@timing.phase("placement")
+def get_server_candidates(queryset: QuerySet = None, load: int = 1) -> List[BBBServer]:
+    """
+    Get all servers a meeting could be created on ordered from best to worst.
+
+    :param queryset: optional queryset to limit the search (state and load will be handled)
+    :param load: the new meeting's load
+    :return: the available servers ordered by the configured placement strategy,
+             slow servers and servers failing recently last (servers with an open circuit are left out)
     """
     if queryset is None:
         queryset = BBBServer.objects
 
-    # Get all servers with a calculated load attribute
-    servers = list(queryset
-                   .filter(state=BBBServer.ENABLED, unreachable=0)
-                   .annotate(load=Sum("meeting__load", filter=Q(meeting__ended=False)))
-                   .order_by("load"))
-
-    # Remove server above smallest load
-    smallest_load = servers[0].load
-    for i in range(len(servers)):
-        server = servers[i]
-        if server.load != smallest_load:
-            break
+    servers = list(queryset.filter(state=BBBServer.ENABLED, unreachable=0))
+    server_health = health.get_health(server.id for server in servers)
+
+    # Skip servers known to be down unless there is no other one
+    available = [server for server in servers if server_health[server.id].circuit != health.OPEN]
+    servers = placement.rank(available or servers, load)
+
+    # Sorting is stable, so the strategy's order is kept within the healthy, the slow and the failing servers
+    servers.sort(key=lambda server: (health.is_failing(server_health[server.id]),
+                                     health.is_slow(server_health[server.id])))
+    return servers
+
+
+def _register_meeting(server: BBBServer, meeting_id: str, parameters: dict) -> Tuple[Meeting, bool]:
+    # Register the meeting to get an id and delete it if the bbb api call fails.
+    # The database only allows one running meeting per meeting id, so of concurrent creates only one
+    # registers a new meeting (the leader), all others get the leader's meeting.
+    for _ in range(3):
+        try:
+            return Meeting.objects.create_running(
+                meeting_id=meeting_id,
+                internal_id=Meeting.TEMP_INTERNAL_ID,
+                server=server,
+                load=int(parameters["load"]) if "load" in parameters else 1,
+                create_query=dict(parameters),
+            ), True
+        except IntegrityError:
+            pass
+        try:
+            meeting = Meeting.running.select_related("server").get(meeting_id=meeting_id)
+        except Meeting.DoesNotExist:
+            # The running meeting ended in between
+            continue
+        if _abandoned(meeting):
+            logger.warning(f"Discarding the abandoned registration of {meeting_id}")
+            meeting.discard()
+            continue
+        return meeting, False
+    raise RuntimeError(f"Couldn't register meeting {meeting_id}")
+
+
+def _abandoned(meeting: Meeting) -> bool:
+    # A leader which died (e.g. its worker was killed) left its placeholder behind
+    max_age = timedelta(seconds=config.create.failover_budget + config.create.wait)
+    return (meeting.internal_id == Meeting.TEMP_INTERNAL_ID
+            and meeting.created < datetime.now(tz=timezone.utc) - max_age)
+
+
+def _result_key(meeting: Meeting) -> str:
+    return f"create:{meeting.id}"
+
+
+def _no_response() -> EarlyResponse:
+    return EarlyResponse(respond(
+        False, "noResponse",
+        "An internal server didn't respond. Try again in some seconds or contact your admin."
+    ))
+
+
+def _update_meeting(meeting: Meeting, response: dict):
+    # Only called by the leader, followers never write the meeting.
+    # The response is cached first, so a follower seeing the internal id (or the meeting gone) without
+    # a cached response knows the response expired.
+    cache.set(_result_key(meeting), response, config.create.result_ttl)
+    if response["returncode"] == "SUCCESS":
+        meeting.internal_id = response["internalMeetingID"]
+        meeting.save(update_fields=["internal_id"])
+    else:
+        meeting.discard()
+
+
+def _poll_leader(meeting: Meeting) -> Tuple[Optional[Meeting], Optional[dict], bool]:
+    """
+    Check whether the leader of a meeting finished its create call
+
+    :param meeting: the meeting registered by another request
+    :type meeting: Meeting
+    :return: the meeting reloaded from the database (None if the leader discarded it),
+             the leader's response (None if it isn't cached) and whether the leader finished
+    :rtype: Tuple[Optional[Meeting], Optional[dict], bool]
+    """
+    response = cache.get(_result_key(meeting))
+    current = Meeting.objects.select_related("server").filter(id=meeting.id).first()
+    finished = response is not None or current is None or current.internal_id != Meeting.TEMP_INTERNAL_ID
+    return current, response, finished
+
+
+def _leader_result(meeting: Meeting, current: Optional[Meeting], response: Optional[dict],
+                   finished: bool) -> Tuple[Meeting, Optional[dict]]:
+    # Raise an error if the leader didn't finish in time or failed without leaving its response
+    if not finished:
+        logger.warning(f"Waiting for the create call of {meeting.meeting_id} timed out")
+        raise _no_response()
+    if current is None:
+        if response is None:
+            raise _no_response()
+        return meeting, response
+    return current, response
+
+
+def _wait_for_leader(meeting: Meeting) -> Tuple[Meeting, Optional[dict]]:
+    """
+    Wait for the create call of the request which registered a meeting and get its response
+
+    The follower only reads the meeting, updating or discarding it is up to the leader.
+
+    :param meeting: the meeting registered by another request
+    :type meeting: Meeting
+    :return: the meeting as the leader left it and the leader's response
+             (None if the leader succeeded too long ago for its response to be cached)
+    :rtype: Tuple[Meeting, Optional[dict]]
+    :raises EarlyResponse: noResponse if the leader didn't finish within create.wait seconds
+    """
+    deadline = time.monotonic() + config.create.wait
+    current, response, finished = _poll_leader(meeting)
+    while not finished and time.monotonic() < deadline:
+        time.sleep(config.create.poll_interval)
+        current, response, finished = _poll_leader(meeting)
+    return _leader_result(meeting, current, response, finished)
+
+
+async def _await_leader(meeting: Meeting) -> Tuple[Meeting, Optional[dict]]:
+    """
+    Async version of _wait_for_leader
+    """
+    deadline = time.monotonic() + config.create.wait
+    current, response, finished = await sync_to_async(_poll_leader)(meeting)
+    while not finished and time.monotonic() < deadline:
+        await asyncio.sleep(config.create.poll_interval)
+        current, response, finished = await sync_to_async(_poll_leader)(meeting)
+    return _leader_result(meeting, current, response, finished)
+
+
+def _abandon(meeting: Meeting, error: BaseException):
+    # Don't leave a placeholder behind, which would block the meeting id.
+    # The followers get the leader's error response, or noResponse for anything else.
+    if isinstance(error, EarlyResponse):
+        cache.set(_result_key(meeting), error.response["response"], config.create.result_ttl)
     else:
-        i = len(servers)
-    servers = servers[:i]
+        cache.delete(_result_key(meeting))
+    placeholder = Meeting.running.filter(id=meeting.id, internal_id=Meeting.TEMP_INTERNAL_ID).first()
+    if placeholder is not None:
+        placeholder.discard()
 
-    # Choose one at random
-    return random.choice(servers)
 
+def _failover_candidates(server: BBBServer, fallbacks: Sequence[BBBServer]) -> List[BBBServer]:
+    # The server followed by the fallbacks, at least the server itself is tried
+    candidates = [server] + [fallback for fallback in fallbacks if fallback != server]
+    return candidates[:max(1, config.create.failover_attempts)]
+
+
+def create_meeting(server: BBBServer, meeting_id: str, parameters: dict = None,
+                   fallbacks: Sequence[BBBServer] = ()) -> Tuple[Meeting, dict]:
+    """
+    Create a meeting on a server or reuse the result of a concurrent create call for the same meeting id
+
+    If the server doesn't respond, the meeting is created on the next fallback server
+    (at most create.failover_attempts servers within create.failover_budget seconds).
 
-def create_meeting(server: BBBServer, meeting_id: str, parameters: dict = None) -> Tuple[Meeting, dict]:
+    :param server: server to create the meeting on if it isn't running yet
+    :param meeting_id: the meeting id used by the api
+    :param parameters: the create call's parameters
+    :param fallbacks: servers to try in order if the server doesn't respond
+    :return: the meeting and the bbb server's response
+    :raises EarlyResponse: noResponse if no server responded
+    """
     if parameters is None:
         parameters = {}
 
-    if not Meeting.running.filter(meeting_id=meeting_id).exists():
-        # Register the meeting to get an id and delete it if the bbb api call fails
-        meeting = Meeting.objects.create(
-            meeting_id=meeting_id,
-            internal_id=Meeting.TEMP_INTERNAL_ID,
-            server=server,
-            load=parameters["load"] if "load" in parameters else 1,
-            create_query=dict(parameters),
-        )
-    else:
-        meeting = Meeting.running.get(meeting_id=meeting_id)
+    meeting, leader = _register_meeting(server, meeting_id, parameters)
+
+    # Direct logoutURL to us
+    parameters["logoutURL"] = build_api_url(Loadbalancer, "rejoin", {"meetingID": meeting.id})
+
+    if not leader:
+        meeting, response = _wait_for_leader(meeting)
+        if response is None:
+            # bbb answers a repeated create with the running meeting
+            response = send_api_request(meeting.server, "create", parameters, timeout=get_timeout(meeting.server))
+        return meeting, response
+
+    # Call bbb's api and fail over to the other servers
+    deadline = time.monotonic() + config.create.failover_budget
+    candidates = _failover_candidates(meeting.server, fallbacks)
+    try:
+        for i, candidate in enumerate(candidates):
+            try:
+                response = send_api_request(candidate, "create", parameters,
+                                            timeout=get_timeout(candidate, deadline - time.monotonic()))
+                break
+            except (EarlyResponse, RuntimeError):
+                if i + 1 >= len(candidates) or time.monotonic() >= deadline:
+                    raise
+                logger.warning(f"Creating {meeting_id} on {candidate} failed, trying the next server")
+
+        if candidate != meeting.server:
+            meeting.reassign(candidate)
+
+        _update_meeting(meeting, response)
+    except BaseException as error:
+        # Also when the worker is stopped or the response is malformed
+        _abandon(meeting, error)
+        raise
+    return meeting, response
+
+
+async def _acreate_on(meeting_id: str, candidates: List[BBBServer], parameters: dict,
+                      deadline: float) -> Tuple[BBBServer, dict]:
+    # Try the candidates one after another, starting the next one early if create.hedge_after is set
+    pending = {}
+    remaining = list(candidates)
+    error = None
+
+    def start_next():
+        candidate = remaining.pop(0)
+        task = asyncio.ensure_future(asend_api_request(candidate, "create", dict(parameters),
+                                                       timeout=get_timeout(candidate, deadline - time.monotonic())))
+        pending[task] = candidate
+
+    start_next()
+    try:
+        while pending:
+            timeout = deadline - time.monotonic()
+            if remaining and config.create.hedge_after > 0:
+                timeout = min(timeout, config.create.hedge_after)
+            done, _ = await asyncio.wait(pending, timeout=max(timeout, 0), return_when=asyncio.FIRST_COMPLETED)
+
+            for task in done:
+                candidate = pending.pop(task)
+                if task.exception() is None:
+                    return candidate, task.result()
+                error = task.exception()
+                logger.warning(f"Creating {meeting_id} on {candidate} failed")
+
+            if time.monotonic() >= deadline:
+                break
+            if remaining and (done or not pending or config.create.hedge_after > 0):
+                start_next()
+    finally:
+        # The losing requests might still create the meeting on their server,
+        # bbb ends it if nobody joins (meetingExpireIfNoUserJoinedInMinutes)
+        for task in pending:
+            task.cancel()
+
+    raise error if error is not None else _no_response()
+
+
+async def acreate_meeting(server: BBBServer, meeting_id: str, parameters: dict = None,
+                          fallbacks: Sequence[BBBServer] = ()) -> Tuple[Meeting, dict]:
+    """
+    Async version of create_meeting which doesn't block while waiting for the bbb server
+
+    It can additionally hedge: if the server hasn't responded after create.hedge_after seconds,
+    the next fallback server is tried at the same time and the first response is used.
+    """
+    if parameters is None:
+        parameters = {}
+
+    meeting, leader = await sync_to_async(_register_meeting)(server, meeting_id, parameters)
 
     # Direct logoutURL to us
     parameters["logoutURL"] = build_api_url(Loadbalancer, "rejoin", {"meetingID": meeting.id})
 
-    # Call bbb's api
-    response = send_api_request(meeting.server, "create", parameters)
+    if not leader:
+        meeting, response = await _await_leader(meeting)
+        if response is None:
+            # bbb answers a repeated create with the running meeting
+            response = await asend_api_request(meeting.server, "create", parameters,
+                                               timeout=get_timeout(meeting.server))
+        return meeting, response
 
-    # Update new meeting
-    if meeting.internal_id == Meeting.TEMP_INTERNAL_ID:
-        if response["returncode"] == "SUCCESS":
-            meeting.internal_id = response["internalMeetingID"]
-            meeting.save()
-        else:
-            meeting.delete()
+    # Call bbb's api and fail over to the other servers
+    candidates = _failover_candidates(meeting.server, fallbacks)
+    try:
+        candidate, response = await _acreate_on(meeting_id, candidates, parameters,
+                                                time.monotonic() + config.create.failover_budget)
+        if candidate != meeting.server:
+            await sync_to_async(meeting.reassign)(candidate)
 
+        await sync_to_async(_update_meeting)(meeting, response)
+    except BaseException as error:
+        # Also when the request is cancelled or the response is malformed
+        await sync_to_async(_abandon)(meeting, error)
+        raise
     return meeting, response
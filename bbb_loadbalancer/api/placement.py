@@ -0,0 +1,117 @@
+"""
+Strategies deciding which server a new meeting is placed on
+
+A strategy takes the candidate servers and the new meeting's load and returns the candidates ordered from best to worst.
+Strategies only look at the attributes running_load, capacity, participants, video_streams and cpu_load,
+so they can be used with anything looking like a BBBServer.
+"""
+import random
+from typing import Callable, Dict, List, Sequence
+
+from common_files.config import LoadBalancerConfig
+
+
+config = LoadBalancerConfig.from_json("../config.json")
+
+Strategy = Callable[[Sequence, int], List]
+strategies: Dict[str, Strategy] = {}
+
+
+def strategy(name: str):
+    """
+    Decorator registering a function as strategy
+
+    :param name: the name used to select the strategy in the config
+    :type name: str
+    """
+    def decorator(func: Strategy) -> Strategy:
+        strategies[name] = func
+        return func
+    return decorator
+
+
+def weighted_load(server) -> float:
+    """
+    Estimate how busy a server is relative to its size
+
+    :param server: server to estimate
+    :return: the server's running load plus its weighted live usage divided by its capacity
+    :rtype: float
+    """
+    usage = (server.running_load
+             + config.placement.participant_weight * server.participants
+             + config.placement.video_weight * server.video_streams)
+    return usage / server.capacity if server.capacity > 0 else float("inf")
+
+
+def overloaded(server) -> bool:
+    """
+    Check whether a server's cpu is above the configured limit
+
+    :param server: server to check
+    :return: whether the server should only be used if there is no other one
+    :rtype: bool
+    """
+    return server.cpu_load is not None and server.cpu_load >= config.placement.cpu_limit
+
+
+def _weighted_key(server):
+    return overloaded(server), weighted_load(server)
+
+
+def _shuffled(servers: Sequence) -> list:
+    # Sorting is stable, so shuffling first breaks ties at random
+    servers = list(servers)
+    random.shuffle(servers)
+    return servers
+
+
+@strategy("least_load")
+def least_load(servers: Sequence, load: int = 1) -> list:
+    """Order by the sum of the running meetings' load parameter ignoring capacity and live usage"""
+    return sorted(_shuffled(servers), key=lambda server: server.running_load)
+
+
+@strategy("least_weighted_load")
+def least_weighted_load(servers: Sequence, load: int = 1) -> list:
+    """Order by the load relative to the server's capacity including its live usage"""
+    return sorted(_shuffled(servers), key=_weighted_key)
+
+
+@strategy("power_of_two")
+def power_of_two(servers: Sequence, load: int = 1) -> list:
+    """Take the better of two random servers, which avoids herding onto the single least loaded one"""
+    servers = _shuffled(servers)
+    return sorted(servers[:2], key=_weighted_key) + sorted(servers[2:], key=_weighted_key)
+
+
+@strategy("bin_packing")
+def bin_packing(servers: Sequence, load: int = 1) -> list:
+    """Fill the busiest server which still has room for the meeting, so idle servers stay free for large meetings"""
+    servers = least_weighted_load(servers, load)
+
+    def fits(server) -> bool:
+        return (not overloaded(server)
+                and weighted_load(server) + load / server.capacity <= config.placement.bin_limit)
+
+    fitting = [server for server in servers if server.capacity > 0 and fits(server)]
+    fitting.reverse()
+    return fitting + [server for server in servers if server not in fitting]
+
+
+def rank(servers: Sequence, load: int = 1, strategy_name: str = None) -> list:
+    """
+    Order servers from best to worst to place a new meeting on
+
+    :param servers: candidate servers
+    :type servers: Sequence[BBBServer]
+    :param load: the new meeting's load
+    :type load: int
+    :param strategy_name: name of the strategy to use (defaults to placement.strategy)
+    :type strategy_name: str
+    :return: the candidates ordered from best to worst
+    :rtype: list
+    """
+    if strategy_name is None:
+        strategy_name = config.placement.strategy
+    return strategies[strategy_name](servers, load)
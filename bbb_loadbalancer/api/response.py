@@ -1,12 +1,14 @@
 import logging
 from functools import wraps
+from xml.sax.saxutils import escape, quoteattr
 from xml.sax.xmlreader import AttributesImpl
 
 from django.http import HttpResponse
-from jxmlease import XMLCDATANode, emit_xml
+from jxmlease import XMLCDATANode
+from jxmlease._basenode import XMLNodeBase
 
 
-logger = logging.getLogger("api")
+logger = logging.getLogger("api.responses")
 
 
 class RawXMLString(XMLCDATANode):
@@ -28,9 +30,119 @@ class RawXMLString(XMLCDATANode):
             content_handler.ignorableWhitespace(newl)
 
 
+_XML_DECLARATION = '<?xml version="1.0" encoding="utf-8"?>\n'
+_NEWLINE = "\n"
+_INDENT = "    "
+
+
+def _start_tag(tag: str, node) -> str:
+    attributes = getattr(node, "xml_attrs", None)
+    if attributes:
+        return "<" + tag + "".join(" " + name + "=" + quoteattr(value) for name, value in attributes.items()) + ">"
+    else:
+        return "<" + tag + ">"
+
+
+def _render_node(parts: list, tag: str, node, depth: int):
+    """
+    Append the xml of a single node to parts
+
+    This mirrors jxmlease's pretty printing, so the output is identical to emit_xml's.
+    """
+    node_type = type(node)
+
+    # Fast path for plain strings which are most of a response
+    if node_type is str:
+        parts.append(f"{depth * _INDENT}<{tag}>{escape(node)}</{tag}>\n" if depth > 0
+                     else f"<{tag}>{escape(node)}</{tag}>")
+        return
+
+    # Nodes from parsed xml keep their own tag
+    if isinstance(node, XMLNodeBase) and node.tag:
+        tag = node.tag
+
+    if isinstance(node, list):
+        for child in node:
+            _render_node(parts, tag, child, depth)
+        return
+
+    parts.append(depth * _INDENT)
+    if isinstance(node, RawXMLString):
+        parts.append(_start_tag(tag, node))
+        parts.append(node.get_cdata())
+    elif isinstance(node, dict):
+        parts.append(_start_tag(tag, node))
+        if node:
+            parts.append(_NEWLINE)
+            for key, child in node.items():
+                _render_node(parts, key, child, depth + 1)
+        if node_type is not dict and isinstance(node, XMLNodeBase):
+            parts.append(escape(node.get_cdata().strip()))
+        if node:
+            parts.append(depth * _INDENT)
+    else:
+        parts.append(_start_tag(tag, node))
+        if node is not None:
+            parts.append(escape(node if isinstance(node, str) else str(node)))
+    parts.append("</" + tag + ">")
+    if depth > 0:
+        parts.append(_NEWLINE)
+
+
+def render_xml(data: dict) -> str:
+    """
+    Render a response dict as xml
+
+    This is a faster replacement for jxmlease's emit_xml producing the same output for the dicts respond() creates.
+    Values may be nested dicts, lists, strings, anything convertible with str,
+    nodes returned by jxmlease's parse and RawXMLString.
+
+    :param data: the dict to render
+    :type data: dict
+    :return: xml document
+    :rtype: str
+    """
+    parts = []
+
+    # Like jxmlease only add the xml declaration if there will be a single root element
+    values = list(data.values())
+    if len(values) == 0 or (len(values) == 1 and not (isinstance(values[0], list) and len(values[0]) > 1)):
+        parts.append(_XML_DECLARATION)
+
+    first_element = True
+    for key, value in data.items():
+        if isinstance(value, list):
+            for child in value:
+                if not first_element:
+                    parts.append(_NEWLINE)
+                _render_node(parts, key, child, 0)
+                first_element = False
+        else:
+            if not first_element:
+                parts.append(_NEWLINE)
+            _render_node(parts, key, value, 0)
+            first_element = False
+
+    return "".join(parts)
+
+
+class PrerenderedResponse(dict):
+    """
+    A response dict which is rendered to xml only once
+    """
+
+    def __init__(self, response: dict):
+        super().__init__(response)
+        self.xml = render_xml(response).encode("utf-8")
+
+
 @wraps(HttpResponse)
 def XmlResponse(data, *args, **kwargs):
-    return HttpResponse(emit_xml(data), *args, content_type="text/xml", **kwargs)
+    if isinstance(data, PrerenderedResponse):
+        content = data.xml
+    else:
+        content = render_xml(data).encode("utf-8")
+    return HttpResponse(content, *args, content_type="text/xml", **kwargs)
 
 
 class EarlyResponse(RuntimeError):
@@ -77,3 +189,34 @@ def respond(success: bool = True,
         response.update(data)
 
     return {"response": response}
+
+
+_prerendered = {}
+
+
+def prerendered(success: bool = True,
+                message_key: str = None,
+                message: str = None,
+                data: dict = None) -> PrerenderedResponse:
+    """
+    Create a response dict like respond, but render its xml only once
+
+    Use this for static responses which are sent often. The data's values have to be hashable.
+
+    :param success: whether the call was successful (when False, message_key and message are required)
+    :type success: bool
+    :param message_key: a camelcase word to describe what happened (required if success is False)
+    :type message_key: str
+    :param message: a short description of what happened (required if success is False)
+    :type message: str
+    :param data: a dictionary containing any endpoint specific response data
+    :type data: dict
+    :return: response dictionary
+    :rtype: PrerenderedResponse
+    """
+    key = (success, message_key, message, tuple(data.items()) if data else None)
+    if key not in _prerendered:
+        _prerendered[key] = PrerenderedResponse(respond(success, message_key, message, data))
+    elif not success:
+        logger.info(f"FAILED: {message_key} | {message}")
+    return _prerendered[key]
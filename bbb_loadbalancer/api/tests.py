@@ -1,3 +1,413 @@
-from django.test import TestCase
+import asyncio
+import hashlib
+import threading
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+from unittest import mock
+from xml.parsers.expat import ExpatError
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.core.cache import cache
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from jxmlease import XMLDictNode, emit_xml, parse
+
+from api import bbb_api, logic, placement, timing
+from api.response import EarlyResponse, RawXMLString, render_xml, respond
+from common_files import health
+from common_files.models import BBBServer, Meeting
+
+LOCMEM_CACHE = {"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+
+
+def _created(internal_id="internal-1"):
+    return {"returncode": "SUCCESS", "internalMeetingID": internal_id}
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class CoalescedCreateTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.server = BBBServer.objects.create(server_id=1, url="https://bbb1.example.org/bigbluebutton/")
+        self.leader, is_leader = logic._register_meeting(self.server, "room", {})
+        self.assertTrue(is_leader)
+
+    def test_running_key_allows_one_leader(self):
+        meeting, is_leader = logic._register_meeting(self.server, "room", {})
+        self.assertFalse(is_leader)
+        self.assertEqual(meeting.id, self.leader.id)
+        self.assertEqual(Meeting.running.filter(meeting_id="room").count(), 1)
+
+    @mock.patch.dict(logic.config.create, {"wait": 0.2})
+    @mock.patch("api.logic.send_api_request")
+    def test_follower_timeout_leaves_meeting_alone(self, send_api_request):
+        with self.assertRaises(EarlyResponse) as context:
+            logic.create_meeting(self.server, "room", {})
+
+        self.assertEqual(context.exception.response["response"]["messageKey"], "noResponse")
+        send_api_request.assert_not_called()
+        self.leader.refresh_from_db()
+        self.assertEqual(self.leader.internal_id, Meeting.TEMP_INTERNAL_ID)
+        self.assertFalse(self.leader.ended)
+
+        # The leader can still finish
+        logic._update_meeting(self.leader, _created())
+        self.leader.refresh_from_db()
+        self.assertEqual(self.leader.internal_id, "internal-1")
+
+    @mock.patch.dict(logic.config.create, {"wait": 0.2})
+    @mock.patch("api.logic.asend_api_request")
+    def test_async_follower_timeout_leaves_meeting_alone(self, asend_api_request):
+        with self.assertRaises(EarlyResponse):
+            async_to_sync(logic.acreate_meeting)(self.server, "room", {})
+
+        asend_api_request.assert_not_called()
+        self.assertTrue(Meeting.running.filter(id=self.leader.id, internal_id=Meeting.TEMP_INTERNAL_ID).exists())
+
+    @mock.patch("api.logic.send_api_request")
+    def test_follower_gets_leaders_response_and_row(self, send_api_request):
+        logic._update_meeting(self.leader, _created())
+
+        meeting, response = logic.create_meeting(self.server, "room", {})
+
+        send_api_request.assert_not_called()
+        self.assertEqual(response, _created())
+        self.assertEqual(meeting.id, self.leader.id)
+        self.assertEqual(meeting.internal_id, "internal-1")
+
+    @mock.patch("api.logic.send_api_request", return_value=_created())
+    def test_follower_asks_again_if_response_expired(self, send_api_request):
+        logic._update_meeting(self.leader, _created())
+        cache.clear()
+
+        meeting, response = logic.create_meeting(self.server, "room", {})
+
+        send_api_request.assert_called_once()
+        self.assertEqual(meeting.internal_id, "internal-1")
+        self.assertTrue(Meeting.running.filter(id=self.leader.id).exists())
+
+    def test_follower_gets_leaders_failure(self):
+        follower, _ = logic._register_meeting(self.server, "room", {})
+        error = logic._no_response()
+        logic._abandon(self.leader, error)
+        self.assertFalse(Meeting.objects.filter(id=self.leader.id).exists())
+
+        meeting, response = logic._wait_for_leader(follower)
+
+        self.assertEqual(response, error.response["response"])
+        self.assertEqual(response["returncode"], "FAILED")
+
+    @mock.patch("api.logic.send_api_request", return_value=_created())
+    def test_abandoned_registration_is_replaced(self, send_api_request):
+        max_age = logic.config.create.failover_budget + logic.config.create.wait
+        Meeting.objects.filter(id=self.leader.id).update(
+            created=datetime.now(tz=timezone.utc) - timedelta(seconds=max_age + 1))
+
+        meeting, response = logic.create_meeting(self.server, "room", {})
+
+        send_api_request.assert_called_once()
+        self.assertNotEqual(meeting.id, self.leader.id)
+        self.assertFalse(Meeting.objects.filter(id=self.leader.id).exists())
+        self.assertEqual(Meeting.running.get(meeting_id="room").internal_id, "internal-1")
+
+    @mock.patch("api.logic.send_api_request", return_value={"returncode": "SUCCESS"})
+    def test_leader_discards_its_placeholder_on_unexpected_errors(self, send_api_request):
+        with self.assertRaises(KeyError):
+            logic.create_meeting(self.server, "other", {})
+
+        self.assertFalse(Meeting.objects.filter(meeting_id="other").exists())
+        send_api_request.return_value = _created()
+        meeting, response = logic.create_meeting(self.server, "other", {})
+        self.assertEqual(meeting.internal_id, "internal-1")
+
+    @mock.patch("api.logic.asend_api_request", side_effect=asyncio.CancelledError)
+    def test_cancelled_leader_discards_its_placeholder(self, asend_api_request):
+        with self.assertRaises(asyncio.CancelledError):
+            async_to_sync(logic.acreate_meeting)(self.server, "other", {})
+
+        self.assertFalse(Meeting.objects.filter(meeting_id="other").exists())
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class FailoverTest(TransactionTestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.servers = [BBBServer.objects.create(server_id=i, url=f"https://bbb{i}.example.org/bigbluebutton/")
+                        for i in range(3)]
+
+    def _fail_on(self, *server_ids):
+        def send_api_request(server, api_call, params=None, timeout=None):
+            if server.server_id in server_ids:
+                raise EarlyResponse(respond(False, "noResponse", "no response"))
+            return _created(f"internal-{server.server_id}")
+        return send_api_request
+
+    def test_fails_over_in_order(self):
+        with mock.patch("api.logic.send_api_request", side_effect=self._fail_on(0)) as send_api_request:
+            meeting, response = logic.create_meeting(self.servers[0], "room", {}, fallbacks=self.servers[1:])
+
+        self.assertEqual([call.args[0].server_id for call in send_api_request.call_args_list], [0, 1])
+        self.assertEqual(meeting.server.server_id, 1)
+        self.assertEqual(Meeting.running.get(meeting_id="room").server_id, self.servers[1].id)
+
+    @mock.patch.dict(logic.config.create, {"failover_attempts": 2})
+    def test_gives_up_after_attempts_and_discards(self):
+        with mock.patch("api.logic.send_api_request", side_effect=self._fail_on(0, 1, 2)) as send_api_request:
+            with self.assertRaises(EarlyResponse):
+                logic.create_meeting(self.servers[0], "room", {}, fallbacks=self.servers[1:])
+
+        self.assertEqual(send_api_request.call_count, 2)
+        self.assertFalse(Meeting.objects.filter(meeting_id="room").exists())
+
+    @mock.patch.dict(logic.config.create, {"failover_budget": 0})
+    def test_budget_stops_failover(self):
+        with mock.patch("api.logic.send_api_request", side_effect=self._fail_on(0)) as send_api_request:
+            with self.assertRaises(EarlyResponse):
+                logic.create_meeting(self.servers[0], "room", {}, fallbacks=self.servers[1:])
+
+        self.assertEqual(send_api_request.call_count, 1)
+
+    @mock.patch.dict(logic.config.create, {"failover_attempts": 0})
+    def test_tries_the_server_without_attempts(self):
+        with mock.patch("api.logic.send_api_request", side_effect=self._fail_on()) as send_api_request:
+            meeting, response = logic.create_meeting(self.servers[0], "room", {}, fallbacks=self.servers[1:])
+
+        self.assertEqual(send_api_request.call_count, 1)
+        self.assertEqual(meeting.internal_id, "internal-0")
+
+    @mock.patch.dict(logic.config.create, {"failover_attempts": 0})
+    def test_async_tries_the_server_without_attempts(self):
+        async def asend_api_request(server, api_call, params=None, timeout=None):
+            return self._fail_on()(server, api_call, params, timeout)
+
+        with mock.patch("api.logic.asend_api_request", side_effect=asend_api_request) as send_api_request:
+            meeting, response = async_to_sync(logic.acreate_meeting)(self.servers[0], "room", {},
+                                                                     fallbacks=self.servers[1:])
+
+        self.assertEqual(send_api_request.call_count, 1)
+        self.assertEqual(meeting.internal_id, "internal-0")
+
+    def test_async_fails_over_in_order(self):
+        async def asend_api_request(server, api_call, params=None, timeout=None):
+            return self._fail_on(0)(server, api_call, params, timeout)
+
+        with mock.patch("api.logic.asend_api_request", side_effect=asend_api_request) as send_api_request:
+            meeting, response = async_to_sync(logic.acreate_meeting)(self.servers[0], "room", {},
+                                                                     fallbacks=self.servers[1:])
+
+        self.assertEqual([call.args[0].server_id for call in send_api_request.call_args_list], [0, 1])
+        self.assertEqual(meeting.internal_id, "internal-1")
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class CircuitProbeTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.server = BBBServer.objects.create(server_id=1, url="https://bbb1.example.org/bigbluebutton/")
+        for _ in range(health.config.health.circuit_failures):
+            health.record_failure(self.server.id)
+        entry = cache.get(health._key(self.server.id))
+        entry["open_until"] = 0
+        health._save(self.server.id, entry)
+
+    def _assert_probe_ended(self):
+        self.assertEqual(health.get_health([self.server.id])[self.server.id].circuit, health.HALF_OPEN)
+        self.assertTrue(health.before_request(self.server.id))
+
+    def test_invalid_xml_ends_the_probe(self):
+        parser = mock.Mock()
+        parser.feed.side_effect = ExpatError("unclosed token")
+        with mock.patch("api.bbb_api.get_client") as get_client:
+            get_client().stream().__enter__().iter_bytes.return_value = [b"<response"]
+            with self.assertRaises(RuntimeError):
+                bbb_api.send_api_request(self.server, "getMeetings", parser=parser)
+        self._assert_probe_ended()
+
+    def test_cancelled_call_ends_the_probe(self):
+        async def call():
+            with mock.patch("api.bbb_api.get_async_client") as get_async_client:
+                get_async_client().stream().__aenter__.side_effect = asyncio.CancelledError
+                await bbb_api.asend_api_request(self.server, "getMeetings")
+
+        with self.assertRaises(asyncio.CancelledError):
+            async_to_sync(call)()
+        self._assert_probe_ended()
+
+
+class AsyncClientTest(SimpleTestCase):
+
+    def test_client_is_closed_with_its_loop(self):
+        async def get_clients():
+            return bbb_api.get_async_client(), bbb_api.get_async_client()
+
+        first, second = async_to_sync(get_clients)()
+        self.assertIs(first, second)
+        self.assertTrue(first.is_closed)
+
+        client = asyncio.run(get_clients())[0]
+        self.assertIsNot(client, first)
+        self.assertTrue(client.is_closed)
+
+
+class RenderXmlTest(SimpleTestCase):
+
+    def test_matches_emit_xml(self):
+        parsed = parse(
+            "<response><returncode>SUCCESS</returncode><meetings>"
+            "<meeting><meetingID>a</meetingID><attendees><attendee role=\"MODERATOR\">x</attendee></attendees></meeting>"
+            "<meeting><meetingID>b &amp; c</meetingID><metadata/></meeting>"
+            "</meetings></response>"
+        )
+        cases = {
+            "strings": respond(True, "key", "message"),
+            "parsed": {"response": parsed["response"]},
+            "parsed in a dict": respond(True, data={"meetings": parsed["response"]["meetings"]}),
+            "raw xml": respond(True, data={"meetings": {"meeting": [
+                RawXMLString("<meetingID>a</meetingID>", tag="meeting"),
+                RawXMLString("<meetingID>b</meetingID>", tag="meeting"),
+            ]}}),
+            "none": respond(True, data={"recordings": None}),
+            "empty dict": respond(True, data={"meetings": {}}),
+            "list": respond(True, data={"recordings": {"recording": ["a", "b"]}}),
+            "root list": {"meeting": ["a", "b"]},
+            "several roots": {"a": "1", "b": "2"},
+            "numbers": respond(True, data={"participantCount": 3, "load": 1.5, "running": True}),
+            "attributes": respond(True, data={"node": XMLDictNode({"a": "b"}, tag="node", xml_attrs={"x": "1"})}),
+            "escaping": respond(True, data={"text": "<a> & \"b\"", "node": XMLDictNode(
+                {"a": "b"}, tag="node", xml_attrs={"x": "<a> & \"b\""})}),
+        }
+        for name, data in cases.items():
+            with self.subTest(name):
+                self.assertEqual(render_xml(data), emit_xml(data))
+
+
+def _get(client, endpoint, query=""):
+    checksum = hashlib.sha1((endpoint + query + settings.SHARED_SECRET).encode("utf-8")).hexdigest()
+    query = f"{query}&checksum={checksum}" if query else f"checksum={checksum}"
+    return client.get(f"/bigbluebutton/api/{endpoint}?{query}")
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class FanOutTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.servers = [BBBServer.objects.create(server_id=i, url=f"https://bbb{i}.example.org/bigbluebutton/")
+                        for i in range(3)]
+
+    @mock.patch.dict(timing.config.timing, {"server_timing": True})
+    def test_server_timing_includes_the_fanned_out_calls(self):
+        def send_api_request(server, api_call, params=None, timeout=None, parser=None):
+            timing.record("upstream", 0.05)
+            return {"returncode": "SUCCESS", "messageKey": "noMeetings"}
+
+        with mock.patch("api.bbb_api.send_api_request", side_effect=send_api_request):
+            response = _get(self.client, "getMeetings")
+
+        self.assertIn("upstream;dur=150.0", response["Server-Timing"])
+
+    @mock.patch.dict(bbb_api.config.upstream, {"fanout_deadline": 0.2})
+    @mock.patch.dict(logic.config.upstream, {"relay_meetings": False})
+    def test_get_meetings_reports_the_missing_server(self):
+        released = threading.Event()
+
+        def send_api_request(server, api_call, params=None, timeout=None, parser=None):
+            if server.server_id == 1:
+                released.wait(5)
+            return parse(f"<response><returncode>SUCCESS</returncode><meetings><meeting>"
+                         f"<meetingID>room-{server.server_id}</meetingID>"
+                         f"</meeting></meetings></response>")["response"]
+
+        try:
+            with mock.patch("api.bbb_api.send_api_request", side_effect=send_api_request):
+                response = parse(_get(self.client, "getMeetings").content)["response"]
+        finally:
+            released.set()
+
+        self.assertEqual(response["returncode"], "SUCCESS")
+        self.assertEqual([meeting["meetingID"] for meeting in response["meetings"]["meeting"]], ["room-0", "room-2"])
+        self.assertEqual(response["missingServers"]["serverID"], "1")
+
+    def _recordings(self, response) -> dict:
+        recordings = parse(response.content)["response"]["recordingResults"]["recording"]
+        return dict((str(recording["recordID"]), str(recording["result"])) for recording in recordings)
+
+    def test_publish_recordings_reports_every_recording(self):
+        for record_id, server in (("rec-0a", 0), ("rec-0b", 0), ("rec-1", 1), ("rec-2", 2)):
+            meeting = Meeting.objects.create_running(meeting_id=record_id, internal_id=record_id,
+                                                     server=self.servers[server], load=1)
+            meeting.mark_ended()
+        BBBServer.objects.filter(server_id=2).update(state=BBBServer.DISABLED)
+
+        def send_api_request(server, api_call, params=None, timeout=None, parser=None):
+            if server.server_id == 1:
+                raise EarlyResponse(respond(False, "noResponse", "no response"))
+            return {"returncode": "SUCCESS", "published": params["publish"]}
+
+        with mock.patch("api.bbb_api.send_api_request", side_effect=send_api_request) as send:
+            response = _get(self.client, "publishRecordings",
+                            "recordID=rec-0a,rec-0b,rec-1,rec-2,unknown&publish=true")
+
+        self.assertEqual(parse(response.content)["response"]["returncode"], "SUCCESS")
+        self.assertEqual(self._recordings(response), {
+            "rec-0a": "SUCCESS", "rec-0b": "SUCCESS", "rec-1": "noResponse", "rec-2": "serverDisabled",
+            "unknown": "notFound",
+        })
+        self.assertEqual(sorted((call.args[0].server_id, call.args[2]) for call in send.call_args_list), [
+            (0, {"publish": "true", "recordID": "rec-0a,rec-0b"}), (1, {"publish": "true", "recordID": "rec-1"}),
+        ])
+
+    def test_update_recordings_fails_without_any_success(self):
+        for server in self.servers[:2]:
+            meeting = Meeting.objects.create_running(meeting_id=f"rec-{server.server_id}",
+                                                     internal_id=f"rec-{server.server_id}", server=server, load=1)
+            meeting.mark_ended()
+
+        def send_api_request(server, api_call, params=None, timeout=None, parser=None):
+            if server.server_id == 1:
+                raise EarlyResponse(respond(False, "noResponse", "no response"))
+            return {"returncode": "FAILED", "messageKey": "notFound"}
+
+        with mock.patch("api.bbb_api.send_api_request", side_effect=send_api_request):
+            response = _get(self.client, "updateRecordings", "recordID=rec-0,rec-1")
+
+        self.assertEqual(parse(response.content)["response"]["returncode"], "FAILED")
+        self.assertEqual(self._recordings(response), {"rec-0": "notFound", "rec-1": "noResponse"})
+
+
+def _server(name, running_load=0, capacity=1.0, participants=0, video_streams=0, cpu_load=None):
+    return SimpleNamespace(name=name, running_load=running_load, capacity=capacity, participants=participants,
+                           video_streams=video_streams, cpu_load=cpu_load)
+
+
+class PlacementTest(SimpleTestCase):
+
+    def _rank(self, strategy_name, servers, load=1):
+        return [server.name for server in placement.rank(servers, load, strategy_name)]
+
+    def test_least_load_ignores_capacity(self):
+        servers = [_server("a", 4, capacity=4), _server("b", 2), _server("c", 3)]
+        self.assertEqual(self._rank("least_load", servers), ["b", "c", "a"])
+
+    def test_least_weighted_load_uses_capacity_and_usage(self):
+        servers = [_server("small", 2), _server("large", 3, capacity=4), _server("busy", 0, video_streams=10)]
+        self.assertEqual(self._rank("least_weighted_load", servers), ["large", "small", "busy"])
+
+    def test_overloaded_servers_come_last(self):
+        servers = [_server("hot", 0, cpu_load=95), _server("a", 5)]
+        for name in ("least_weighted_load", "bin_packing"):
+            self.assertEqual(self._rank(name, servers), ["a", "hot"])
+
+    @mock.patch.dict(placement.config.placement, {"bin_limit": 10})
+    def test_bin_packing_fills_the_busiest_server_with_room(self):
+        servers = [_server("idle", 0), _server("half", 5), _server("full", 10)]
+        self.assertEqual(self._rank("bin_packing", servers), ["half", "idle", "full"])
+        self.assertEqual(self._rank("bin_packing", servers, load=6), ["idle", "half", "full"])
+
+    def test_power_of_two_keeps_all_servers(self):
+        servers = [_server(str(i), i) for i in range(5)]
+        ranked = self._rank("power_of_two", servers)
+        self.assertEqual(sorted(ranked), ["0", "1", "2", "3", "4"])
+        self.assertLessEqual(int(ranked[0]), int(ranked[1]))
@@ -0,0 +1,150 @@
+"""
+Time spent per phase of an api request
+
+_GetView starts the timings of each request, code along the way records its phases:
+
+Phase     | Recorded by
+----------|-------------
+checksum  | _GetView.get_parameters
+placement | logic.get_server_candidates
+upstream  | every call to a bbb server (summed up if there are several)
+render    | rendering the xml response
+
+The timings are kept in a context variable, so they follow the request into sync_to_async threads and tasks.
+Threads started by other means run in a context from branch and have their timings merged back afterwards.
+"""
+import json
+import logging
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import Context, ContextVar, copy_context
+from typing import Optional, Tuple
+
+from django.http import HttpRequest, HttpResponse
+
+from common_files import metrics
+from common_files.config import LoadBalancerConfig
+
+slow_logger = logging.getLogger("api.slow")
+
+config = LoadBalancerConfig.from_json("../config.json")
+
+
+class Timings:
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.phases = defaultdict(float)
+        self.server_id = None
+
+
+_current: ContextVar[Optional[Timings]] = ContextVar("timings", default=None)
+
+
+def start() -> Timings:
+    """
+    Start the timings of a new request
+
+    :return: the request's timings to pass to finish
+    :rtype: Timings
+    """
+    timings = Timings()
+    _current.set(timings)
+    return timings
+
+
+@contextmanager
+def phase(name: str):
+    """
+    Add the time spent in the with block (or decorated function) to a phase of the current request
+    """
+    timings = _current.get()
+    if timings is None:
+        yield
+        return
+
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.phases[name] += time.perf_counter() - start_time
+
+
+def record(name: str, seconds: float):
+    """
+    Add time to a phase of the current request
+    """
+    timings = _current.get()
+    if timings is not None:
+        timings.phases[name] += seconds
+
+
+def set_server(server_id: int):
+    """
+    Set the server the current request was sent to
+
+    :param server_id: the server's server_id
+    :type server_id: int
+    """
+    timings = _current.get()
+    if timings is not None:
+        timings.server_id = server_id
+
+
+def branch() -> Tuple[Context, Optional[Timings]]:
+    """
+    Create a context for work done on behalf of the current request in another thread
+
+    The work records into timings of its own, so several threads don't race on the request's timings.
+
+    :return: the context to run the work in and its timings to pass to merge (None outside of a request)
+    :rtype: Tuple[Context, Optional[Timings]]
+    """
+    context = copy_context()
+    if _current.get() is None:
+        return context, None
+    timings = Timings()
+    context.run(_current.set, timings)
+    return context, timings
+
+
+def merge(timings: Optional[Timings]):
+    """
+    Add the phases of a branch's timings to the current request
+    """
+    current = _current.get()
+    if current is None or timings is None:
+        return
+    for name, seconds in timings.phases.items():
+        current.phases[name] += seconds
+
+
+def finish(timings: Timings, request: HttpRequest, response: HttpResponse):
+    """
+    Report a request's timings
+
+    They are added to the Server-Timing header if timing.server_timing is set,
+    exported to common_files.metrics and logged to the slow request log if the request took at least
+    timing.slow_request seconds.
+    """
+    total = time.perf_counter() - timings.start
+    match = getattr(request, "resolver_match", None)
+    endpoint = match.route if match is not None else request.path
+
+    for name, seconds in timings.phases.items():
+        metrics.request_phase_duration.labels(endpoint, name).observe(seconds)
+
+    if config.timing.server_timing:
+        response["Server-Timing"] = ", ".join(
+            [f"{name};dur={seconds * 1000:.1f}" for name, seconds in timings.phases.items()]
+            + [f"total;dur={total * 1000:.1f}"]
+        )
+
+    if config.timing.slow_request and total >= config.timing.slow_request:
+        slow_logger.warning(json.dumps({
+            "endpoint": endpoint,
+            "meetingID": request.GET.get("meetingID"),
+            "serverID": timings.server_id,
+            "total": round(total, 4),
+            "phases": {name: round(seconds, 4) for name, seconds in timings.phases.items()},
+        }))
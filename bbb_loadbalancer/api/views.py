@@ -1,3 +1,4 @@
+import asyncio
 import hashlib
 import json
 import logging
@@ -5,17 +6,23 @@ import re
 import os.path
 from collections import defaultdict
 from datetime import datetime, timedelta
+from functools import partial, update_wrapper
+from typing import Dict, List, Optional, Sequence, Tuple
 
-import httpx
+from asgiref.sync import sync_to_async
 from django.http import HttpRequest, HttpResponseRedirect
 from django.views import View
 from jxmlease import XMLDictNode
 from rc_protocol import get_checksum, validate_checksum
 
-from api.bbb_api import send_api_request, build_api_url
-from api.logic import get_next_server, create_meeting, config, Loadbalancer
-from api.response import XmlResponse, EarlyResponse, RawXMLString, respond
+from api.bbb_api import send_api_request, asend_api_request, send_api_requests, build_api_url, get_client, \
+    get_async_client
+from api.logic import get_server_candidates, create_meeting, acreate_meeting, config, Loadbalancer
+from api import timing
+from api.response import XmlResponse, EarlyResponse, RawXMLString, respond, prerendered
+from api.xml_stream import ItemsParser, ItemsRelayParser
 from bbb_loadbalancer import settings
+from common_files import archive, directory
 from common_files.models import Meeting, BBBServer
 
 _checksum_regex = re.compile(r"checksum=([^&]+)&|&?checksum=([^&]+)$")
@@ -25,16 +32,48 @@ _checksum_algos = [
 ]
 
 logger = logging.getLogger("api")
+request_logger = logging.getLogger("api.requests")
 
 
 class _GetView(View):
     def get(self, request: HttpRequest, *args, **kwargs):
+        timings = timing.start()
+        with timing.phase("checksum"):
+            parameters = self.get_parameters(request)
+        if parameters is None:
+            return XmlResponse(prerendered(False, "checksumError", "You did not pass the checksum security check"))
+
+        # Call to subclass for actual processing logic
+        try:
+            response = self.process(parameters, request)
+            assert response is not None, \
+                "The process method didn't return a response"
+        except EarlyResponse as early_response:
+            response = early_response.response
+        except BaseException:
+            logger.exception("FAILED due to exception:")
+            response = respond(False, "internalError", "An internal server error occurred.")
+
+        with timing.phase("render"):
+            response = self.wrap_response(response)
+        timing.finish(timings, request, response)
+        return response
+
+    def get_parameters(self, request: HttpRequest) -> Optional[dict]:
+        """
+        Check the request's checksum and get its parameters
+
+        :param request: the incoming request
+        :type request: HttpRequest
+        :return: the parameters as simple dict without checksum or None if the checksum is wrong
+        :rtype: Optional[dict]
+        """
         # Get data for checksum test
         endpoint = request.path.split("/")[-1]
         checksum = request.GET.get("checksum")
         query_string = _checksum_regex.sub("", request.META["QUERY_STRING"])
 
-        logger.info(f"GET {request.get_full_path()}")
+        request_logger.info(f"GET {request.get_full_path()}")
 
         # Try different hashing algorithms
         for hash_algo in _checksum_algos:
@@ -42,22 +81,13 @@ class _GetView(View):
                 break
         # No checksum matched
         else:
-            return XmlResponse(respond(False, "checksumError", "You did not pass the checksum security check"))
+            return None
 
         # Get parameters as simple dict without checksum
-        parameters = dict((key, request.GET.get(key)) for key in request.GET if key != "checksum")
-
-        # Call to subclass for actual processing logic
-        try:
-            response = self.process(parameters, request)
-            assert response is not None, \
-                "The process method didn't return a response"
-        except EarlyResponse as early_response:
-            response = early_response.response
-        except BaseException:
-            logger.exception("FAILED due to exception:")
-            response = respond(False, "internalError", "An internal server error occurred.")
+        return dict((key, request.GET.get(key)) for key in request.GET if key != "checksum")
 
+    @staticmethod
+    def wrap_response(response):
         # Wrap response with XmlResponse if necessary
         if isinstance(response, dict):
             return XmlResponse(response)
@@ -94,19 +124,88 @@ class _GetView(View):
         try:
             return Meeting.running.get(meeting_id=meeting_id)
         except Meeting.DoesNotExist:
-            raise EarlyResponse(respond(
+            raise EarlyResponse(prerendered(
                 False, "notFound",
                 "We could not find a meeting with that meeting ID - perhaps the meeting is not yet running?"
             )) from None
 
+    def get_running_meeting(self, parameters: dict) -> Tuple[directory.RunningMeeting, BBBServer]:
+        """
+        Helper method to look up the running meeting in the directory and respond with an error if there is none
+
+        Unlike get_meeting this doesn't query the database for meetings which have been looked up recently.
+        :param parameters: The parameters from the process method call
+        :type parameters: dict
+        :return: running meeting and its server
+        :rtype: Tuple[directory.RunningMeeting, BBBServer]
+        :raises EarlyResponse: notFound
+        """
+        meeting = directory.lookup(self.get_meeting_id(parameters))
+        if meeting is None:
+            raise EarlyResponse(prerendered(
+                False, "notFound",
+                "We could not find a meeting with that meeting ID - perhaps the meeting is not yet running?"
+            ))
+        return meeting, directory.get_server(meeting.server_id)
+
     def process(self, parameters: dict, request: HttpRequest):
         raise NotImplementedError
 
 
+class _AsyncGetView(_GetView):
+    """
+    Variant of _GetView for endpoints mostly waiting for upstream servers
+
+    Its process method is a coroutine, so an asgi worker can serve other requests while it waits.
+    Database access has to be wrapped with sync_to_async.
+    """
+
+    @classmethod
+    def as_view(cls, **initkwargs):
+        view = super().as_view(**initkwargs)
+
+        # Django 3.2 only runs views natively async if they are coroutine functions
+        async def async_view(request, *args, **kwargs):
+            response = view(request, *args, **kwargs)
+            if asyncio.iscoroutine(response):
+                response = await response
+            return response
+        update_wrapper(async_view, view)
+        return async_view
+
+    async def get(self, request: HttpRequest, *args, **kwargs):
+        timings = timing.start()
+        with timing.phase("checksum"):
+            parameters = self.get_parameters(request)
+        if parameters is None:
+            return XmlResponse(prerendered(False, "checksumError", "You did not pass the checksum security check"))
+
+        # Call to subclass for actual processing logic
+        try:
+            response = await self.process(parameters, request)
+            assert response is not None, \
+                "The process method didn't return a response"
+        except EarlyResponse as early_response:
+            response = early_response.response
+        except asyncio.CancelledError:
+            raise
+        except BaseException:
+            logger.exception("FAILED due to exception:")
+            response = respond(False, "internalError", "An internal server error occurred.")
+
+        with timing.phase("render"):
+            response = self.wrap_response(response)
+        timing.finish(timings, request, response)
+        return response
+
+    async def process(self, parameters: dict, request: HttpRequest):
+        raise NotImplementedError
+
+
 class DefaultView(View):
 
     def get(self, request: HttpRequest, *args, **kwargs):
-        logger.info(f"GET {request.path}")
+        request_logger.info(f"GET {request.path}")
         return XmlResponse(respond(False, "unsupportedRequest", "This request is not supported."))
 
 
@@ -120,14 +219,12 @@ class Index(View):
         return XmlResponse(respond(True, data={"version": "2.0"}))
 
 
-class Create(_GetView):
+class Create(_AsyncGetView):
 
-    def process(self, parameters: dict, request: HttpRequest):
-        meeting, response = create_meeting(
-            get_next_server(),
-            self.get_meeting_id(parameters),
-            parameters,
-        )
+    async def process(self, parameters: dict, request: HttpRequest):
+        meeting_id = self.get_meeting_id(parameters)
+        candidates = await sync_to_async(get_server_candidates)(load=int(parameters.get("load", 1)))
+        meeting, response = await acreate_meeting(candidates[0], meeting_id, parameters, fallbacks=candidates[1:])
 
         if response["returncode"] == "SUCCESS":
             logger.info(f"SUCCESS: created on {meeting.server}")
@@ -138,8 +235,8 @@ class Create(_GetView):
 class Join(_GetView):
 
     def process(self, parameters: dict, request: HttpRequest):
-        meeting = self.get_meeting(parameters)
-        redirect = build_api_url(meeting.server, "join", parameters)
+        _, server = self.get_running_meeting(parameters)
+        redirect = build_api_url(server, "join", parameters)
         logger.info(f"-> {redirect}")
         response = HttpResponseRedirect(redirect)
 
@@ -162,10 +259,10 @@ class IsMeetingRunning(_GetView):
     def process(self, parameters: dict, request: HttpRequest):
         meeting_id = self.get_meeting_id(parameters)
 
-        if Meeting.running.filter(meeting_id=meeting_id).exists():
-            return respond(data={"running": "true"})
+        if directory.lookup(meeting_id) is not None:
+            return prerendered(data={"running": "true"})
         else:
-            return respond(data={"running": "false"})
+            return prerendered(data={"running": "false"})
 
 
 class End(_GetView):
@@ -175,35 +272,29 @@ class End(_GetView):
 
         response = send_api_request(meeting.server, "end", parameters)
         if response["returncode"] == "SUCCESS":
-            meeting.ended = True
-            meeting.save()
+            meeting.mark_ended()
 
         return respond(data=response)
 
 
-class GetMeetingInfo(_GetView):
+class GetMeetingInfo(_AsyncGetView):
 
-    def process(self, parameters: dict, request: HttpRequest):
-        meeting = self.get_meeting(parameters)
-        response = send_api_request(meeting.server, "getMeetingInfo", parameters)
+    async def process(self, parameters: dict, request: HttpRequest):
+        _, server = await sync_to_async(self.get_running_meeting)(parameters)
+        response = await asend_api_request(server, "getMeetingInfo", parameters)
         return XmlResponse({"response": response})
 
 
 class GetMeetings(_GetView):
 
     @staticmethod
-    def from_server(server: BBBServer) -> list:
+    def meetings_from_response(response: dict) -> list:
         """
-        Get all meetings on a server
+        Get the list of meetings from a server's getMeetings response
 
-        :param server: server to get meetings from
+        :param response: the server's getMeetings response
         :return: list of meetings (meetings are dicts)
         """
-        if not server.enabled:
-            return []
-
-        response = send_api_request(server, "getMeetings")
-
         if "messageKey" in response and response["messageKey"] == "noMeetings":
             return []  # No meetings
 
@@ -214,30 +305,80 @@ class GetMeetings(_GetView):
         else:
             return list(meetings_data)  # Multiple meetings
 
+    @classmethod
+    def from_servers(cls, servers, fields: Sequence[str] = None,
+                     relay: bool = False) -> Tuple[Dict[BBBServer, list], List[BBBServer]]:
+        """
+        Get all meetings on several servers concurrently
+
+        Disabled servers are skipped and servers which don't answer in time are reported as missing.
+
+        :param servers: servers to get meetings from
+        :param fields: only parse these attributes of each meeting (meetings will be plain dicts)
+        :param relay: don't parse the meetings at all and return their raw xml strings instead
+        :return: dict mapping each answering server to its meetings and a list of the missing servers
+        """
+        if relay:
+            parser_factory = ItemsRelayParser
+        elif fields is not None:
+            parser_factory = partial(ItemsParser, fields)
+        else:
+            parser_factory = None
+
+        servers = list(servers)
+        responses, missing = send_api_requests([server for server in servers if server.enabled], "getMeetings",
+                                               parser_factory=parser_factory)
+
+        meetings = {}
+        for server in servers:
+            if not server.enabled:
+                meetings[server] = []
+            elif server in responses:
+                meetings[server] = cls.meetings_from_response(responses[server])
+        return meetings, missing
+
+    @staticmethod
+    def missing_servers(missing: List[BBBServer]) -> dict:
+        """
+        Build the response data reporting servers which didn't answer
+
+        :param missing: servers which didn't answer
+        :return: data to add to the response (empty if no server is missing)
+        """
+        if not missing:
+            return {}
+        logger.info(f"Missing servers: {', '.join(str(server.server_id) for server in missing)}")
+        return {"missingServers": {"serverID": [str(server.server_id) for server in missing]}}
+
     def process(self, parameters: dict, request: HttpRequest):
+        relay = config.upstream.relay_meetings
+        meetings_per_server, missing = self.from_servers(BBBServer.objects.order_by("server_id"), relay=relay)
         meetings = []
-        for server in BBBServer.objects.all():
-            meetings += self.from_server(server)
+        for server_meetings in meetings_per_server.values():
+            meetings += server_meetings
 
         if len(meetings) == 0:
             return respond(
                 True, "noMeetings",
-                "no meetings were found on this server"
+                "no meetings were found on this server",
+                data=self.missing_servers(missing)
             )
+        elif relay:
+            # Pass the servers' xml on without rebuilding it
+            return respond(True, data={"meetings": RawXMLString("".join(meetings)), **self.missing_servers(missing)})
         else:
-            return respond(True, data={"meetings": {"meeting": meetings}})
+            return respond(True, data={"meetings": {"meeting": meetings}, **self.missing_servers(missing)})
 
 
-class GetRecordings(_GetView):
+class GetRecordings(_AsyncGetView):
 
-    def process(self, parameters: dict, request: HttpRequest):
+    async def process(self, parameters: dict, request: HttpRequest):
         recordings = []
         if "recordID" in parameters:
             recordings = list(map(str.strip, parameters["recordID"].split(",")))
         elif "meetingID" in parameters:
             for meeting_id in map(str.strip, parameters["meetingID"].split(",")):
-                for meeting in Meeting.objects.filter(meeting_id=meeting_id):
-                    recordings.append(meeting.internal_id)
+                recordings.extend(await sync_to_async(archive.get_internal_ids)(meeting_id))
 
         # Forward request to player
         url = os.path.join(settings.config.player.api_url, "getRecordings")
@@ -245,7 +386,7 @@ class GetRecordings(_GetView):
             "recordings": recordings
         }
         params["checksum"] = get_checksum(params, settings.config.player.rcp_secret, salt="getRecordings")
-        response = httpx.post(url, json=params, headers={"user-agent": "bbb-loadbalancer"}).text
+        response = (await get_async_client().post(url, json=params)).text
 
         # Wrap player's response
         if not response:
@@ -260,42 +401,75 @@ class GetRecordings(_GetView):
             )
 
 
-class PublishRecordings(_GetView):
-    required_parameters = ["recordID", "publish"]
+class _RecordingsView(_GetView):
+    """Base for the endpoints forwarding a list of record ids to the servers the recordings were made on"""
 
-    def process(self, parameters: dict, request: HttpRequest):
-        # Get a list of meetings to be published for each server
-        meetings_per_server = defaultdict(list)
-        for internal_id in map(str.strip, parameters["recordID"].split(",")):
-            try:
-                meeting = Meeting.objects.get(internal_id=internal_id)
-                meetings_per_server[meeting.server].append(internal_id)
-            except Meeting.DoesNotExist:
-                pass
-
-        # Call publish on every server once with all its meetings
-        responses = []
-        for server, meetings in meetings_per_server.items():
-            if not server.enabled:
+    @staticmethod
+    def send_to_servers(api_call: str, parameters: dict) -> Tuple[bool, dict]:
+        """
+        Send an api call to every server with recordings in the recordID parameter
+
+        The meetings are looked up at once and every server is called once with all its record ids.
+        The servers are called concurrently, a server failing or not answering in time only affects its recordings.
+
+        :param api_call: the api call to send
+        :type api_call: str
+        :param parameters: the request's parameters, all except the recordID are passed on
+        :type parameters: dict
+        :return: whether any recording succeeded and a report of every recording's result to add to the response
+        :rtype: Tuple[bool, dict]
+        """
+        record_ids = list(dict.fromkeys(map(str.strip, parameters["recordID"].split(","))))
+        params = dict((key, value) for key, value in parameters.items() if key != "recordID")
+
+        meetings = archive.get_by_internal_ids(record_ids)
+        results = dict.fromkeys(record_ids, "notFound")
+        record_ids_per_server = defaultdict(list)
+        for record_id in record_ids:
+            meeting = meetings.get(record_id)
+            if meeting is None:
+                continue
+            if not meeting.server.enabled:
+                results[record_id] = "serverDisabled"
                 continue
+            record_ids_per_server[meeting.server].append(record_id)
 
-            responses.append(
-                send_api_request(server, "publishRecordings", {
-                    "recordID": ",".join(meetings),
-                    "publish": parameters["publish"]
-                })
-            )
+        responses, missing = send_api_requests(
+            record_ids_per_server, api_call, params,
+            server_params=dict((server, {"recordID": ",".join(server_record_ids)})
+                               for server, server_record_ids in record_ids_per_server.items())
+        )
+        for server in missing:
+            for record_id in record_ids_per_server[server]:
+                results[record_id] = "noResponse"
+        for server, response in responses.items():
+            if response.get("returncode") == "SUCCESS":
+                result = "SUCCESS"
+            else:
+                result = str(response.get("messageKey") or "FAILED")
+            for record_id in record_ids_per_server[server]:
+                results[record_id] = result
+
+        report = {"recordingResults": {"recording": [
+            {"recordID": record_id, "result": result} for record_id, result in results.items()
+        ]}}
+        return "SUCCESS" in results.values(), report
+
+
+class PublishRecordings(_RecordingsView):
+    required_parameters = ["recordID", "publish"]
+
+    def process(self, parameters: dict, request: HttpRequest):
+        success, report = self.send_to_servers("publishRecordings", parameters)
 
         # If any recording was published successfully just call everything a success (bbb behaviour)
-        for response in responses:
-            if response["returncode"] == "SUCCESS":
-                break
-        else:
+        if not success:
             return respond(
                    False, "notFound",
-                   "We could not find recordings"
+                   "We could not find recordings",
+                   data=report
                )
-        return respond(True, data={"published": parameters["publish"]})
+        return respond(True, data={"published": parameters["publish"], **report})
 
 
 class DeleteRecordings(_GetView):
@@ -308,52 +482,27 @@ class DeleteRecordings(_GetView):
         }
         params["checksum"] = get_checksum(params, settings.config.player.rcp_secret, salt="deleteRecordings")
 
-        response = httpx.post(url, json=params, headers={"user-agent": "bbb-loadbalancer"}).json()
+        response = get_client().post(url, json=params).json()
         if response["success"]:
             return respond(True)
         else:
             return respond(False, "emptyList", response["message"])
 
 
-class UpdateRecordings(_GetView):
+class UpdateRecordings(_RecordingsView):
     required_parameters = ["recordID"]
 
     def process(self, parameters: dict, request: HttpRequest):
-        # Get a parameters dict without the 'recordID'
-        meta_parameters = dict((key, value) for key, value in parameters.items() if key != "recordID")
-
-        # Get a list of meetings to be updated for each server
-        meetings_per_server = defaultdict(list)
-        for internal_id in map(str.strip, parameters["recordID"].split(",")):
-            try:
-                meeting = Meeting.objects.get(internal_id=internal_id)
-                meetings_per_server[meeting.server].append(internal_id)
-            except Meeting.DoesNotExist:
-                pass
-
-        # Call update on every server once with all its meetings
-        responses = []
-        for server, meetings in meetings_per_server.items():
-            if not server.enabled:
-                continue
-
-            responses.append(
-                send_api_request(server, "updateRecordings", {
-                    "recordID": ",".join(meetings),
-                    **meta_parameters,
-                })
-            )
+        success, report = self.send_to_servers("updateRecordings", parameters)
 
         # If any recording was updated successfully just call everything a success (bbb behaviour)
-        for response in responses:
-            if response["returncode"] == "SUCCESS":
-                break
-        else:
+        if not success:
             return respond(
                 False, "notFound",
-                "We could not find recordings"
+                "We could not find recordings",
+                data=report
             )
-        return respond(True, data={"updated": "true"})
+        return respond(True, data={"updated": "true", **report})
 
 
 class GetDefaultConfigXML(_GetView):
@@ -377,6 +526,7 @@ class Move(_GetView):
     def process(self, parameters: dict, request: HttpRequest):
         meeting = self.get_meeting(parameters)
 
+        fallbacks = []
         if "serverID" in parameters:
             try:
                 server = BBBServer.objects.get(server_id=parameters["serverID"])
@@ -386,7 +536,8 @@ class Move(_GetView):
                     "We don't have a server with that server ID"
                 )
         else:
-            server = get_next_server(BBBServer.objects.exclude(id=meeting.server.id))
+            candidates = get_server_candidates(BBBServer.objects.exclude(id=meeting.server.id), load=meeting.load)
+            server, fallbacks = candidates[0], candidates[1:]
 
         if server == meeting.server:
             return respond(False, "sameServer", "Origin and destination server are the same.")
@@ -396,17 +547,15 @@ class Move(_GetView):
             "end", {"meetingID": meeting.meeting_id, "password": meeting.create_query["moderatorPW"]}
         )
         if response["returncode"] == "SUCCESS":
-            meeting.ended = True
-            meeting.save()
+            meeting.mark_ended()
         else:
             return respond(data=response)
 
         # Create meeting
-        new_meeting, response = create_meeting(server, meeting.meeting_id, meeting.create_query)
+        new_meeting, response = create_meeting(server, meeting.meeting_id, meeting.create_query, fallbacks=fallbacks)
         if response["returncode"] == "SUCCESS":
             logger.info(f"SUCCESS: moved from {meeting.server} to {new_meeting.server}")
-            meeting.moved_to = new_meeting
-            meeting.save()
+            meeting.record_move(new_meeting)
 
         return respond(data=response)
 
@@ -416,42 +565,38 @@ class GetStatistics(_GetView):
     meeting_attributes = ["meetingID", "participantCount", "listenerCount", "voiceParticipantCount", "videoCount"]
 
     def process(self, parameters: dict, request: HttpRequest):
+        meetings_per_server, missing = GetMeetings.from_servers(BBBServer.objects.order_by("server_id"),
+                                                                fields=self.meeting_attributes)
         servers = []
-        for server in BBBServer.objects.all():
+        for server, server_meetings in meetings_per_server.items():
             meetings = []
-            for meeting in GetMeetings.from_server(server):
+            for meeting in server_meetings:
                 meetings.append(dict(
-                    (attr, meeting[attr]) for attr in self.meeting_attributes
+                    (attr, meeting.get(attr, "")) for attr in self.meeting_attributes
                 ))
             servers.append({"serverID": server.server_id, "meetings": {"meeting": meetings}})
 
-        return respond(True, data={"servers": {"server": servers}})
+        return respond(True, data={"servers": {"server": servers}, **GetMeetings.missing_servers(missing)})
 
 
 class Rejoin(_GetView):
 
     def process(self, parameters: dict, request: HttpRequest):
         try:
-            meeting = Meeting.objects.get(id=parameters["meetingID"])
+            # Resolved in a single step and cached, since all participants of a moved meeting arrive at once
+            destination = archive.get_destination(int(parameters["meetingID"]))
+            server = None if destination.server_id is None else directory.get_server(destination.server_id)
         except KeyError:
             return respond(False, "missingParamMeetingID", "You must specify a meeting ID for the meeting.")
-        except Meeting.DoesNotExist:
-            return respond(
+        except (ValueError, Meeting.DoesNotExist, BBBServer.DoesNotExist):
+            return prerendered(
                 False, "notFound",
                 "We could not find a meeting with that meeting ID - perhaps the meeting is not yet running?"
             )
 
-        if meeting.moved_to is None:
-            if "logoutURL" in meeting.create_query:
-                return HttpResponseRedirect(meeting.create_query["logoutURL"])
-            else:
-                return HttpResponseRedirect(config.logoutURL)
+        if server is None:
+            return HttpResponseRedirect(destination.logout_url)
         else:
-            # Follow moved_to links
-            new_meeting = meeting.moved_to
-            while new_meeting.moved_to is not None:
-                new_meeting = new_meeting.moved_to
-
             # Get parameters from last join
             cookie = request.COOKIES.get("bbb_join")
             if cookie is None:
@@ -463,6 +608,6 @@ class Rejoin(_GetView):
             checksum = parameters["checksum"]
             del parameters["checksum"]
             if validate_checksum(parameters, checksum, Loadbalancer.secret, salt="rejoin", use_time_component=False):
-                return HttpResponseRedirect(build_api_url(new_meeting.server, "join", parameters))
+                return HttpResponseRedirect(build_api_url(server, "join", parameters))
             else:
-                return respond(False, "checksumError", "You did not pass the checksum security check")
+                return prerendered(False, "checksumError", "You did not pass the checksum security check")
@@ -0,0 +1,130 @@
+"""
+Incremental parsers for list responses of bigbluebutton's api (like getMeetings)
+
+jxmlease builds a complete tree of every response. For list responses most of that tree
+(attendees, metadata, ...) is thrown away again. These parsers are fed the response in chunks
+and only keep what is asked for.
+
+Both parsers produce a dict shaped like the one jxmlease would return for <response>,
+but only containing the response's top level text elements and the container with its items:
+{"returncode": "SUCCESS", "meetings": {"meeting": [...]}}
+"""
+from xml.parsers.expat import ParserCreate
+from typing import Sequence
+
+
+class ItemsParser:
+    """
+    Collect only the requested fields of each item
+
+    The items are dicts mapping the field names to their text.
+    Any other child of an item is skipped including its whole subtree.
+    """
+
+    def __init__(self, fields: Sequence[str], container: str = "meetings", item: str = "meeting"):
+        self.fields = frozenset(fields)
+        self.container = container
+        self.item = item
+
+        self.response = {}
+        self.items = []
+
+        self._parser = ParserCreate()
+        self._parser.buffer_text = True
+        self._parser.StartElementHandler = self._start
+        self._parser.EndElementHandler = self._end
+        self._parser.CharacterDataHandler = self._text
+
+        self._path = []
+        self._current_item = None
+        self._text_parts = None
+
+    def _start(self, tag, attributes):
+        self._path.append(tag)
+        depth = len(self._path)
+
+        # <response><tag> or <response><container><item><tag>
+        if depth == 2 or (depth == 4 and self._current_item is not None and tag in self.fields):
+            self._text_parts = []
+        elif depth == 3 and tag == self.item and self._path[1] == self.container:
+            self._current_item = {}
+            self._text_parts = None
+        else:
+            self._text_parts = None
+
+    def _end(self, tag):
+        depth = len(self._path)
+        if depth == 2 and self._text_parts is not None:
+            self.response[tag] = "".join(self._text_parts).strip()
+        elif depth == 4 and self._text_parts is not None:
+            self._current_item[tag] = "".join(self._text_parts)
+        elif depth == 3 and self._current_item is not None:
+            self.items.append(self._current_item)
+            self._current_item = None
+
+        self._text_parts = None
+        self._path.pop()
+
+    def _text(self, data):
+        if self._text_parts is not None:
+            self._text_parts.append(data)
+
+    def feed(self, data: bytes):
+        """
+        Parse the next chunk of the response
+
+        :param data: next chunk
+        :type data: bytes
+        :raises xml.parsers.expat.ExpatError: if the response is not well formed
+        """
+        self._parser.Parse(data, False)
+
+    def close(self) -> dict:
+        """
+        Finish parsing
+
+        :return: the response's top level text elements and the container with the parsed items
+        :rtype: dict
+        :raises xml.parsers.expat.ExpatError: if the response is not well formed
+        """
+        self._parser.Parse(b"", True)
+        if self.container in self.response or self.items:
+            self.response[self.container] = {self.item: self.items}
+        return self.response
+
+
+class ItemsRelayParser(ItemsParser):
+    """
+    Collect each item as its raw xml without parsing its content
+
+    The items are the unmodified xml fragments of the response, so they can be passed on as they are.
+    """
+
+    def __init__(self, container: str = "meetings", item: str = "meeting"):
+        super().__init__((), container, item)
+        self._buffer = bytearray()
+        self._item_start = None
+        self._item_started = False
+
+    def _start(self, tag, attributes):
+        super()._start(tag, attributes)
+        self._item_started = False
+        if self._current_item is not None and len(self._path) == 3:
+            self._item_start = self._parser.CurrentByteIndex
+            self._item_started = True
+
+    def _end(self, tag):
+        if len(self._path) == 3 and self._current_item is not None:
+            index = self._parser.CurrentByteIndex
+            # Expat points behind an empty element and at the end tag of any other
+            if self._item_started and self._buffer[index - 2:index] == b"/>":
+                end = index
+            else:
+                end = self._buffer.index(b">", index) + 1
+            self._current_item = bytes(self._buffer[self._item_start:end]).decode("utf-8")
+        self._item_started = False
+        super()._end(tag)
+
+    def feed(self, data: bytes):
+        self._buffer += data
+        super().feed(data)
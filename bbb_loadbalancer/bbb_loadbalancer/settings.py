@@ -95,9 +95,32 @@ DATABASES = {
     }
 }
 
+# Cache
+# https://docs.djangoproject.com/en/3.2/topics/cache/
+
+CACHES = {
+    'default': {
+        'BACKEND': config.cache.backend,
+        'LOCATION': config.cache.location,
+    }
+}
+# Memcached passes OPTIONS to its client, only django's own stores are limited in size.
+# A full store drops every cull_frequency-th entry, so max_entries should stay well above the
+# entries in use (about three per running meeting plus a few per server).
+if config.cache.backend.startswith(("django.core.cache.backends.filebased.",
+                                    "django.core.cache.backends.locmem.",
+                                    "django.core.cache.backends.db.")):
+    CACHES['default']['OPTIONS'] = {
+        'MAX_ENTRIES': config.cache.max_entries,
+        'CULL_FREQUENCY': config.cache.cull_frequency,
+    }
+
 # Logging
 # https://docs.djangoproject.com/en/3.2/topics/logging/
 
+# Handlers write in a background thread (see common_files/log.py)
+LOG_JSON = config.log_format == "json"
+
 LOGGING = {
     'version': 1,
     'disable_existing_loggers': False,
@@ -111,25 +134,41 @@ LOGGING = {
             'format': '{message}',
             'style': '{',
         },
+        'json': {
+            '()': 'common_files.log.JsonFormatter',
+        },
     },
     'filters': {
         'require_debug_true': {
             '()': 'django.utils.log.RequireDebugTrue',
         },
+        'sample': {
+            '()': 'common_files.log.SamplingFilter',
+            'rate': config.log_sample_rate,
+        },
     },
     'handlers': {
         'console': {
-            'class': 'logging.StreamHandler',
-            'formatter': 'without_time'
+            'class': 'common_files.log.QueuedHandler',
+            'target_class': 'logging.StreamHandler',
+            'formatter': 'json' if LOG_JSON else 'without_time'
         },
         'loadbalancer': {
-            'class': 'logging.FileHandler',
+            'class': 'common_files.log.QueuedHandler',
+            'target_class': 'logging.FileHandler',
             'filename': os.path.join(config.log_dir, 'loadbalancer.log'),
-            'formatter': 'with_time'
+            'formatter': 'json' if LOG_JSON else 'with_time'
         },
         'django': {
-            'class': 'logging.FileHandler',
+            'class': 'common_files.log.QueuedHandler',
+            'target_class': 'logging.FileHandler',
             'filename': os.path.join(config.log_dir, 'django.log'),
+            'formatter': 'json' if LOG_JSON else 'with_time'
+        },
+        'slow_requests': {
+            'class': 'common_files.log.QueuedHandler',
+            'target_class': 'logging.FileHandler',
+            'filename': os.path.join(config.log_dir, 'slow_requests.log'),
             'formatter': 'with_time'
         }
     },
@@ -139,6 +178,20 @@ LOGGING = {
             'level': 'INFO',
             'propagate': True,
         },
+        # A line per request, only log_sample_rate of them are kept
+        'api.requests': {
+            'level': 'INFO',
+            'filters': ['sample'],
+        },
+        # A line per failed response, all of them are kept
+        'api.responses': {
+            'level': 'INFO',
+        },
+        'api.slow': {
+            'handlers': ['slow_requests'],
+            'level': 'INFO',
+            'propagate': False,
+        },
         'django': {
             'handlers': ['console', 'django'],
             'filter': ['require_debug_true'],
@@ -196,8 +249,15 @@ STATIC_ROOT = '/var/www/static/'
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
+# MySQL doesn't support the partial indexes on Meeting, it uses the composite indexes instead
+SILENCED_SYSTEM_CHECKS = ["models.W037"]
+
 SHARED_SECRET = config.secret
 
 MONITORING = config.monitoring.enabled
 MONITORING_SECRET = config.monitoring.secret
 MONITORING_TIME_DELTA = config.monitoring.time_delta
+MONITORING_METRICS_TOKEN = config.monitoring.metrics_token
+
+if MONITORING:
+    MIDDLEWARE.insert(0, 'monitoring.middleware.metrics_middleware')
@@ -0,0 +1,271 @@
+"""
+Benchmark the functions every api request runs through
+
+Measures the cost per call of checking checksums, building api urls, creating and rendering responses,
+parsing getMeetings responses and choosing the next server. Every benchmark is run in rounds
+of as many calls as fit into --min-time seconds, the fastest round is the result (like timeit).
+
+Usage (from the bbb_loadbalancer directory):
+    python -m benchmarks.hot_path --output before.json
+    python -m benchmarks.hot_path --compare before.json
+
+The benchmarks use an in-memory sqlite database and cache (see benchmarks/settings.py),
+so results are comparable between commits on the same machine.
+With --compare the run exits with an error if a benchmark got slower than --tolerance allows.
+"""
+import os
+import django
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'benchmarks.settings')
+django.setup()
+
+import argparse
+import fnmatch
+import json
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import time
+from typing import Callable, Dict
+
+from django.db import connection
+from django.test import RequestFactory
+from jxmlease import parse
+
+from api.bbb_api import build_api_url
+from api.logic import get_next_server, Loadbalancer
+from api.response import render_xml, respond
+from api.views import _GetView, _checksum_algos, _checksum_regex
+from bbb_loadbalancer import settings
+from common_files.models import BBBServer, Meeting
+
+
+def seed(servers: int, meetings: int):
+    """
+    Fill the database with servers and running meetings spread over them
+
+    :param servers: number of servers
+    :param meetings: number of running meetings
+    """
+    BBBServer.objects.bulk_create([
+        BBBServer(server_id=i, url=f"https://bbb{i}.example.org/bigbluebutton/", secret="secret",
+                  capacity=random.choice((1, 1, 2)), participants=random.randrange(500),
+                  video_streams=random.randrange(100), cpu_load=random.random())
+        for i in range(servers)
+    ])
+    # bulk_create doesn't set the primary keys on every database
+    server_objects = list(BBBServer.objects.all())
+    Meeting.objects.bulk_create([
+        Meeting(meeting_id=f"room-{i}", internal_id=f"{i:040x}-{i}", server=server_objects[i % servers],
+                load=random.choice((1, 1, 1, 2, 5)))
+        for i in range(meetings)
+    ])
+    BBBServer.reconcile_running_load()
+
+
+def get_meetings_xml(meetings: int, attendees: int) -> bytes:
+    """
+    Build a getMeetings response like a bbb server sends it
+
+    :param meetings: number of meetings in the response
+    :param attendees: number of attendees per meeting
+    """
+    parts = ["<response><returncode>SUCCESS</returncode><meetings>"]
+    for i in range(meetings):
+        parts.append(
+            f"<meeting><meetingName>Room {i}</meetingName><meetingID>room-{i}</meetingID>"
+            f"<internalMeetingID>{i:040x}-1700000000000</internalMeetingID><createTime>1700000000000</createTime>"
+            f"<createDate>Tue Nov 14 22:13:20 UTC 2023</createDate><voiceBridge>7{i:04d}</voiceBridge>"
+            f"<dialNumber>613-555-1234</dialNumber><attendeePW>ap</attendeePW><moderatorPW>mp</moderatorPW>"
+            f"<running>true</running><duration>0</duration><hasUserJoined>true</hasUserJoined>"
+            f"<recording>false</recording><hasBeenForciblyEnded>false</hasBeenForciblyEnded>"
+            f"<startTime>1700000000100</startTime><endTime>0</endTime>"
+            f"<participantCount>{attendees}</participantCount><listenerCount>{attendees // 2}</listenerCount>"
+            f"<voiceParticipantCount>{attendees // 4}</voiceParticipantCount>"
+            f"<videoCount>{attendees // 4}</videoCount><maxUsers>0</maxUsers><moderatorCount>1</moderatorCount>"
+            f"<attendees>"
+        )
+        for j in range(attendees):
+            parts.append(
+                f"<attendee><userID>w_{i}_{j}</userID><fullName>User {j}</fullName>"
+                f"<role>{'MODERATOR' if j == 0 else 'VIEWER'}</role><isPresenter>{str(j == 0).lower()}</isPresenter>"
+                f"<isListeningOnly>{str(j % 2 == 0).lower()}</isListeningOnly><hasJoinedVoice>false</hasJoinedVoice>"
+                f"<hasVideo>{str(j % 4 == 0).lower()}</hasVideo><clientType>HTML5</clientType></attendee>"
+            )
+        parts.append("</attendees><metadata><bbb-origin>Greenlight</bbb-origin></metadata>"
+                     "<isBreakout>false</isBreakout></meeting>")
+    parts.append("</meetings></response>")
+    return "".join(parts).encode("utf-8")
+
+
+def benchmarks(servers: int, meetings: int) -> Dict[str, Callable[[], object]]:
+    """
+    Build the benchmarked calls
+
+    :return: dict mapping a name to a function without arguments running the code to measure once
+    """
+    factory = RequestFactory()
+    view = _GetView()
+
+    def signed_request(call: str, params: str, hash_algo) -> object:
+        checksum = hash_algo(call + params + settings.SHARED_SECRET)
+        return factory.get(f"/bigbluebutton/api/{call}?{params}&checksum={checksum}")
+
+    join_parameters = "fullName=Jane+Doe&meetingID=room-1&role=VIEWER&redirect=true&userID=user-42"
+    # sha1 matches on the first try, sha256 only after sha1 failed
+    sha1_request = signed_request("join", join_parameters, _checksum_algos[0])
+    sha256_request = signed_request("join", join_parameters, _checksum_algos[1])
+    query_string = sha256_request.META["QUERY_STRING"]
+
+    def check_checksum(request):
+        # Parse the query string again, like for every new request
+        request.__dict__.pop("GET", None)
+        return view.get_parameters(request)
+
+    create_parameters = {"meetingID": "room-1", "name": "Room 1", "attendeePW": "ap", "moderatorPW": "mp",
+                         "record": True, "autoStartRecording": False, "meta_bbb-origin": "Greenlight",
+                         "welcome": "Welcome to <b>%%CONFNAME%%</b>!", "maxParticipants": 100}
+    server = BBBServer(server_id=0, url="https://bbb0.example.org/bigbluebutton/", secret="secret")
+
+    create_response = {"meetingID": "room-1", "internalMeetingID": f"{1:040x}-1700000000000",
+                       "parentMeetingID": "bbb-none", "attendeePW": "ap", "moderatorPW": "mp",
+                       "createTime": "1700000000000", "voiceBridge": "70001", "dialNumber": "613-555-1234",
+                       "createDate": "Tue Nov 14 22:13:20 UTC 2023", "hasUserJoined": "false", "duration": "0",
+                       "hasBeenForciblyEnded": "false"}
+
+    small_payload = get_meetings_xml(10, 5)
+    large_payload = get_meetings_xml(100, 20)
+    parsed_meetings = parse(large_payload)["response"]["meetings"]["meeting"]
+
+    return {
+        "checksum_sha1": lambda: check_checksum(sha1_request),
+        "checksum_sha256": lambda: check_checksum(sha256_request),
+        "checksum_regex": lambda: _checksum_regex.sub("", query_string),
+        "build_api_url": lambda: build_api_url(server, "create", dict(create_parameters)),
+        "build_api_url_loadbalancer": lambda: build_api_url(Loadbalancer, "join", {"meetingID": "room-1",
+                                                                                    "fullName": "Jane Doe"}),
+        "respond_failed": lambda: render_xml(respond(False, "notFound", "We could not find a meeting with that ID")),
+        "respond_create": lambda: render_xml(respond(True, data=create_response)),
+        "respond_get_meetings_100": lambda: render_xml(respond(True, data={"meetings": {"meeting": parsed_meetings}})),
+        "parse_get_meetings_10": lambda: parse(small_payload),
+        "parse_get_meetings_100": lambda: parse(large_payload),
+        f"get_next_server_{servers}_{meetings}": get_next_server,
+    }
+
+
+def measure(function: Callable[[], object], rounds: int, min_time: float) -> dict:
+    """
+    Time a function
+
+    :param function: function to call
+    :param rounds: number of rounds
+    :param min_time: minimum seconds per round, determines the calls per round
+    :return: dict with the fastest and median time per call in microseconds and the calls per round
+    """
+    # Find the number of calls filling min_time (like timeit.Timer.autorange)
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            function()
+        if time.perf_counter() - start >= min_time:
+            break
+        number *= 2
+
+    timings = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        for _ in range(number):
+            function()
+        timings.append((time.perf_counter() - start) / number * 1e6)
+    return {
+        "min_us": round(min(timings), 3),
+        "median_us": round(statistics.median(timings), 3),
+        "calls": number,
+    }
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> bool:
+    """
+    Print the change of every benchmark against a previous run
+
+    :param results: benchmarks of this run
+    :param baseline: benchmarks of the previous run
+    :param tolerance: allowed slowdown as fraction, e.g. 0.1 for 10%
+    :return: whether no benchmark got slower than allowed
+    """
+    success = True
+    print(f"{'benchmark':<32}{'before us':>12}{'after us':>12}{'change':>9}")
+    for name, result in results.items():
+        if name not in baseline:
+            print(f"{name:<32}{'-':>12}{result['min_us']:>12}{'new':>9}")
+            continue
+        before = baseline[name]["min_us"]
+        change = result["min_us"] / before - 1 if before else 0
+        regression = change > tolerance
+        success = success and not regression
+        print(f"{name:<32}{before:>12}{result['min_us']:>12}{change:>+9.1%}{'  REGRESSION' if regression else ''}")
+    return success
+
+
+def _commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the functions on every api request's path")
+    parser.add_argument("--servers", type=int, default=30, help="number of servers to seed")
+    parser.add_argument("--meetings", type=int, default=2000, help="number of running meetings to seed")
+    parser.add_argument("--rounds", type=int, default=5, help="how often each benchmark is run")
+    parser.add_argument("--min-time", type=float, default=0.2, help="minimum seconds per round")
+    parser.add_argument("--filter", default="*", help="only run the benchmarks matching this pattern")
+    parser.add_argument("--output", help="write the results as json to this file")
+    parser.add_argument("--json", action="store_true", help="print the results as json")
+    parser.add_argument("--compare", help="compare the results with the json file of a previous run")
+    parser.add_argument("--tolerance", type=float, default=0.1,
+                        help="slowdown (as fraction) tolerated by --compare before reporting a regression")
+    args = parser.parse_args()
+
+    random.seed(0)
+    connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    try:
+        seed(args.servers, args.meetings)
+        results = {}
+        for name, function in benchmarks(args.servers, args.meetings).items():
+            if fnmatch.fnmatch(name, args.filter):
+                results[name] = measure(function, args.rounds, args.min_time)
+                if not args.json:
+                    print(f"{name}: {results[name]['min_us']}us (median {results[name]['median_us']}us)",
+                          file=sys.stderr)
+    finally:
+        connection.creation.destroy_test_db(connection.settings_dict["NAME"], verbosity=0)
+
+    report = {
+        "commit": _commit(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "servers": args.servers,
+        "meetings": args.meetings,
+        "benchmarks": results,
+    }
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+    if args.json:
+        print(json.dumps(report, indent=2))
+
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)
+        print(f"Comparing {report['commit'] or 'this run'} with {baseline.get('commit') or args.compare}")
+        sys.exit(0 if compare(results, baseline["benchmarks"], args.tolerance) else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+"""
+Benchmark the hot queries on the Meeting table
+
+Seeds a test database with lots of historical meetings, prints the query plan of every hot query,
+checks that it uses an index and measures its latency.
+
+Usage (from the bbb_loadbalancer directory):
+    python -m benchmarks.queries --meetings 2000000
+
+The test database is created next to the configured one (like django's test runner does),
+so the database user needs the permission to create databases.
+"""
+import os
+import django
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'bbb_loadbalancer.settings')
+django.setup()
+
+import argparse
+import json
+import random
+import statistics
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+
+from django.db import connection
+from django.db.models import Sum
+
+from common_files.models import BBBServer, Meeting
+
+
+# Strings identifying an index access in the query plans of sqlite, postgresql and mysql
+INDEX_MARKERS = ("USING INDEX", "USING COVERING INDEX", "USING INTEGER PRIMARY KEY",
+                 "Index Scan", "Index Only Scan", "Bitmap Index Scan", "_idx")
+
+
+def seed(meetings: int, running: int, servers: int, batch_size: int = 10000):
+    """
+    Fill the database with servers, historical meetings and some running ones
+
+    :param meetings: total number of meetings
+    :param running: number of them which are still running
+    :param servers: number of servers
+    :param batch_size: number of meetings to insert at once
+    """
+    server_objects = [BBBServer.objects.create(server_id=i, url=f"https://bbb{i}.example.org/bigbluebutton/")
+                      for i in range(servers)]
+
+    now = datetime.now(tz=timezone.utc)
+    start = time.perf_counter()
+    for offset in range(0, meetings, batch_size):
+        batch = []
+        for i in range(offset, min(offset + batch_size, meetings)):
+            is_running = i >= meetings - running
+            batch.append(Meeting(
+                # Rooms are reused, so most meeting ids appear several times
+                meeting_id=f"room-{i % (meetings // 5 + 1)}",
+                internal_id=f"{i:040x}-{i}",
+                server=server_objects[i % servers],
+                ended=not is_running,
+                load=1,
+            ))
+        Meeting.objects.bulk_create(batch)
+        print(f"\rSeeded {min(offset + batch_size, meetings)}/{meetings} meetings", end="", file=sys.stderr)
+    print(f" in {time.perf_counter() - start:.1f}s", file=sys.stderr)
+
+    # Spread the creation times over the last year (auto_now_add set them all to now)
+    Meeting.objects.filter(ended=True).update(created=now - timedelta(days=365))
+    BBBServer.reconcile_running_load()
+
+
+def hot_queries(meetings: int, running: int, servers: int) -> dict:
+    """
+    Build the hot queries with random but existing parameters
+
+    :return: dict mapping a name to a function returning the queryset
+    """
+    def running_meeting_id():
+        return f"room-{random.randrange(meetings - running, meetings) % (meetings // 5 + 1)}"
+
+    def internal_id():
+        i = random.randrange(meetings)
+        return f"{i:040x}-{i}"
+
+    return {
+        # _GetView.get_meeting, directory.lookup, create_meeting
+        "running_by_meeting_id": lambda: Meeting.running.filter(meeting_id=running_meeting_id()),
+        # GetRecordings by meeting id
+        "all_by_meeting_id": lambda: Meeting.objects.filter(meeting_id=running_meeting_id()),
+        # PublishRecordings, UpdateRecordings
+        "by_internal_ids": lambda: Meeting.objects.filter(internal_id__in=[internal_id() for _ in range(20)]),
+        # set_state on panic, the poller's db.get_running_meetings
+        "running_by_server": lambda: Meeting.running.filter(server__server_id=random.randrange(servers)),
+        # BBBServer.reconcile_running_load
+        "running_load_per_server": lambda: Meeting.running.values("server").annotate(total=Sum("load")),
+        # get_next_server
+        "next_server": lambda: BBBServer.objects.filter(state=BBBServer.ENABLED, unreachable=0)
+                                                .order_by("running_load"),
+    }
+
+
+def measure(make_queryset, repeat: int) -> dict:
+    """
+    Time a query
+
+    :return: dict with the median, 95th percentile and maximum in milliseconds
+    """
+    timings = []
+    for _ in range(repeat):
+        queryset = make_queryset()
+        start = time.perf_counter()
+        list(queryset)
+        timings.append((time.perf_counter() - start) * 1000)
+    timings.sort()
+    return {
+        "p50_ms": round(statistics.median(timings), 3),
+        "p95_ms": round(timings[int(0.95 * (len(timings) - 1))], 3),
+        "max_ms": round(timings[-1], 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the hot queries on the Meeting table")
+    parser.add_argument("--meetings", type=int, default=1000000, help="number of meetings to seed")
+    parser.add_argument("--running", type=int, default=2000, help="number of seeded meetings still running")
+    parser.add_argument("--servers", type=int, default=30, help="number of servers to seed")
+    parser.add_argument("--repeat", type=int, default=200, help="how often each query is run")
+    parser.add_argument("--keepdb", action="store_true", help="reuse the seeded test database of a previous run")
+    parser.add_argument("--json", action="store_true", help="print the results as json")
+    args = parser.parse_args()
+
+    connection.creation.create_test_db(verbosity=0, autoclobber=True, keepdb=args.keepdb)
+    try:
+        if not Meeting.objects.exists():
+            seed(args.meetings, args.running, args.servers)
+
+        results = {}
+        for name, make_queryset in hot_queries(args.meetings, args.running, args.servers).items():
+            plan = make_queryset().explain()
+            results[name] = {
+                "plan": plan,
+                "uses_index": any(marker in plan for marker in INDEX_MARKERS),
+                **measure(make_queryset, args.repeat),
+            }
+    finally:
+        if not args.keepdb:
+            connection.creation.destroy_test_db(connection.settings_dict["NAME"], verbosity=0)
+
+    if args.json:
+        print(json.dumps({"vendor": connection.vendor, "meetings": args.meetings, "queries": results}, indent=2))
+    else:
+        for name, result in results.items():
+            print(f"{name}: p50 {result['p50_ms']}ms, p95 {result['p95_ms']}ms, max {result['max_ms']}ms"
+                  f"{'' if result['uses_index'] else ' (NO INDEX USED)'}")
+            for line in result["plan"].splitlines():
+                print(f"\t{line}")
+
+    # Fail if any hot query scans the whole table
+    sys.exit(0 if all(result["uses_index"] for result in results.values()) else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,25 @@
+"""
+Settings for the microbenchmarks and the placement simulator
+
+Runs on an in-memory sqlite database and cache, so the results only depend on the code and the machine
+and not on the configured database, cache or log files.
+"""
+from bbb_loadbalancer.settings import *  # noqa: F401,F403
+
+DATABASES = {
+    "default": {
+        "ENGINE": "django.db.backends.sqlite3",
+        "NAME": ":memory:",
+    }
+}
+
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+    }
+}
+
+LOGGING = {
+    "version": 1,
+    "disable_existing_loggers": False,
+}
@@ -6,6 +6,7 @@ django.setup()
 
 import argparse
 
+from common_files.archive import archive_ended_meetings
 from common_files.config import LoadBalancerConfig
 from common_files.models import BBBServer
 
@@ -22,6 +23,8 @@ add = subparsers.add_parser("add", description="Add a server")
 add.add_argument('--server-id', type=int, help="A unique id to identify the server in requests")
 add.add_argument('--url', type=bbb_url, help="The bigbluebutton server's url")
 add.add_argument('--secret', type=str, help="The bigbluebutton server's shared secret")
+add.add_argument('--capacity', type=float, default=1, help="The server's size relative to the other servers "
+                                                          "(defaults to 1)")
 def handle_add():
     if BBBServer.objects.filter(server_id=args.server_id).exists():
         parser.error("A server with this id exists already")
@@ -65,7 +68,8 @@ def handle_add():
         BBBServer.objects.create(
             server_id=args.server_id,
             url=args.url,
-            secret=args.secret
+            secret=args.secret,
+            capacity=args.capacity,
         )
     else:
         print("Failed to establish a ssh connection")
@@ -89,15 +93,34 @@ edit.add_argument('--state', type=state, help="The server's state: ENABLED, DISA
                                               "(only the first character will be looked at; also accepts lower case)")
 edit.add_argument('--secret', type=str, help="The new secret for the server")
 edit.add_argument('--url', type=str, help="The new url for the server")
+edit.add_argument('--capacity', type=float, help="The server's size relative to the other servers")
+edit.add_argument('--connect-timeout', type=float, help="Seconds to wait for a connection to the server "
+                                                       "(0 to use the configured default)")
+edit.add_argument('--read-timeout', type=float, help="Seconds to wait for the server's response "
+                                                    "(0 to use the configured default)")
 def handle_edit():
     # TODO
     if args.state:
         set_state(args.server, args.state)
+    # Only save the edited fields, the server's running_load is kept up to date by the database
+    fields = []
     if args.secret:
         args.server.secret = args.secret
+        fields.append("secret")
     if args.url:
         args.server.url = args.url
-    args.server.save()
+        fields.append("url")
+    if args.capacity is not None:
+        args.server.capacity = args.capacity
+        fields.append("capacity")
+    if args.connect_timeout is not None:
+        args.server.connect_timeout = args.connect_timeout or None
+        fields.append("connect_timeout")
+    if args.read_timeout is not None:
+        args.server.read_timeout = args.read_timeout or None
+        fields.append("read_timeout")
+    if fields:
+        args.server.save(update_fields=fields)
 
 
 subparsers.add_parser("list", description="List all server")
@@ -107,6 +130,13 @@ def handle_list():
         print(f"\tsecret: {server.secret}")
         print(f"\tstate: {server.state}")
         print("\t" + "NOT REACHABLE" if server.unreachable else "REACHABLE")
+        print(f"\trunning load: {server.running_load}")
+        print(f"\tcapacity: {server.capacity}")
+        if server.usage_updated is not None:
+            print(f"\tusage: {server.participants} participants, {server.video_streams} videos, "
+                  f"cpu {server.cpu_load if server.cpu_load is not None else 'unknown'}%")
+        if server.connect_timeout is not None or server.read_timeout is not None:
+            print(f"\ttimeouts: connect {server.connect_timeout or 'default'}, read {server.read_timeout or 'default'}")
 
 
 panic = subparsers.add_parser("panic", description="Set a server to panic. "
@@ -147,6 +177,25 @@ def handle_enable():
     set_state(args.server, BBBServer.ENABLED)
 
 
+subparsers.add_parser("reconcile", description="Recalculate every server's running load from its running meetings. "
+                      "The poller does this every cycle, so this is only needed if it isn't running.")
+def handle_reconcile():
+    drift = BBBServer.reconcile_running_load()
+    if not drift:
+        print("All running loads are correct")
+    for server_id, amount in drift.items():
+        print(f"#{server_id}: running load was off by {amount}, repaired")
+
+
+archive = subparsers.add_parser("archive", description="Move old ended meetings into the archive. "
+                                "The poller does this every archive.interval seconds if archive.enabled is set.")
+archive.add_argument("--age", type=float, default=None,
+                     help="archive ended meetings created more than this many days ago (defaults to archive.age)")
+def handle_archive():
+    count = archive_ended_meetings(age=args.age)
+    print(f"Archived {count} meetings")
+
+
 if __name__ == "__main__":
     args = parser.parse_args()
     if args.command is None:
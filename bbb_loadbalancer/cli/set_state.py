@@ -1,12 +1,12 @@
 import sys
 from api.bbb_api import send_api_request
-from api.logic import get_next_server, create_meeting
+from api.logic import get_server_candidates, create_meeting
 from common_files.models import BBBServer, Meeting
 
 
 def set_state(server: BBBServer, state: str):
     server.state = state
-    server.save()
+    server.save(update_fields=["state"])
 
     # Move away all meetings on panic
     if state == BBBServer.PANIC:
@@ -19,15 +19,14 @@ def set_state(server: BBBServer, state: str):
             except:
                 pass
             finally:
-                meeting.ended = True
-                meeting.save()
+                meeting.mark_ended()
 
             # Reopen the meeting on a new server
-            new_server = get_next_server()
-            new_meeting, response = create_meeting(new_server, meeting.meeting_id, meeting.create_query)
+            candidates = get_server_candidates(load=meeting.load)
+            new_meeting, response = create_meeting(candidates[0], meeting.meeting_id, meeting.create_query,
+                                                   fallbacks=candidates[1:])
             if response["returncode"] == "SUCCESS":
-                print(f"Reopened '{meeting.meeting_id}' on #{new_server.server_id}", file=sys.stdout)
-                meeting.moved_to = new_meeting
-                meeting.save()
+                print(f"Reopened '{meeting.meeting_id}' on #{new_meeting.server.server_id}", file=sys.stdout)
+                meeting.record_move(new_meeting)
             else:
                 print(f"Couldn't reopen '{meeting.meeting_id}': {response['message']}", file=sys.stderr)
@@ -0,0 +1,215 @@
+"""
+Archive of ended meetings
+
+Ended meetings are only needed for their recordings and for redirecting users of moved meetings.
+To keep the Meeting table (and every query on it) small, meetings which ended and were created
+more than archive.age days ago are moved into the ArchivedMeeting table.
+
+Everything looking up meetings which might have ended should use the functions of this module,
+which check both tables.
+"""
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Iterable, List, Union
+
+from django.db import transaction
+from django.db.models import Max, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+from common_files import directory
+from common_files.config import LoadBalancerConfig
+from common_files.models import ArchivedMeeting, Meeting
+
+
+config = LoadBalancerConfig.from_json("../config.json")
+
+AnyMeeting = Union[Meeting, ArchivedMeeting]
+
+_FIELDS = ("id", "meeting_id", "internal_id", "server_id", "load", "create_query", "created", "moved_to_id",
+           "final_destination_id")
+
+
+def archive_ended_meetings(age: float = None, batch_size: int = None, max_batches: int = None) -> int:
+    """
+    Move old ended meetings from the Meeting table into the ArchivedMeeting table
+
+    :param age: days since their creation after which ended meetings are archived (defaults to archive.age)
+    :type age: float
+    :param batch_size: number of meetings moved per transaction (defaults to archive.batch_size)
+    :type batch_size: int
+    :param max_batches: stop after this many transactions even if there are more meetings to archive (None for no limit)
+    :type max_batches: int
+    :return: number of archived meetings
+    :rtype: int
+    """
+    if age is None:
+        age = config.archive.age
+    if batch_size is None:
+        batch_size = config.archive.batch_size
+    created_before = datetime.now(tz=timezone.utc) - timedelta(days=age)
+
+    # MySQL (before 8.0) resets its auto increment to the highest existing id on restart,
+    # so the newest meeting stays to prevent ids from being reused
+    newest = Meeting.objects.aggregate(newest=Max("id"))["newest"]
+
+    archived = 0
+    batches = 0
+    while max_batches is None or batches < max_batches:
+        batches += 1
+        with transaction.atomic():
+            ids = set(Meeting.objects
+                      .filter(ended=True, created__lt=created_before)
+                      .exclude(id=newest)
+                      .order_by("id")
+                      .values_list("id", flat=True)[:batch_size])
+            if not ids:
+                break
+
+            # Deleting a meeting would cascade to the meetings moved to it, so they have to be archived as well
+            while True:
+                referencing = set(Meeting.objects
+                                  .filter(moved_to__in=ids)
+                                  .exclude(id__in=ids)
+                                  .values_list("id", flat=True))
+                if not referencing:
+                    break
+                ids |= referencing
+
+            ArchivedMeeting.objects.bulk_create(
+                ArchivedMeeting(**dict(zip(_FIELDS, values)))
+                for values in Meeting.objects.filter(id__in=ids).values_list(*_FIELDS)
+            )
+            Meeting.objects.filter(id__in=ids).delete()
+
+        archived += len(ids)
+
+    return archived
+
+
+def get_meeting(pk: int) -> AnyMeeting:
+    """
+    Get a meeting by its primary key from either table
+
+    :param pk: the meeting's primary key
+    :type pk: int
+    :return: the meeting
+    :rtype: Union[Meeting, ArchivedMeeting]
+    :raises Meeting.DoesNotExist: if the meeting is in neither table
+    """
+    try:
+        return Meeting.objects.select_related("server").get(id=pk)
+    except Meeting.DoesNotExist:
+        pass
+    try:
+        return ArchivedMeeting.objects.select_related("server").get(id=pk)
+    except ArchivedMeeting.DoesNotExist:
+        raise Meeting.DoesNotExist() from None
+
+
+def follow_moves(meeting: AnyMeeting) -> AnyMeeting:
+    """
+    Get the meeting a meeting ended up in after all its moves
+
+    :param meeting: the meeting to start from
+    :type meeting: Union[Meeting, ArchivedMeeting]
+    :return: the last meeting in the chain of moves (the meeting itself if it wasn't moved)
+    :rtype: Union[Meeting, ArchivedMeeting]
+    :raises Meeting.DoesNotExist: if the final meeting doesn't exist anymore
+    """
+    if meeting.final_destination_id is None:
+        return meeting
+    return get_meeting(meeting.final_destination_id)
+
+
+def _with_destination_server(queryset):
+    # The final destination might be live or archived
+    return queryset.annotate(destination_server_id=Coalesce(
+        Subquery(Meeting.objects.filter(id=OuterRef("final_destination_id")).values("server_id")[:1]),
+        Subquery(ArchivedMeeting.objects.filter(id=OuterRef("final_destination_id")).values("server_id")[:1]),
+    )).values_list("final_destination_id", "destination_server_id", "create_query")
+
+
+def get_destination(pk: int) -> directory.Destination:
+    """
+    Get where to send the participants of a meeting which might have been moved
+
+    The answer is cached in the directory. Uncached meetings cost a single query (two for archived meetings).
+
+    :param pk: the meeting's primary key
+    :type pk: int
+    :return: the server of the meeting's final destination or the logout url if it wasn't moved
+    :rtype: directory.Destination
+    :raises Meeting.DoesNotExist: if the meeting or its final destination doesn't exist
+    """
+    destination = directory.get_destination(pk)
+    if destination is not None:
+        return destination
+
+    row = _with_destination_server(Meeting.objects.filter(id=pk)).first()
+    if row is None:
+        row = _with_destination_server(ArchivedMeeting.objects.filter(id=pk)).first()
+    if row is None:
+        raise Meeting.DoesNotExist()
+
+    final_destination_id, server_id, create_query = row
+    if final_destination_id is None:
+        destination = directory.Destination(None, create_query.get("logoutURL", config.logoutURL))
+    elif server_id is None:
+        raise Meeting.DoesNotExist()
+    else:
+        destination = directory.Destination(server_id, None)
+
+    directory.set_destinations({pk: destination})
+    return destination
+
+
+def get_by_internal_id(internal_id: str) -> AnyMeeting:
+    """
+    Get a meeting by its internal id (the record id of its recordings) from either table
+
+    :param internal_id: the meeting's internal id
+    :type internal_id: str
+    :return: the meeting
+    :rtype: Union[Meeting, ArchivedMeeting]
+    :raises Meeting.DoesNotExist: if the meeting is in neither table
+    """
+    try:
+        return Meeting.objects.select_related("server").get(internal_id=internal_id)
+    except Meeting.DoesNotExist:
+        pass
+    try:
+        return ArchivedMeeting.objects.select_related("server").get(internal_id=internal_id)
+    except ArchivedMeeting.DoesNotExist:
+        raise Meeting.DoesNotExist() from None
+
+
+def get_by_internal_ids(internal_ids: Iterable[str]) -> Dict[str, AnyMeeting]:
+    """
+    Get the meetings for many internal ids at once from either table
+
+    :param internal_ids: the meetings' internal ids
+    :type internal_ids: Iterable[str]
+    :return: dict mapping each found internal id to its meeting (live meetings are preferred over archived ones)
+    :rtype: Dict[str, Union[Meeting, ArchivedMeeting]]
+    """
+    internal_ids = set(internal_ids)
+    meetings = dict((meeting.internal_id, meeting) for meeting in
+                    Meeting.objects.select_related("server").filter(internal_id__in=internal_ids))
+    remaining = internal_ids.difference(meetings)
+    if remaining:
+        meetings.update((meeting.internal_id, meeting) for meeting in
+                        ArchivedMeeting.objects.select_related("server").filter(internal_id__in=remaining))
+    return meetings
+
+
+def get_internal_ids(meeting_id: str) -> List[str]:
+    """
+    Get the internal ids of all meetings ever created with a meeting id
+
+    :param meeting_id: the meeting id used by the api
+    :type meeting_id: str
+    :return: the internal ids from both tables, oldest first
+    :rtype: List[str]
+    """
+    archived = ArchivedMeeting.objects.filter(meeting_id=meeting_id).order_by("id").values_list("internal_id", flat=True)
+    live = Meeting.objects.filter(meeting_id=meeting_id).order_by("id").values_list("internal_id", flat=True)
+    return list(archived) + list(live)
@@ -25,12 +25,84 @@ class LoadBalancerConfig(staticconfig.Config):
         self.player.rcp_secret = "change_me"
 
         self.log_dir = "/var/log/bbb-loadbalancer"
+        self.log_format = "json"
+        self.log_sample_rate = 0.1
 
         self.ssh_user = "root"
         self.hostname = socket.gethostname()
         self.logoutURL = "/"
 
+        self.upstream = staticconfig.Namespace()
+        self.upstream.timeout = 5
+        self.upstream.connect_timeout = 2
+        self.upstream.http2 = True
+        self.upstream.max_connections = 100
+        self.upstream.max_keepalive_connections = 20
+        self.upstream.keepalive_expiry = 30
+        self.upstream.fanout_deadline = 10
+        self.upstream.fanout_workers = 32
+        self.upstream.relay_meetings = False
+
+        self.create = staticconfig.Namespace()
+        self.create.wait = 10
+        self.create.poll_interval = 0.05
+        self.create.result_ttl = 30
+        self.create.failover_attempts = 3
+        self.create.failover_budget = 15
+        self.create.hedge_after = 0
+
+        self.timing = staticconfig.Namespace()
+        self.timing.server_timing = False
+        self.timing.slow_request = 2
+
+        self.health = staticconfig.Namespace()
+        self.health.failure_half_life = 60
+        self.health.max_failure_score = 3
+        self.health.circuit_failures = 5
+        self.health.circuit_open_time = 30
+        self.health.latency_alpha = 0.2
+        self.health.slow_latency = 1.5
+        self.health.max_error_rate = 0.5
+        self.health.report_interval = 1
+
+        self.placement = staticconfig.Namespace()
+        self.placement.strategy = "least_weighted_load"
+        self.placement.participant_weight = 0.1
+        self.placement.video_weight = 0.5
+        self.placement.cpu_limit = 90
+        self.placement.bin_limit = 100
+
+        self.cache = staticconfig.Namespace()
+        self.cache.backend = "django.core.cache.backends.filebased.FileBasedCache"
+        self.cache.location = "/var/cache/bbb-loadbalancer"
+        self.cache.max_entries = 100000
+        self.cache.cull_frequency = 10
+
+        self.directory = staticconfig.Namespace()
+        self.directory.local_ttl = 1
+        self.directory.shared_ttl = 30
+        self.directory.negative_ttl = 2
+        self.directory.server_ttl = 5
+        self.directory.destination_ttl = 600
+
+        self.poller = staticconfig.Namespace()
+        self.poller.interval = 30
+        self.poller.concurrency = 20
+        self.poller.deadline = 25
+        self.poller.jitter = 5
+        self.poller.cpu_timeout = 10
+
+        self.archive = staticconfig.Namespace()
+        self.archive.enabled = True
+        self.archive.age = 30
+        self.archive.interval = 3600
+        self.archive.batch_size = 500
+        self.archive.max_batches = 10
+
         self.monitoring = staticconfig.Namespace()
         self.monitoring.enabled = True
         self.monitoring.secret = "change_me"
         self.monitoring.time_delta = 5
+        self.monitoring.cache_ttl = 5
+        self.monitoring.metrics_token = "change_me"
+        self.monitoring.metrics_dirs = ["/run/bbb-loadbalancer/metrics", "/run/bbb-poller/metrics"]
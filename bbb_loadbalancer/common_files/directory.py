@@ -0,0 +1,193 @@
+"""
+Directory of the running meetings and the servers they run on
+
+It answers the hot lookups (isMeetingRunning, join, getMeetingInfo) without touching the database:
+
+1. Every process keeps the answers it has seen for directory.local_ttl seconds.
+2. All processes (gunicorn workers and the poller) share django's cache.
+3. Only if both miss, the database is asked and the answer is put in both caches.
+
+Every meeting id has a generation in the shared cache and entries are only valid for the generation
+they were read in. Creating or ending a meeting starts a new generation once the transaction commits,
+so an answer read from the database before that and written to the cache afterwards is ignored.
+Other processes might answer from their local cache for up to directory.local_ttl seconds after that.
+
+It also caches where rejoin sends the participants of (possibly moved) meetings. Moving a meeting
+writes the new destination right away, so an evacuated server's participants don't hit the database.
+"""
+import hashlib
+import secrets
+import time
+from collections import namedtuple
+from typing import Dict, Optional
+
+from django.core.cache import cache
+
+from common_files import models
+from common_files.config import LoadBalancerConfig
+
+
+config = LoadBalancerConfig.from_json("../config.json")
+
+RunningMeeting = namedtuple("RunningMeeting", ["id", "meeting_id", "server_id"])
+RunningMeeting.__doc__ = "A running meeting's primary key, meeting id and its server's primary key"
+
+Destination = namedtuple("Destination", ["server_id", "logout_url"])
+Destination.__doc__ = "Where rejoin sends a meeting's participants: the final meeting's server's primary key or a logout url"
+
+_NOT_RUNNING = "NOT_RUNNING"
+_LOCAL_LIMIT = 10000
+
+_local_meetings = {}
+_local_destinations = {}
+_local_servers = {}
+_servers_expire = 0.0
+
+
+def _key(meeting_id: str) -> str:
+    # Meeting ids may contain characters memcached doesn't allow in keys
+    return "running:" + hashlib.sha1(meeting_id.encode("utf-8")).hexdigest()
+
+
+def _generation_key(meeting_id: str) -> str:
+    return "generation:" + hashlib.sha1(meeting_id.encode("utf-8")).hexdigest()
+
+
+def _new_generation() -> str:
+    # Random instead of counting, so a generation evicted from the cache can't come back
+    return secrets.token_hex(8)
+
+
+def _generation_ttl() -> float:
+    # Outlive the entries written in the generation
+    return 2 * config.directory.shared_ttl
+
+
+def _query(meeting_id: str):
+    return (models.Meeting.running
+            .filter(meeting_id=meeting_id)
+            .order_by("-id")
+            .values_list("id", "server_id")
+            .first())
+
+
+def _destination_key(pk: int) -> str:
+    return f"destination:{pk}"
+
+
+def lookup(meeting_id: str) -> Optional[RunningMeeting]:
+    """
+    Get the running meeting with a meeting id
+
+    :param meeting_id: the meeting id used by the api
+    :type meeting_id: str
+    :return: the running meeting or None if there is none
+    :rtype: Optional[RunningMeeting]
+    """
+    now = time.monotonic()
+    local = _local_meetings.get(meeting_id)
+    if local is not None and local[0] > now:
+        entry = local[1]
+    else:
+        key, generation_key = _key(meeting_id), _generation_key(meeting_id)
+        cached = cache.get_many([key, generation_key])
+        generation = cached.get(generation_key)
+        if generation is not None and key in cached and cached[key][0] == generation:
+            entry = cached[key][1]
+        else:
+            if generation is None:
+                generation = _new_generation()
+                if not cache.add(generation_key, generation, _generation_ttl()):
+                    generation = cache.get(generation_key, generation)
+
+            meeting = _query(meeting_id)
+            if meeting is None:
+                entry = _NOT_RUNNING
+                cache.set(key, (generation, entry), config.directory.negative_ttl)
+            else:
+                entry = RunningMeeting(meeting[0], meeting_id, meeting[1])
+                cache.set(key, (generation, entry), config.directory.shared_ttl)
+
+        if len(_local_meetings) >= _LOCAL_LIMIT:
+            _local_meetings.clear()
+        _local_meetings[meeting_id] = (now + config.directory.local_ttl, entry)
+
+    return None if entry == _NOT_RUNNING else entry
+
+
+def get_server(server_id: int) -> "models.BBBServer":
+    """
+    Get a server by its primary key
+
+    All servers are cached in the process for directory.server_ttl seconds.
+
+    :param server_id: the server's primary key (not its server_id field)
+    :type server_id: int
+    :return: the server
+    :rtype: BBBServer
+    :raises BBBServer.DoesNotExist: if there is no such server
+    """
+    global _local_servers, _servers_expire
+
+    now = time.monotonic()
+    if _servers_expire <= now or server_id not in _local_servers:
+        _local_servers = dict((server.id, server) for server in models.BBBServer.objects.all())
+        _servers_expire = now + config.directory.server_ttl
+
+    try:
+        return _local_servers[server_id]
+    except KeyError:
+        raise models.BBBServer.DoesNotExist() from None
+
+
+def invalidate(*meeting_ids: str):
+    """
+    Remove meetings from the directory
+
+    Call this whenever a meeting is created or ended (after the transaction committed).
+    It starts a new generation, which also discards entries of lookups still reading the old state.
+
+    :param meeting_ids: the meeting ids used by the api
+    :type meeting_ids: str
+    """
+    generation = _new_generation()
+    cache.set_many(dict((_generation_key(meeting_id), generation) for meeting_id in meeting_ids), _generation_ttl())
+    for meeting_id in meeting_ids:
+        _local_meetings.pop(meeting_id, None)
+
+
+def get_destination(pk: int) -> Optional[Destination]:
+    """
+    Get the cached destination of a meeting's participants for rejoin
+
+    Use common_files.archive.get_destination which falls back to the database.
+
+    :param pk: the meeting's primary key
+    :type pk: int
+    :return: the cached destination or None if it isn't cached
+    :rtype: Optional[Destination]
+    """
+    now = time.monotonic()
+    local = _local_destinations.get(pk)
+    if local is not None and local[0] > now:
+        return local[1]
+
+    destination = cache.get(_destination_key(pk))
+    if destination is not None:
+        if len(_local_destinations) >= _LOCAL_LIMIT:
+            _local_destinations.clear()
+        _local_destinations[pk] = (now + config.directory.local_ttl, destination)
+    return destination
+
+
+def set_destinations(destinations: Dict[int, Destination]):
+    """
+    Cache the destinations of meetings' participants for rejoin
+
+    :param destinations: dict mapping meetings' primary keys to their destination
+    :type destinations: Dict[int, Destination]
+    """
+    cache.set_many(dict((_destination_key(pk), destination) for pk, destination in destinations.items()),
+                   config.directory.destination_ttl)
+    for pk in destinations:
+        _local_destinations.pop(pk, None)
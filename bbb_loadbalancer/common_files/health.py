@@ -0,0 +1,252 @@
+"""
+Health of the servers as seen by the api workers' upstream calls
+
+Failure score:
+    Every failed call to a server adds 1 to its failure score, which halves every health.failure_half_life seconds.
+    Servers whose score reaches health.max_failure_score are only used for new meetings if there is no other server.
+
+Circuit breaker:
+    After health.circuit_failures consecutive failures a server's circuit opens. For health.circuit_open_time seconds
+    calls to it fail immediately instead of waiting for a timeout and it doesn't get new meetings.
+    Then the circuit is half open: a single call is let through. If it succeeds, the circuit closes again,
+    otherwise it stays open for another health.circuit_open_time seconds.
+
+Latency and error rate:
+    Every call's response time and whether it failed are averaged with an exponentially weighted moving average
+    (health.latency_alpha is the weight of a new sample). Servers answering slower than health.slow_latency seconds
+    or failing more than health.max_error_rate of their calls are only used for new meetings after the others.
+    The poller's api check contributes samples as well. Each process collects its samples for up to
+    health.report_interval seconds before adding them to the shared averages, so not every call writes to the cache.
+
+The state of each server is shared by all workers (and the poller) through django's cache.
+Concurrent updates might get lost, which is fine for estimates like these.
+Letting a single call probe a half open circuit relies on cache.add being atomic, which memcached guarantees.
+With the file based cache two workers might both probe.
+"""
+import logging
+import threading
+import time
+from collections import defaultdict, namedtuple
+from typing import Dict, Iterable, List, Optional
+
+from django.core.cache import cache
+
+from common_files.config import LoadBalancerConfig
+
+
+logger = logging.getLogger(__name__)
+
+config = LoadBalancerConfig.from_json("../config.json")
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+Health = namedtuple("Health", ["failure_score", "circuit", "latency", "error_rate"])
+Health.__doc__ = "A server's current failure score, the state of its circuit, its average latency and error rate"
+
+# Samples not yet added to the shared averages, None stands for a failed call
+_samples: Dict[int, List[Optional[float]]] = defaultdict(list)
+_reported: Dict[int, float] = {}
+_samples_lock = threading.Lock()
+
+
+class CircuitOpen(Exception):
+    """Raised instead of calling a server whose circuit is open"""
+
+
+def _key(server_id: int) -> str:
+    return f"health:{server_id}"
+
+
+def _probe_key(server_id: int) -> str:
+    return f"health:probe:{server_id}"
+
+
+def _new_entry() -> dict:
+    return {"failure_score": 0.0, "updated": 0.0, "failures": 0, "open_until": None,
+            "latency": None, "error_rate": 0.0}
+
+
+def _decayed_score(entry: dict, now: float) -> float:
+    return entry["failure_score"] * 0.5 ** ((now - entry["updated"]) / config.health.failure_half_life)
+
+
+def _circuit(entry: dict, now: float) -> str:
+    if entry["open_until"] is None:
+        return CLOSED
+    return OPEN if now < entry["open_until"] else HALF_OPEN
+
+
+def _save(server_id: int, entry: dict):
+    cache.set(_key(server_id), entry, config.health.failure_half_life * 10 + config.health.circuit_open_time)
+
+
+def _take_samples(server_id: int, sample: Optional[float], force: bool) -> List[Optional[float]]:
+    now = time.monotonic()
+    with _samples_lock:
+        _samples[server_id].append(sample)
+        if not force and now - _reported.get(server_id, 0) < config.health.report_interval:
+            return []
+        _reported[server_id] = now
+        return _samples.pop(server_id)
+
+
+def _add_samples(entry: dict, samples: List[Optional[float]]):
+    alpha = config.health.latency_alpha
+    for sample in samples:
+        entry["error_rate"] += alpha * ((sample is None) - entry["error_rate"])
+        if sample is None:
+            continue
+        if entry["latency"] is None:
+            entry["latency"] = sample
+        else:
+            entry["latency"] += alpha * (sample - entry["latency"])
+
+
+def _record_sample(server_id: int, sample: Optional[float]):
+    samples = _take_samples(server_id, sample, False)
+    if samples:
+        entry = cache.get(_key(server_id)) or _new_entry()
+        _add_samples(entry, samples)
+        _save(server_id, entry)
+
+
+def record_latency(server_id: int, seconds: float):
+    """
+    Add a successful call's response time to a server's averages
+
+    :param server_id: the server's primary key (not its server_id field)
+    :type server_id: int
+    :param seconds: how long the server took to answer
+    :type seconds: float
+    """
+    _record_sample(server_id, seconds)
+
+
+def record_error(server_id: int):
+    """
+    Add a failed call to a server's error rate without counting it towards its failure score and circuit
+
+    :param server_id: the server's primary key (not its server_id field)
+    :type server_id: int
+    """
+    _record_sample(server_id, None)
+
+
+def record_failure(server_id: int):
+    """
+    Count a failed call to a server
+
+    :param server_id: the server's primary key (not its server_id field)
+    :type server_id: int
+    """
+    now = time.time()
+    entry = cache.get(_key(server_id)) or _new_entry()
+    circuit = _circuit(entry, now)
+    _add_samples(entry, _take_samples(server_id, None, True))
+
+    entry["failure_score"] = _decayed_score(entry, now) + 1
+    entry["updated"] = now
+    entry["failures"] += 1
+    if circuit == HALF_OPEN or (circuit == CLOSED and entry["failures"] >= config.health.circuit_failures):
+        entry["open_until"] = now + config.health.circuit_open_time
+        logger.warning(f"Opened the circuit of server {server_id} after {entry['failures']} failures")
+    _save(server_id, entry)
+
+
+def record_success(server_id: int):
+    """
+    Close a server's circuit after a successful call
+
+    Only needs to be called if before_request returned True.
+
+    :param server_id: the server's primary key (not its server_id field)
+    :type server_id: int
+    """
+    entry = cache.get(_key(server_id))
+    if entry is not None and (entry["failures"] or entry["open_until"] is not None):
+        if entry["open_until"] is not None:
+            logger.info(f"Closed the circuit of server {server_id}")
+        entry["failures"] = 0
+        entry["open_until"] = None
+        _save(server_id, entry)
+
+
+def end_probe(server_id: int):
+    """
+    Let the next call probe a half open circuit
+
+    Has to be called after every call for which before_request returned True, however the call ended.
+
+    :param server_id: the server's primary key (not its server_id field)
+    :type server_id: int
+    """
+    cache.delete(_probe_key(server_id))
+
+
+def before_request(server_id: int) -> bool:
+    """
+    Check whether a call to a server may be sent
+
+    :param server_id: the server's primary key (not its server_id field)
+    :type server_id: int
+    :return: whether the server had failures, so a success has to be reported with record_success
+             and the call's end with end_probe
+    :rtype: bool
+    :raises CircuitOpen: if the server's circuit is open or another call is already probing the half open circuit
+    """
+    entry = cache.get(_key(server_id))
+    if entry is None:
+        return False
+
+    circuit = _circuit(entry, time.time())
+    if circuit == OPEN:
+        raise CircuitOpen()
+    if circuit == HALF_OPEN and not cache.add(_probe_key(server_id), True, config.health.circuit_open_time):
+        raise CircuitOpen()
+    return entry["failures"] > 0 or circuit == HALF_OPEN
+
+
+def get_health(server_ids: Iterable[int]) -> Dict[int, Health]:
+    """
+    Get the current health of servers
+
+    :param server_ids: the servers' primary keys
+    :type server_ids: Iterable[int]
+    :return: dict mapping each server's primary key to its health
+    :rtype: Dict[int, Health]
+    """
+    now = time.time()
+    server_ids = list(server_ids)
+    entries = cache.get_many([_key(server_id) for server_id in server_ids])
+
+    health = {}
+    for server_id in server_ids:
+        entry = entries.get(_key(server_id)) or _new_entry()
+        health[server_id] = Health(_decayed_score(entry, now), _circuit(entry, now),
+                                   entry["latency"], entry["error_rate"])
+    return health
+
+
+def is_failing(health: Health) -> bool:
+    """
+    Check whether a server failed often enough recently to be avoided
+
+    :param health: a server's health returned by get_health
+    :type health: Health
+    :rtype: bool
+    """
+    return health.failure_score >= config.health.max_failure_score
+
+
+def is_slow(health: Health) -> bool:
+    """
+    Check whether a server answers too slowly or fails too many calls to get new meetings before others
+
+    :param health: a server's health returned by get_health
+    :type health: Health
+    :rtype: bool
+    """
+    return ((health.latency is not None and health.latency >= config.health.slow_latency)
+            or health.error_rate >= config.health.max_error_rate)
@@ -0,0 +1,140 @@
+"""
+Logging helpers shared by the loadbalancer and the poller
+
+QueuedHandler:
+    Hands records to a background thread which writes them with another handler,
+    so a slow disk or journald never blocks a request or a poll cycle.
+JsonFormatter:
+    Formats records as one json object per line.
+SamplingFilter:
+    Lets only a fraction of high-volume records through.
+gzip_rotator / gzip_namer:
+    Compress rotated log files in a background thread.
+"""
+import atexit
+import copy
+import gzip
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import shutil
+import threading
+from datetime import datetime, timezone
+
+from django.utils.module_loading import import_string
+
+# Attributes every LogRecord has, everything else was passed with extra
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", logging.INFO, "", 0, "", None, None))) | {"message", "asctime"}
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Format records as json objects with their time, level, logger, message, extra attributes and exception
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES:
+                data[key] = value
+        if record.exc_info:
+            data["exception"] = self.formatException(record.exc_info)
+        return json.dumps(data, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Let only a fraction of the records up to a level through
+
+    :param rate: fraction of the records to keep
+    :type rate: float
+    :param level: records above this level are always kept
+    :type level: str
+    """
+
+    def __init__(self, rate: float = 0.1, level: str = "INFO"):
+        super().__init__()
+        self.rate = rate
+        self.level = logging.getLevelName(level)
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        return record.levelno > self.level or random.random() < self.rate
+
+
+class QueuedHandler(logging.handlers.QueueHandler):
+    """
+    Write records in a background thread
+
+    All keyword arguments are passed to the handler doing the actual writing.
+    If the queue is full (the target can't keep up) new records are dropped instead of blocking.
+
+    :param target_class: dotted path of the handler class writing the records
+    :type target_class: str
+    :param queue_size: maximum number of records waiting to be written
+    :type queue_size: int
+    """
+
+    def __init__(self, target_class: str = "logging.StreamHandler", queue_size: int = 10000, **kwargs):
+        super().__init__(queue.Queue(queue_size))
+        self.target = import_string(target_class)(**kwargs)
+        self.dropped = 0
+        self.listener = logging.handlers.QueueListener(self.queue, self.target, respect_handler_level=True)
+        self.listener.start()
+        atexit.register(self._stop)
+
+    def setFormatter(self, fmt):
+        # The target formats the records in the background thread
+        super().setFormatter(fmt)
+        self.target.setFormatter(fmt)
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Only merge the message's arguments now, in case they change before the record is written
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def _stop(self):
+        if self.listener._thread is not None:
+            self.listener.stop()
+
+    def close(self):
+        self._stop()
+        self.target.close()
+        super().close()
+
+
+def _compress(source: str, dest: str):
+    with open(source, "rb") as source_file, gzip.open(dest, "wb") as dest_file:
+        shutil.copyfileobj(source_file, dest_file, 1024 * 1024)
+    os.remove(source)
+
+
+def gzip_namer(name: str) -> str:
+    return name + ".gz"
+
+
+def gzip_rotator(source: str, dest: str):
+    """
+    Rotator for logging's rotating handlers gzipping the rotated file in a background thread
+
+    The file is only renamed while the handler waits, then it is compressed in chunks.
+    Use together with gzip_namer.
+    """
+    pending = dest[:-len(".gz")] if dest.endswith(".gz") else dest + ".pending"
+    os.rename(source, pending)
+    threading.Thread(target=_compress, args=(pending, dest), name="log-compression").start()
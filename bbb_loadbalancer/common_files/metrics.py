@@ -0,0 +1,135 @@
+"""
+Prometheus metrics of the loadbalancer and the poller
+
+Every process writes its metrics to the directory in the environment variable PROMETHEUS_MULTIPROC_DIR
+(set by the systemd units, the loadbalancer's workers and the poller use separate directories).
+Recording a value only writes to a memory mapped file, the values of all processes are merged when scraped.
+Without PROMETHEUS_MULTIPROC_DIR each process only exposes its own metrics.
+"""
+import glob
+import os
+from typing import Iterable
+
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram, REGISTRY, generate_latest
+from prometheus_client.core import GaugeMetricFamily
+from prometheus_client.multiprocess import MultiProcessCollector
+
+from common_files.config import LoadBalancerConfig
+
+
+config = LoadBalancerConfig.from_json("../config.json")
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+# Loadbalancer
+request_duration = Histogram(
+    "bbb_loadbalancer_request_duration_seconds", "Time spent answering api requests",
+    ["endpoint"], buckets=LATENCY_BUCKETS,
+)
+request_queries = Histogram(
+    "bbb_loadbalancer_request_db_queries", "Database queries per api request",
+    ["endpoint"], buckets=QUERY_BUCKETS,
+)
+request_query_duration = Histogram(
+    "bbb_loadbalancer_request_db_seconds", "Time spent in database queries per api request",
+    ["endpoint"], buckets=LATENCY_BUCKETS,
+)
+request_phase_duration = Histogram(
+    "bbb_loadbalancer_request_phase_seconds", "Time spent per phase of api requests (see api/timing.py)",
+    ["endpoint", "phase"], buckets=LATENCY_BUCKETS,
+)
+upstream_duration = Histogram(
+    "bbb_loadbalancer_upstream_duration_seconds", "Response time of successful calls to a bbb server",
+    ["server"], buckets=LATENCY_BUCKETS,
+)
+upstream_errors = Counter(
+    "bbb_loadbalancer_upstream_errors", "Calls to a bbb server which failed",
+    ["server"],
+)
+upstream_rejected = Counter(
+    "bbb_loadbalancer_upstream_rejected", "Calls to a bbb server which weren't sent because its circuit was open",
+    ["server"],
+)
+
+# Poller
+poller_cycle_duration = Histogram(
+    "bbb_poller_cycle_duration_seconds", "Time until all checks of a poller cycle finished",
+    buckets=(1, 2.5, 5, 10, 20, 30, 60, 120, 300),
+)
+poller_tasks_skipped = Counter(
+    "bbb_poller_tasks_skipped", "Poller tasks skipped because the previous cycle's one was still running",
+    ["task"],
+)
+poller_tasks_timed_out = Counter(
+    "bbb_poller_tasks_timed_out", "Poller tasks cancelled at the deadline of their cycle",
+    ["task"],
+)
+poller_meetings_ended = Counter(
+    "bbb_poller_meetings_ended", "Meetings marked as ended because their server didn't list them anymore",
+    ["server"],
+)
+poller_unknown_meetings = Gauge(
+    "bbb_poller_unknown_meetings", "Meetings running on a server which the loadbalancer didn't create",
+    ["server"], multiprocess_mode="mostrecent",
+)
+poller_cycle_lag = Gauge(
+    "bbb_poller_cycle_lag_seconds", "How late the last poller cycle started",
+    multiprocess_mode="mostrecent",
+)
+poller_last_cycle = Gauge(
+    "bbb_poller_last_cycle_timestamp_seconds", "When the last poller cycle started",
+    multiprocess_mode="mostrecent",
+)
+
+
+class _MultiProcessCollector:
+    """Merges the metrics written by the processes of several directories"""
+
+    def __init__(self, paths: Iterable[str]):
+        self.paths = list(paths)
+
+    def collect(self):
+        files = []
+        for path in self.paths:
+            files += glob.glob(os.path.join(path, "*.db"))
+        return MultiProcessCollector.merge(files, accumulate=True)
+
+
+class _ServerCollector:
+    """Running meetings and load per server, read from the database with a single query when scraped"""
+
+    def collect(self):
+        from common_files.models import BBBServer
+
+        meetings = GaugeMetricFamily("bbb_loadbalancer_server_running_meetings",
+                                     "Running meetings per server", labels=["server"])
+        load = GaugeMetricFamily("bbb_loadbalancer_server_running_load",
+                                 "Summed load of the running meetings per server", labels=["server"])
+
+        servers = BBBServer.with_running_meetings().values_list("server_id", "running_meetings", "running_load")
+        for server_id, running_meetings, running_load in servers:
+            meetings.add_metric([str(server_id)], running_meetings)
+            load.add_metric([str(server_id)], running_load)
+        return [meetings, load]
+
+
+if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+    _registry = CollectorRegistry()
+    _registry.register(_MultiProcessCollector({os.environ["PROMETHEUS_MULTIPROC_DIR"],
+                                                *config.monitoring.metrics_dirs}))
+else:
+    _registry = REGISTRY
+
+_server_registry = CollectorRegistry()
+_server_registry.register(_ServerCollector())
+
+
+def generate() -> bytes:
+    """
+    Render the metrics of all processes and the servers' current load in prometheus' text format
+
+    :rtype: bytes
+    """
+    return generate_latest(_registry) + generate_latest(_server_registry)
+
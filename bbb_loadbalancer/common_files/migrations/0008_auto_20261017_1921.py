@@ -0,0 +1,23 @@
+# Generated by Django 3.2.23 on 2026-10-17 19:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('common_files', '0007_auto_20220331_1348'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='bbbserver',
+            name='connect_timeout',
+            field=models.FloatField(blank=True, default=None, null=True),
+        ),
+        migrations.AddField(
+            model_name='bbbserver',
+            name='read_timeout',
+            field=models.FloatField(blank=True, default=None, null=True),
+        ),
+    ]
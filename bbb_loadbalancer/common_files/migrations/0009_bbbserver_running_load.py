@@ -0,0 +1,28 @@
+# Generated by Django 3.2.23 on 2026-10-17 19:22
+
+from django.db import migrations, models
+from django.db.models import Sum
+
+
+def calculate_running_load(apps, schema_editor):
+    BBBServer = apps.get_model("common_files", "BBBServer")
+    Meeting = apps.get_model("common_files", "Meeting")
+    loads = Meeting.objects.filter(ended=False).values("server").annotate(total=Sum("load"))
+    for load in loads:
+        BBBServer.objects.filter(id=load["server"]).update(running_load=load["total"] or 0)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('common_files', '0008_auto_20261017_1921'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='bbbserver',
+            name='running_load',
+            field=models.IntegerField(db_index=True, default=0),
+        ),
+        migrations.RunPython(calculate_running_load, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 3.2.23 on 2026-10-17 19:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('common_files', '0009_bbbserver_running_load'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='bbbserver',
+            name='capacity',
+            field=models.FloatField(default=1),
+        ),
+        migrations.AddField(
+            model_name='bbbserver',
+            name='cpu_load',
+            field=models.FloatField(blank=True, default=None, null=True),
+        ),
+        migrations.AddField(
+            model_name='bbbserver',
+            name='participants',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='bbbserver',
+            name='usage_updated',
+            field=models.DateTimeField(blank=True, default=None, null=True),
+        ),
+        migrations.AddField(
+            model_name='bbbserver',
+            name='video_streams',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
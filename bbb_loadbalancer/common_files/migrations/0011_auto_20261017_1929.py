@@ -0,0 +1,41 @@
+# Generated by Django 3.2.23 on 2026-10-17 19:29
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('common_files', '0010_auto_20261017_1923'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='meeting',
+            index=models.Index(fields=['meeting_id', 'ended'], name='meeting_meeting_id_ended_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='meeting',
+            index=models.Index(fields=['internal_id'], name='meeting_internal_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='meeting',
+            index=models.Index(fields=['ended', 'created'], name='meeting_ended_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='meeting',
+            index=models.Index(fields=['server', 'ended'], name='meeting_server_ended_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='meeting',
+            index=models.Index(condition=models.Q(('ended', False)), fields=['meeting_id'], name='meeting_running_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='meeting',
+            index=models.Index(condition=models.Q(('ended', False)), fields=['server'], name='meeting_running_server_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='meeting',
+            index=models.Index(condition=models.Q(('ended', False)), fields=['created'], name='meeting_running_created_idx'),
+        ),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 3.2.23 on 2026-10-17 19:31
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('common_files', '0011_auto_20261017_1929'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedMeeting',
+            fields=[
+                ('id', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('meeting_id', models.CharField(default='', max_length=255)),
+                ('internal_id', models.CharField(default='', max_length=255)),
+                ('load', models.IntegerField()),
+                ('create_query', models.JSONField(default=dict)),
+                ('created', models.DateTimeField()),
+                ('moved_to_id', models.BigIntegerField(blank=True, default=None, null=True)),
+                ('archived', models.DateTimeField(auto_now_add=True)),
+                ('server', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='archived_meetings', to='common_files.bbbserver')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='archivedmeeting',
+            index=models.Index(fields=['meeting_id'], name='archived_meeting_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='archivedmeeting',
+            index=models.Index(fields=['internal_id'], name='archived_internal_id_idx'),
+        ),
+    ]
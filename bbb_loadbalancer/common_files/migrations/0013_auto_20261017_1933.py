@@ -0,0 +1,52 @@
+# Generated by Django 3.2.23 on 2026-10-17 19:33
+
+from django.db import migrations, models
+
+
+def resolve_final_destinations(apps, schema_editor):
+    Meeting = apps.get_model("common_files", "Meeting")
+    ArchivedMeeting = apps.get_model("common_files", "ArchivedMeeting")
+    moves = dict(Meeting.objects.filter(moved_to__isnull=False).values_list("id", "moved_to"))
+    moves.update(ArchivedMeeting.objects.filter(moved_to_id__isnull=False).values_list("id", "moved_to_id"))
+
+    destinations = {}
+    for pk in moves:
+        destination = moves[pk]
+        seen = {pk}
+        while destination in moves and destination not in seen:
+            seen.add(destination)
+            destination = moves[destination]
+        destinations.setdefault(destination, []).append(pk)
+
+    for destination, pks in destinations.items():
+        Meeting.objects.filter(id__in=pks).update(final_destination_id=destination)
+        ArchivedMeeting.objects.filter(id__in=pks).update(final_destination_id=destination)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('common_files', '0012_auto_20261017_1931'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='archivedmeeting',
+            name='final_destination_id',
+            field=models.BigIntegerField(blank=True, default=None, null=True),
+        ),
+        migrations.AddField(
+            model_name='meeting',
+            name='final_destination_id',
+            field=models.BigIntegerField(blank=True, default=None, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='archivedmeeting',
+            index=models.Index(fields=['final_destination_id'], name='archived_final_destination_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='meeting',
+            index=models.Index(fields=['final_destination_id'], name='meeting_final_destination_idx'),
+        ),
+        migrations.RunPython(resolve_final_destinations, migrations.RunPython.noop),
+    ]
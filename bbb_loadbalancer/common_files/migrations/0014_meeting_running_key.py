@@ -0,0 +1,34 @@
+# Generated by Django 3.2.23 on 2026-10-17 19:38
+
+from django.db import migrations, models
+
+
+def set_running_keys(apps, schema_editor):
+    Meeting = apps.get_model("common_files", "Meeting")
+    # Only the newest of several running meetings with the same id gets the key
+    newest = {}
+    for pk, meeting_id in Meeting.objects.filter(ended=False).order_by("id").values_list("id", "meeting_id"):
+        newest[meeting_id] = pk
+    for meeting_id, pk in newest.items():
+        Meeting.objects.filter(id=pk).update(running_key=meeting_id)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('common_files', '0013_auto_20261017_1933'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='meeting',
+            name='running_key',
+            field=models.CharField(blank=True, default=None, max_length=255, null=True),
+        ),
+        migrations.RunPython(set_running_keys, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='meeting',
+            name='running_key',
+            field=models.CharField(blank=True, default=None, max_length=255, null=True, unique=True),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 3.2.23 on 2026-10-17 19:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('common_files', '0014_meeting_running_key'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='bbbserver',
+            name='last_poll',
+            field=models.DateTimeField(blank=True, default=None, null=True),
+        ),
+        migrations.AddField(
+            model_name='bbbserver',
+            name='last_poll_result',
+            field=models.CharField(blank=True, default='', max_length=255),
+        ),
+    ]
@@ -1,7 +1,11 @@
 import re
+from collections import defaultdict
+from typing import Dict
 
-from django.db import models
-from django.db.models import Manager
+from django.db import models, transaction
+from django.db.models import Manager, QuerySet, Count, F, Q, Sum
+
+from common_files import directory
 
 
 class BBBServer(models.Model):
@@ -16,6 +20,20 @@ class BBBServer(models.Model):
                              choices=((ENABLED, "enabled"), (DISABLED, "disabled"), (PANIC, "panic")))
     unreachable = models.PositiveIntegerField(default=0)
     reachable = models.PositiveIntegerField(default=0)
+    connect_timeout = models.FloatField(null=True, blank=True, default=None)
+    read_timeout = models.FloatField(null=True, blank=True, default=None)
+    running_load = models.IntegerField(default=0, db_index=True)
+    capacity = models.FloatField(default=1)
+
+    # Live usage as last seen by the poller
+    participants = models.PositiveIntegerField(default=0)
+    video_streams = models.PositiveIntegerField(default=0)
+    cpu_load = models.FloatField(null=True, blank=True, default=None)
+    usage_updated = models.DateTimeField(null=True, blank=True, default=None)
+
+    # Outcome of the poller's last checks
+    last_poll = models.DateTimeField(null=True, blank=True, default=None)
+    last_poll_result = models.CharField(max_length=255, blank=True, default="")
 
     @property
     def enabled(self):
@@ -34,6 +52,34 @@ class BBBServer(models.Model):
                 url = url[:(url.find("/", 8) if url.find("/", 8) != -1 else len(url))] + "/bigbluebutton/api/"
         return url
 
+    @classmethod
+    def reconcile_running_load(cls) -> Dict[int, int]:
+        """
+        Recalculate every server's running_load from its running meetings and repair any drift
+
+        :return: dict mapping the server_id of each drifted server to the amount it was off by
+        :rtype: Dict[int, int]
+        """
+        drift = {}
+        with transaction.atomic():
+            servers = list(cls.objects.select_for_update().order_by("id"))
+            loads = dict(Meeting.running.values("server").annotate(total=Sum("load")).values_list("server", "total"))
+            for server in servers:
+                load = loads.get(server.id) or 0
+                if server.running_load != load:
+                    drift[server.server_id] = server.running_load - load
+                    cls.objects.filter(id=server.id).update(running_load=load)
+        return drift
+
+    @classmethod
+    def with_running_meetings(cls) -> QuerySet:
+        """
+        Get all servers annotated with their number of running meetings as running_meetings
+
+        :rtype: QuerySet
+        """
+        return cls.objects.annotate(running_meetings=Count("meeting", filter=Q(meeting__ended=False)))
+
     def get_absolute_url(self):
         """
         Provide a link to api mate in django's admin site
@@ -44,7 +90,51 @@ class BBBServer(models.Model):
         return self.url
 
 
-class RunningMeetingsManager(Manager):
+class MeetingQuerySet(QuerySet):
+
+    def create_running(self, **kwargs) -> "Meeting":
+        """
+        Create a new running meeting and add its load to its server's running_load
+
+        :return: the new meeting
+        :rtype: Meeting
+        :raises IntegrityError: if a meeting with the same meeting id is already running
+        """
+        kwargs.setdefault("running_key", kwargs.get("meeting_id"))
+        with transaction.atomic():
+            meeting = self.create(**kwargs)
+            BBBServer.objects.filter(id=meeting.server_id).update(running_load=F("running_load") + meeting.load)
+            transaction.on_commit(lambda: directory.invalidate(meeting.meeting_id))
+        return meeting
+
+    def mark_ended(self) -> int:
+        """
+        Mark all running meetings in this queryset as ended and remove their load from their servers' running_load
+
+        :return: number of meetings which have been ended
+        :rtype: int
+        """
+        with transaction.atomic():
+            meetings = list(self.filter(ended=False).select_for_update()
+                            .values_list("id", "server_id", "load", "meeting_id"))
+            if not meetings:
+                return 0
+
+            Meeting.objects.filter(id__in=[meeting[0] for meeting in meetings]).update(ended=True, running_key=None)
+
+            loads = defaultdict(int)
+            for _, server_id, load, _ in meetings:
+                loads[server_id] += load
+            for server_id, load in loads.items():
+                BBBServer.objects.filter(id=server_id).update(running_load=F("running_load") - load)
+
+            meeting_ids = [meeting[3] for meeting in meetings]
+            transaction.on_commit(lambda: directory.invalidate(*meeting_ids))
+
+        return len(meetings)
+
+
+class RunningMeetingsManager(Manager.from_queryset(MeetingQuerySet)):
 
     def get_queryset(self):
         return super().get_queryset().filter(ended=False)
@@ -53,7 +143,7 @@ class RunningMeetingsManager(Manager):
 class Meeting(models.Model):
     TEMP_INTERNAL_ID = "**TEMP**"
 
-    objects = Manager()
+    objects = MeetingQuerySet.as_manager()
     running = RunningMeetingsManager()
 
     meeting_id = models.CharField(max_length=255, default="")
@@ -64,6 +154,122 @@ class Meeting(models.Model):
     create_query = models.JSONField(default=dict)
     created = models.DateTimeField(auto_now_add=True)
     moved_to = models.ForeignKey("Meeting", on_delete=models.CASCADE, null=True, blank=True, default=None)
+    # The meeting id while the meeting is running, its uniqueness prevents two running meetings with the same id
+    running_key = models.CharField(max_length=255, null=True, blank=True, default=None, unique=True)
+    # Primary key of the last meeting in the chain of moved_to links, kept up to date by record_move
+    final_destination_id = models.BigIntegerField(null=True, blank=True, default=None)
+
+    class Meta:
+        indexes = [
+            # Meeting.running lookups by meeting id and getRecordings by meeting id
+            models.Index(fields=["meeting_id", "ended"], name="meeting_meeting_id_ended_idx"),
+            # publishRecordings, updateRecordings and getRecordings by record id
+            models.Index(fields=["internal_id"], name="meeting_internal_id_idx"),
+            # The poller's running meetings and the archive's old meetings
+            models.Index(fields=["ended", "created"], name="meeting_ended_created_idx"),
+            # Running meetings per server (panic, load reconciliation)
+            models.Index(fields=["server", "ended"], name="meeting_server_ended_idx"),
+            # Repointing the chain of moves in record_move
+            models.Index(fields=["final_destination_id"], name="meeting_final_destination_idx"),
+
+            # Small indexes covering only the running meetings where the database supports them (not MySQL),
+            # otherwise the composite indexes above are used
+            models.Index(fields=["meeting_id"], condition=Q(ended=False), name="meeting_running_id_idx"),
+            models.Index(fields=["server"], condition=Q(ended=False), name="meeting_running_server_idx"),
+            models.Index(fields=["created"], condition=Q(ended=False), name="meeting_running_created_idx"),
+        ]
+
+    def mark_ended(self) -> bool:
+        """
+        Mark this meeting as ended and remove its load from its server's running_load
+
+        :return: whether the meeting was still running
+        :rtype: bool
+        """
+        self.ended = True
+        self.running_key = None
+        return Meeting.objects.filter(id=self.id).mark_ended() > 0
+
+    def reassign(self, server: BBBServer):
+        """
+        Move this running meeting's registration and its load to another server
+
+        This only changes the database, it is meant for meetings which haven't been created on their server yet.
+
+        :param server: the new server
+        :type server: BBBServer
+        """
+        with transaction.atomic():
+            if Meeting.running.filter(id=self.id).update(server=server):
+                BBBServer.objects.filter(id=self.server_id).update(running_load=F("running_load") - self.load)
+                BBBServer.objects.filter(id=server.id).update(running_load=F("running_load") + self.load)
+            self.server = server
+            meeting_id = self.meeting_id
+            transaction.on_commit(lambda: directory.invalidate(meeting_id))
+
+    def record_move(self, new_meeting: "Meeting"):
+        """
+        Link this meeting to the meeting it was moved to
+
+        Every meeting (live or archived) which ended up in this one is pointed to the new meeting as well,
+        so rejoin never has to follow the chain of moves.
+
+        :param new_meeting: the meeting replacing this one
+        :type new_meeting: Meeting
+        """
+        with transaction.atomic():
+            self.moved_to = new_meeting
+            self.final_destination_id = new_meeting.id
+            self.save(update_fields=["moved_to", "final_destination_id"])
+
+            moved = list(Meeting.objects.filter(final_destination_id=self.id).values_list("id", flat=True))
+            moved += ArchivedMeeting.objects.filter(final_destination_id=self.id).values_list("id", flat=True)
+            Meeting.objects.filter(final_destination_id=self.id).update(final_destination_id=new_meeting.id)
+            ArchivedMeeting.objects.filter(final_destination_id=self.id).update(final_destination_id=new_meeting.id)
+
+            # Participants of an evacuated server rejoin all at once, so their destination is cached right away
+            destination = directory.Destination(new_meeting.server_id, None)
+            moved.append(self.id)
+            transaction.on_commit(lambda: directory.set_destinations(dict.fromkeys(moved, destination)))
+
+    def discard(self):
+        """
+        Delete this meeting and remove its load from its server's running_load if it was running
+        """
+        with transaction.atomic():
+            self.mark_ended()
+            self.delete()
+
+    def __str__(self):
+        return self.meeting_id
+
+
+class ArchivedMeeting(models.Model):
+    """
+    An ended meeting moved out of the Meeting table by common_files.archive
+
+    It keeps its Meeting's primary key, so moved_to links, final destinations and rejoin urls stay valid.
+    """
+    ended = True
+
+    id = models.BigIntegerField(primary_key=True)
+    meeting_id = models.CharField(max_length=255, default="")
+    internal_id = models.CharField(max_length=255, default="")
+    server = models.ForeignKey(BBBServer, on_delete=models.CASCADE, related_name="archived_meetings")
+    load = models.IntegerField()
+    create_query = models.JSONField(default=dict)
+    created = models.DateTimeField()
+    # Primary key of the meeting this one was moved to, which is either in Meeting or in ArchivedMeeting
+    moved_to_id = models.BigIntegerField(null=True, blank=True, default=None)
+    final_destination_id = models.BigIntegerField(null=True, blank=True, default=None)
+    archived = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["meeting_id"], name="archived_meeting_id_idx"),
+            models.Index(fields=["internal_id"], name="archived_internal_id_idx"),
+            models.Index(fields=["final_destination_id"], name="archived_final_destination_idx"),
+        ]
 
     def __str__(self):
         return self.meeting_id
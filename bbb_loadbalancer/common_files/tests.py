@@ -0,0 +1,239 @@
+import time
+from datetime import datetime, timedelta, timezone
+from unittest import mock
+
+from django.core.cache import cache
+from django.test import SimpleTestCase, TransactionTestCase, override_settings
+
+from cli.set_state import set_state
+from common_files import archive, directory, health
+from common_files.models import ArchivedMeeting, BBBServer, Meeting
+
+LOCMEM_CACHE = {"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+@mock.patch.dict(directory.config.directory, {"local_ttl": 0})
+class DirectoryTest(TransactionTestCase):
+
+    def setUp(self):
+        cache.clear()
+        directory._local_meetings.clear()
+        self.server = BBBServer.objects.create(server_id=1, url="https://bbb1.example.org/bigbluebutton/")
+
+    def _create(self, meeting_id: str) -> Meeting:
+        return Meeting.objects.create_running(meeting_id=meeting_id, internal_id="internal", server=self.server,
+                                             load=1)
+
+    def test_lookup(self):
+        self.assertIsNone(directory.lookup("room"))
+        meeting = self._create("room")
+
+        self.assertEqual(directory.lookup("room"), (meeting.id, "room", self.server.id))
+        with self.assertNumQueries(0):
+            self.assertEqual(directory.lookup("room").id, meeting.id)
+
+        Meeting.running.filter(id=meeting.id).mark_ended()
+        self.assertIsNone(directory.lookup("room"))
+
+    def test_stale_read_is_not_written_back(self):
+        meeting = self._create("room")
+        query = directory._query
+
+        def ended_while_reading(meeting_id):
+            # The lookup reads the running meeting, then the meeting ends before the lookup caches it
+            result = query(meeting_id)
+            Meeting.running.filter(id=meeting.id).mark_ended()
+            return result
+
+        with mock.patch.object(directory, "_query", side_effect=ended_while_reading):
+            self.assertEqual(directory.lookup("room").id, meeting.id)
+
+        self.assertIsNone(directory.lookup("room"))
+
+    def test_lost_generation_discards_entries(self):
+        self._create("room")
+        directory.lookup("room")
+        cache.delete(directory._generation_key("room"))
+
+        with self.assertNumQueries(1):
+            directory.lookup("room")
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class CircuitTest(SimpleTestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    def _circuit(self) -> str:
+        return health.get_health([1])[1].circuit
+
+    def _expire_open_time(self):
+        entry = cache.get(health._key(1))
+        entry["open_until"] = time.time() - 1
+        health._save(1, entry)
+
+    def _open(self):
+        for _ in range(health.config.health.circuit_failures):
+            health.before_request(1)
+            health.record_failure(1)
+
+    def test_opens_after_consecutive_failures(self):
+        self.assertFalse(health.before_request(1))
+        for _ in range(health.config.health.circuit_failures - 1):
+            health.record_failure(1)
+        self.assertEqual(self._circuit(), health.CLOSED)
+        self.assertTrue(health.before_request(1))
+
+        health.record_failure(1)
+        self.assertEqual(self._circuit(), health.OPEN)
+        with self.assertRaises(health.CircuitOpen):
+            health.before_request(1)
+
+    def test_half_open_lets_one_probe_through_and_closes(self):
+        self._open()
+        self._expire_open_time()
+        self.assertEqual(self._circuit(), health.HALF_OPEN)
+
+        self.assertTrue(health.before_request(1))
+        with self.assertRaises(health.CircuitOpen):
+            health.before_request(1)
+
+        health.record_success(1)
+        health.end_probe(1)
+        self.assertEqual(self._circuit(), health.CLOSED)
+        self.assertFalse(health.before_request(1))
+
+    def test_failed_probe_reopens(self):
+        self._open()
+        self._expire_open_time()
+
+        self.assertTrue(health.before_request(1))
+        health.record_failure(1)
+        health.end_probe(1)
+        self.assertEqual(self._circuit(), health.OPEN)
+
+    def test_ended_probe_lets_the_next_one_through(self):
+        self._open()
+        self._expire_open_time()
+
+        self.assertTrue(health.before_request(1))
+        health.end_probe(1)
+        self.assertTrue(health.before_request(1))
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class RunningLoadTest(TransactionTestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.servers = [BBBServer.objects.create(server_id=i, url=f"https://bbb{i}.example.org/bigbluebutton/")
+                        for i in range(2)]
+
+    def _create(self, meeting_id: str, server: BBBServer, load: int) -> Meeting:
+        return Meeting.objects.create_running(meeting_id=meeting_id, internal_id=f"internal-{meeting_id}",
+                                             server=server, load=load)
+
+    def _loads(self) -> list:
+        return list(BBBServer.objects.order_by("server_id").values_list("running_load", flat=True))
+
+    def test_create_and_end(self):
+        first = self._create("first", self.servers[0], 3)
+        self._create("second", self.servers[0], 2)
+        third = self._create("third", self.servers[1], 4)
+        self.assertEqual(self._loads(), [5, 4])
+
+        self.assertTrue(first.mark_ended())
+        self.assertFalse(first.mark_ended())
+        self.assertEqual(self._loads(), [2, 4])
+
+        self.assertEqual(Meeting.objects.all().mark_ended(), 2)
+        self.assertEqual(self._loads(), [0, 0])
+
+        third.discard()
+        self.assertEqual(self._loads(), [0, 0])
+
+    def test_discard_running_meeting(self):
+        self._create("room", self.servers[0], 3).discard()
+        self.assertEqual(self._loads(), [0, 0])
+
+    def test_reassign(self):
+        meeting = self._create("room", self.servers[0], 3)
+        meeting.reassign(self.servers[1])
+        self.assertEqual(self._loads(), [0, 3])
+
+        # An ended meeting's load has already been removed
+        meeting.mark_ended()
+        meeting.reassign(self.servers[0])
+        self.assertEqual(self._loads(), [0, 0])
+
+    def test_reconcile(self):
+        self._create("room", self.servers[0], 3)
+        BBBServer.objects.filter(server_id=0).update(running_load=5)
+        BBBServer.objects.filter(server_id=1).update(running_load=-1)
+
+        self.assertEqual(BBBServer.reconcile_running_load(), {0: 2, 1: -1})
+        self.assertEqual(self._loads(), [3, 0])
+        self.assertEqual(BBBServer.reconcile_running_load(), {})
+
+    def test_set_state_keeps_the_load(self):
+        stale = BBBServer.objects.get(server_id=0)
+        self._create("room", self.servers[0], 3)
+
+        set_state(stale, BBBServer.DISABLED)
+        server = BBBServer.objects.get(server_id=0)
+        self.assertEqual((server.state, server.running_load), (BBBServer.DISABLED, 3))
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class ArchiveTest(TransactionTestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.server = BBBServer.objects.create(server_id=1, url="https://bbb1.example.org/bigbluebutton/")
+
+    def _create(self, meeting_id: str, ended: bool = True, days: float = 60) -> Meeting:
+        meeting = Meeting.objects.create_running(meeting_id=meeting_id, internal_id=f"internal-{meeting_id}",
+                                                 server=self.server, load=1)
+        if ended:
+            meeting.mark_ended()
+        Meeting.objects.filter(id=meeting.id).update(created=datetime.now(tz=timezone.utc) - timedelta(days=days))
+        return meeting
+
+    def test_archives_old_ended_meetings(self):
+        old = self._create("old")
+        self._create("recent", days=1)
+        self._create("running", ended=False)
+        self._create("newest")
+
+        self.assertEqual(archive.archive_ended_meetings(age=30, batch_size=1), 1)
+
+        self.assertEqual(set(Meeting.objects.values_list("meeting_id", flat=True)), {"recent", "running", "newest"})
+        self.assertEqual(list(ArchivedMeeting.objects.values_list("id", "internal_id")), [(old.id, "internal-old")])
+        self.assertEqual(archive.get_meeting(old.id).meeting_id, "old")
+        self.assertEqual(archive.get_internal_ids("old"), ["internal-old"])
+
+    def test_limits_the_batches(self):
+        for i in range(4):
+            self._create(f"old-{i}")
+        self._create("newest")
+
+        self.assertEqual(archive.archive_ended_meetings(age=30, batch_size=1, max_batches=2), 2)
+        self.assertEqual(archive.archive_ended_meetings(age=30, batch_size=1, max_batches=3), 2)
+        self.assertEqual(ArchivedMeeting.objects.count(), 4)
+
+    def test_moved_meetings_still_find_their_destination(self):
+        first = self._create("first")
+        second = self._create("second")
+        third = self._create("third", ended=False, days=0)
+        first.record_move(second)
+        second.record_move(third)
+        cache.clear()
+        directory._local_destinations.clear()
+
+        self.assertEqual(archive.archive_ended_meetings(age=30), 2)
+
+        self.assertEqual(ArchivedMeeting.objects.count(), 2)
+        self.assertEqual(archive.get_destination(first.id), (self.server.id, None))
+        self.assertEqual(archive.follow_moves(archive.get_meeting(first.id)).id, third.id)
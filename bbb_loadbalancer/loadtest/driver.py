@@ -0,0 +1,255 @@
+"""
+Fire api traffic at the loadbalancer and report throughput and latencies per endpoint
+
+Synthetic traffic (a closed loop of --concurrency clients sending a weighted mix of calls):
+    python -m loadtest.driver --url http://127.0.0.1:8000/bigbluebutton/api/ --secret change_me --duration 30
+
+Replayed traffic (at --speed times the recorded pace):
+    python -m loadtest.driver --url ... --secret ... --replay traffic.jsonl --speed 10
+
+Replay files contain one request per line:
+    {"time": 0.153, "call": "create", "params": {"meetingID": "room-1", "name": "Room 1"}}
+where time is the second the request was sent at relative to the first one.
+Synthetic runs write this format with --record, so a run can be repeated exactly.
+"""
+import argparse
+import asyncio
+import hashlib
+import itertools
+import json
+import math
+import random
+import re
+import sys
+import time
+from collections import defaultdict
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urlencode
+
+import httpx
+
+DEFAULT_MIX = "create=10,join=30,isMeetingRunning=25,getMeetingInfo=20,getMeetings=3,publishRecordings=2,end=10"
+
+_internal_id_regex = re.compile(rb"<internalMeetingID>([^<]+)</internalMeetingID>")
+
+
+def percentile(values: List[float], percent: float) -> float:
+    """
+    Nearest-rank percentile of sorted values
+    """
+    if not values:
+        return 0.0
+    return values[max(0, min(len(values) - 1, math.ceil(percent / 100 * len(values)) - 1))]
+
+
+class Statistics:
+    def __init__(self):
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.errors: Dict[str, int] = defaultdict(int)
+        self.start = time.perf_counter()
+        self.end = None
+
+    def add(self, call: str, seconds: float, success: bool):
+        self.latencies[call].append(seconds)
+        if not success:
+            self.errors[call] += 1
+
+    def report(self) -> dict:
+        duration = (self.end or time.perf_counter()) - self.start
+        endpoints = {}
+        for call, latencies in sorted(self.latencies.items()):
+            latencies = sorted(latencies)
+            endpoints[call] = {
+                "requests": len(latencies),
+                "errors": self.errors[call],
+                "rps": round(len(latencies) / duration, 1),
+                "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+                "p95_ms": round(percentile(latencies, 95) * 1000, 2),
+                "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+                "max_ms": round(latencies[-1] * 1000, 2),
+            }
+        total = sum(endpoint["requests"] for endpoint in endpoints.values())
+        return {
+            "duration": round(duration, 2),
+            "requests": total,
+            "errors": sum(endpoint["errors"] for endpoint in endpoints.values()),
+            "rps": round(total / duration, 1),
+            "endpoints": endpoints,
+        }
+
+
+class SyntheticTraffic:
+    """
+    Generates a weighted mix of calls for the meetings it created itself
+
+    :param mix: dict mapping api calls to their weights
+    """
+
+    def __init__(self, mix: Dict[str, float]):
+        self.calls = list(mix)
+        self.weights = list(mix.values())
+        self.counter = itertools.count()
+        self.running: List[str] = []
+        self.internal_ids: Dict[str, str] = {}
+
+    def _create(self) -> Tuple[str, dict]:
+        meeting_id = f"load-{next(self.counter)}"
+        self.running.append(meeting_id)
+        return "create", {"meetingID": meeting_id, "name": f"Load test {meeting_id}",
+                          "load": random.choice((1, 1, 1, 2, 5))}
+
+    def next(self) -> Tuple[str, dict]:
+        call = random.choices(self.calls, self.weights)[0]
+        if call == "getMeetings":
+            return call, {}
+        if call == "create" or not self.running:
+            return self._create()
+
+        meeting_id = random.choice(self.running)
+        if call == "end":
+            self.running.remove(meeting_id)
+            return call, {"meetingID": meeting_id}
+        if call == "join":
+            return call, {"meetingID": meeting_id, "fullName": f"User {random.randrange(1000)}", "role": "VIEWER"}
+        if call in ("publishRecordings", "updateRecordings"):
+            record_id = self.internal_ids.get(meeting_id)
+            if record_id is None:
+                return "getMeetingInfo", {"meetingID": meeting_id}
+            if call == "publishRecordings":
+                return call, {"recordID": record_id, "publish": "true"}
+            return call, {"recordID": record_id, "meta_loadtest": "true"}
+        return call, {"meetingID": meeting_id}
+
+    def created(self, meeting_id: str, content: bytes):
+        match = _internal_id_regex.search(content)
+        if match is not None:
+            self.internal_ids[meeting_id] = match.group(1).decode()
+
+
+class Driver:
+    def __init__(self, url: str, secret: str, concurrency: int, record: Optional[str] = None):
+        self.url = url if url.endswith("/") else url + "/"
+        self.secret = secret
+        self.concurrency = concurrency
+        self.statistics = Statistics()
+        self.client = httpx.AsyncClient(
+            timeout=60, follow_redirects=False,
+            limits=httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency),
+        )
+        self.record = open(record, "w") if record else None
+
+    def build_url(self, call: str, params: dict) -> str:
+        query_string = urlencode(params)
+        checksum = hashlib.sha1((call + query_string + self.secret).encode()).hexdigest()
+        return f"{self.url}{call}?{query_string}{'&' if query_string else ''}checksum={checksum}"
+
+    async def send(self, call: str, params: dict) -> Optional[bytes]:
+        if self.record is not None:
+            self.record.write(json.dumps({"time": round(time.perf_counter() - self.statistics.start, 4),
+                                          "call": call, "params": params}) + "\n")
+        start = time.perf_counter()
+        try:
+            response = await self.client.get(self.build_url(call, params))
+        except httpx.HTTPError:
+            self.statistics.add(call, time.perf_counter() - start, False)
+            return None
+        success = response.status_code == 302 or (response.status_code == 200
+                                                   and b"<returncode>SUCCESS</returncode>" in response.content)
+        self.statistics.add(call, time.perf_counter() - start, success)
+        return response.content
+
+    async def synthetic(self, duration: float, mix: Dict[str, float]):
+        traffic = SyntheticTraffic(mix)
+        stop = time.perf_counter() + duration
+
+        async def client():
+            while time.perf_counter() < stop:
+                call, params = traffic.next()
+                content = await self.send(call, params)
+                if call == "create" and content is not None:
+                    traffic.created(params["meetingID"], content)
+
+        await asyncio.gather(*(client() for _ in range(self.concurrency)))
+
+    async def replay(self, path: str, speed: float):
+        with open(path) as file:
+            entries = sorted((json.loads(line) for line in file if line.strip()), key=lambda entry: entry["time"])
+        if not entries:
+            return
+
+        semaphore = asyncio.Semaphore(self.concurrency)
+        first = entries[0]["time"]
+        start = time.perf_counter()
+
+        async def send(entry):
+            async with semaphore:
+                await self.send(entry["call"], entry.get("params", {}))
+
+        tasks = []
+        for entry in entries:
+            delay = (entry["time"] - first) / speed - (time.perf_counter() - start)
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.create_task(send(entry)))
+        await asyncio.gather(*tasks)
+
+    async def close(self):
+        self.statistics.end = time.perf_counter()
+        await self.client.aclose()
+        if self.record is not None:
+            self.record.close()
+
+
+def print_report(report: dict):
+    print(f"{report['requests']} requests in {report['duration']}s: {report['rps']} requests/s, "
+          f"{report['errors']} errors")
+    print(f"{'endpoint':<20}{'requests':>10}{'errors':>8}{'rps':>9}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}"
+          f"{'max ms':>10}")
+    for call, endpoint in report["endpoints"].items():
+        print(f"{call:<20}{endpoint['requests']:>10}{endpoint['errors']:>8}{endpoint['rps']:>9}"
+              f"{endpoint['p50_ms']:>10}{endpoint['p95_ms']:>10}{endpoint['p99_ms']:>10}{endpoint['max_ms']:>10}")
+
+
+def parse_mix(string: str) -> Dict[str, float]:
+    mix = {}
+    for part in string.split(","):
+        call, _, weight = part.partition("=")
+        mix[call.strip()] = float(weight or 1)
+    return mix
+
+
+async def run(args):
+    driver = Driver(args.url, args.secret, args.concurrency, args.record)
+    try:
+        if args.replay:
+            await driver.replay(args.replay, args.speed)
+        else:
+            await driver.synthetic(args.duration, parse_mix(args.mix))
+    finally:
+        await driver.close()
+    return driver.statistics.report()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Send api traffic to the loadbalancer and measure it")
+    parser.add_argument("--url", default="http://127.0.0.1:8000/bigbluebutton/api/", help="the loadbalancer's api")
+    parser.add_argument("--secret", required=True, help="the loadbalancer's shared secret")
+    parser.add_argument("--concurrency", type=int, default=20, help="requests in flight at the same time")
+    parser.add_argument("--duration", type=float, default=30, help="seconds to send synthetic traffic")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="weights of the synthetic calls")
+    parser.add_argument("--record", help="write the sent requests to this file for replaying them")
+    parser.add_argument("--replay", help="replay the requests in this file instead of sending synthetic ones")
+    parser.add_argument("--speed", type=float, default=1, help="replay this many times faster than recorded")
+    parser.add_argument("--json", action="store_true", help="print the results as json")
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args))
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+    sys.exit(0 if report["requests"] else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,271 @@
+"""
+A cluster of fake bigbluebutton servers for load tests
+
+Each node implements create, end, getMeetings, getMeetingInfo, isMeetingRunning, publishRecordings,
+updateRecordings and join with bigbluebutton's checksums and keeps its meetings in memory.
+Latency, error rate and the number of meetings running from the start are configurable per node.
+All nodes are served by a single uvicorn server in one process.
+
+Usage (from the bbb_loadbalancer directory):
+    python -m loadtest.fake_bbb --nodes 3 --first-port 18001 --latency 0.05
+    python -m loadtest.fake_bbb --nodes 3 --node 18003:latency=1.5,error_rate=0.2
+
+With --register the nodes are added to the loadbalancer's database as servers 0, 1, ...
+(replacing servers with these ids), which skips the ssh setup of `python -m cli add`.
+"""
+import argparse
+import asyncio
+import hashlib
+import os
+import random
+import re
+import socket
+import time
+from typing import Dict, Optional
+from urllib.parse import parse_qsl
+from xml.sax.saxutils import escape
+
+import uvicorn
+
+_checksum_regex = re.compile(r"checksum=([^&]+)&|&?checksum=([^&]+)$")
+
+
+def _xml(returncode: str = "SUCCESS", body: str = "", message_key: str = None, message: str = None) -> str:
+    if message_key is not None:
+        body += f"<messageKey>{message_key}</messageKey><message>{escape(message or '')}</message>"
+    return f"<response><returncode>{returncode}</returncode>{body}</response>"
+
+
+def _failed(message_key: str, message: str) -> str:
+    return _xml("FAILED", message_key=message_key, message=message)
+
+
+class FakeMeeting:
+    def __init__(self, meeting_id: str, name: str, participants: int = 0):
+        self.meeting_id = meeting_id
+        self.name = name
+        self.create_time = int(time.time() * 1000)
+        self.internal_id = f"{hashlib.sha1(meeting_id.encode()).hexdigest()}-{self.create_time}"
+        self.participants = participants
+
+    def to_xml(self) -> str:
+        return (f"<meetingName>{escape(self.name)}</meetingName><meetingID>{escape(self.meeting_id)}</meetingID>"
+                f"<internalMeetingID>{self.internal_id}</internalMeetingID><createTime>{self.create_time}</createTime>"
+                f"<running>true</running><participantCount>{self.participants}</participantCount>"
+                f"<listenerCount>{self.participants // 2}</listenerCount>"
+                f"<voiceParticipantCount>0</voiceParticipantCount>"
+                f"<videoCount>{self.participants // 4}</videoCount><moderatorCount>1</moderatorCount>"
+                f"<attendees></attendees><metadata></metadata>")
+
+
+class FakeNode:
+    """
+    A single fake bigbluebutton server
+
+    :param secret: the shared secret checksums are validated with
+    :param latency: mean seconds to wait before answering (exponentially distributed)
+    :param error_rate: fraction of requests answered with http status 500
+    :param meetings: number of meetings running from the start
+    """
+
+    def __init__(self, secret: str, latency: float = 0.0, error_rate: float = 0.0, meetings: int = 0):
+        self.secret = secret
+        self.latency = latency
+        self.error_rate = error_rate
+        self.meetings: Dict[str, FakeMeeting] = {}
+        self.recordings = set()
+        self.requests = 0
+        for i in range(meetings):
+            meeting = FakeMeeting(f"seeded-{i}", f"Seeded meeting {i}", participants=random.randint(1, 30))
+            self.meetings[meeting.meeting_id] = meeting
+            self.recordings.add(meeting.internal_id)
+
+    def check_checksum(self, call: str, query_string: str) -> bool:
+        match = _checksum_regex.search(query_string)
+        if match is None:
+            return False
+        checksum = match.group(1) or match.group(2)
+        string = call + _checksum_regex.sub("", query_string) + self.secret
+        return checksum in (hashlib.sha1(string.encode()).hexdigest(), hashlib.sha256(string.encode()).hexdigest())
+
+    def handle(self, call: str, params: dict) -> str:
+        handler = getattr(self, f"api_{call}", None)
+        if handler is None:
+            return _failed("unsupportedRequest", "This request is not supported.")
+        return handler(params)
+
+    def _meeting(self, params: dict) -> Optional[FakeMeeting]:
+        return self.meetings.get(params.get("meetingID", ""))
+
+    def api_(self, params: dict) -> str:
+        return _xml(body="<version>2.4</version>")
+
+    def api_create(self, params: dict) -> str:
+        if "meetingID" not in params:
+            return _failed("missingParamMeetingID", "You must specify a meeting ID for the meeting.")
+        meeting = self._meeting(params)
+        warning = ""
+        if meeting is None:
+            meeting = FakeMeeting(params["meetingID"], params.get("name", params["meetingID"]))
+            self.meetings[meeting.meeting_id] = meeting
+            self.recordings.add(meeting.internal_id)
+        else:
+            warning = ("<messageKey>duplicateWarning</messageKey>"
+                       "<message>This conference was already in existence and may currently be in progress.</message>")
+        return _xml(body=f"<meetingID>{escape(meeting.meeting_id)}</meetingID>"
+                         f"<internalMeetingID>{meeting.internal_id}</internalMeetingID>"
+                         f"<createTime>{meeting.create_time}</createTime>"
+                         f"<hasBeenForciblyEnded>false</hasBeenForciblyEnded>"
+                         + warning)
+
+    def api_end(self, params: dict) -> str:
+        if self.meetings.pop(params.get("meetingID", ""), None) is None:
+            return _failed("notFound", "We could not find a meeting with that meeting ID")
+        return _xml(message_key="sentEndMeetingRequest", message="A request to end the meeting was sent.")
+
+    def api_join(self, params: dict) -> str:
+        meeting = self._meeting(params)
+        if meeting is None:
+            return _failed("invalidMeetingIdentifier",
+                           "The meeting ID that you supplied did not match any existing meetings")
+        meeting.participants += 1
+        return _xml(body=f"<meeting_id>{meeting.internal_id}</meeting_id>", message_key="successfullyJoined",
+                    message="You have joined successfully.")
+
+    def api_isMeetingRunning(self, params: dict) -> str:
+        return _xml(body=f"<running>{'true' if self._meeting(params) else 'false'}</running>")
+
+    def api_getMeetingInfo(self, params: dict) -> str:
+        meeting = self._meeting(params)
+        if meeting is None:
+            return _failed("notFound", "A meeting with that ID does not exist")
+        return _xml(body=meeting.to_xml())
+
+    def api_getMeetings(self, params: dict) -> str:
+        if not self.meetings:
+            return _xml(body="<meetings/>", message_key="noMeetings", message="no meetings were found on this server")
+        meetings = "".join(f"<meeting>{meeting.to_xml()}</meeting>" for meeting in self.meetings.values())
+        return _xml(body=f"<meetings>{meetings}</meetings>")
+
+    def _recording_call(self, params: dict, result: str) -> str:
+        if "recordID" not in params:
+            return _failed("missingParamRecordID", "You must specify a recordID.")
+        if not all(record_id in self.recordings for record_id in params["recordID"].split(",")):
+            return _failed("notFound", "We could not find recordings")
+        return _xml(body=f"<{result}>true</{result}>")
+
+    def api_publishRecordings(self, params: dict) -> str:
+        return self._recording_call(params, "published")
+
+    def api_updateRecordings(self, params: dict) -> str:
+        return self._recording_call(params, "updated")
+
+
+class FakeCluster:
+    """
+    ASGI app dispatching requests to the node listening on the port they arrived on
+    """
+
+    def __init__(self, nodes: Dict[int, FakeNode]):
+        self.nodes = nodes
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return
+
+        body = b""
+        more_body = True
+        while more_body:
+            message = await receive()
+            body += message.get("body", b"")
+            more_body = message.get("more_body", False)
+
+        node = self.nodes[scope["server"][1]]
+        node.requests += 1
+        if node.latency:
+            await asyncio.sleep(random.expovariate(1 / node.latency))
+
+        if random.random() < node.error_rate:
+            status, content = 500, b"Internal Server Error"
+        else:
+            call = scope["path"].rstrip("/").rsplit("/", 1)[-1]
+            call = "" if call == "api" else call
+            query_string = scope["query_string"].decode()
+            if call and not node.check_checksum(call, query_string):
+                content = _failed("checksumError", "You did not pass the checksum security check")
+            else:
+                params = dict(parse_qsl(query_string))
+                params.update(parse_qsl(body.decode()))
+                content = node.handle(call, params)
+            status, content = 200, content.encode()
+
+        await send({"type": "http.response.start", "status": status,
+                    "headers": [(b"content-type", b"text/xml"), (b"content-length", str(len(content)).encode())]})
+        await send({"type": "http.response.body", "body": content})
+
+
+def _parse_node_options(option: str):
+    port, _, settings = option.partition(":")
+    values = {}
+    for setting in filter(None, settings.split(",")):
+        key, _, value = setting.partition("=")
+        values[key] = int(value) if key == "meetings" else float(value)
+    return int(port), values
+
+
+def _socket(host: str, port: int) -> socket.socket:
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(1024)
+    return sock
+
+
+def register(nodes: Dict[int, dict], host: str, secret: str):
+    """
+    Add the nodes to the loadbalancer's database as servers numbered from 0
+    """
+    import django
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "bbb_loadbalancer.settings")
+    django.setup()
+    from common_files.models import BBBServer
+
+    for server_id, port in enumerate(nodes):
+        BBBServer.objects.update_or_create(server_id=server_id, defaults=dict(
+            url=f"http://{host}:{port}/bigbluebutton/", secret=secret, state=BBBServer.ENABLED, unreachable=0,
+        ))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a cluster of fake bigbluebutton servers")
+    parser.add_argument("--nodes", type=int, default=3, help="number of nodes")
+    parser.add_argument("--host", default="127.0.0.1", help="address to listen on")
+    parser.add_argument("--first-port", type=int, default=18001, help="port of the first node, the others follow")
+    parser.add_argument("--secret", default="fake-secret", help="shared secret of all nodes")
+    parser.add_argument("--latency", type=float, default=0.02, help="mean response time in seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests failing with status 500")
+    parser.add_argument("--meetings", type=int, default=0, help="meetings running on each node from the start")
+    parser.add_argument("--node", action="append", default=[], metavar="PORT:KEY=VALUE,...",
+                        help="override latency, error_rate or meetings of a single node, e.g. 18003:latency=1.5")
+    parser.add_argument("--register", action="store_true", help="add the nodes to the loadbalancer's database")
+    args = parser.parse_args()
+
+    nodes = {}
+    for port in range(args.first_port, args.first_port + args.nodes):
+        nodes[port] = dict(latency=args.latency, error_rate=args.error_rate, meetings=args.meetings)
+    for option in args.node:
+        port, values = _parse_node_options(option)
+        nodes[port].update(values)
+    cluster = FakeCluster({port: FakeNode(args.secret, **options) for port, options in nodes.items()})
+
+    if args.register:
+        register(nodes, args.host, args.secret)
+    for server_id, (port, options) in enumerate(nodes.items()):
+        print(f"#{server_id}: http://{args.host}:{port}/bigbluebutton/ {options}")
+
+    config = uvicorn.Config(cluster, log_level="warning", lifespan="off", access_log=False)
+    uvicorn.Server(config).run(sockets=[_socket(args.host, port) for port in nodes])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+import asyncio
+import time
+from contextvars import ContextVar
+from typing import List, Optional
+
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.utils.decorators import sync_and_async_middleware
+
+from common_files import metrics
+
+# Number of queries and seconds spent in them by the current request
+_queries: ContextVar[Optional[List]] = ContextVar("queries", default=None)
+
+
+def _count_query(execute, sql, params, many, context):
+    queries = _queries.get()
+    if queries is None:
+        return execute(sql, params, many, context)
+
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        queries[0] += 1
+        queries[1] += time.perf_counter() - start
+
+
+def _instrument_connection(sender, connection, **kwargs):
+    if _count_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_count_query)
+
+
+connection_created.connect(_instrument_connection, dispatch_uid="monitoring.middleware")
+
+
+def _observe(request, queries: List, seconds: float):
+    match = getattr(request, "resolver_match", None)
+    endpoint = match.route if match is not None else "unmatched"
+    metrics.request_duration.labels(endpoint).observe(seconds)
+    metrics.request_queries.labels(endpoint).observe(queries[0])
+    metrics.request_query_duration.labels(endpoint).observe(queries[1])
+
+
+@sync_and_async_middleware
+def metrics_middleware(get_response):
+    """
+    Record each request's duration and its database queries in common_files.metrics
+    """
+    # Connections opened before this middleware was loaded
+    for connection in connections.all():
+        _instrument_connection(None, connection)
+
+    if asyncio.iscoroutinefunction(get_response):
+        async def middleware(request):
+            queries = [0, 0.0]
+            token = _queries.set(queries)
+            start = time.perf_counter()
+            try:
+                response = await get_response(request)
+            finally:
+                _queries.reset(token)
+            _observe(request, queries, time.perf_counter() - start)
+            return response
+    else:
+        def middleware(request):
+            queries = [0, 0.0]
+            token = _queries.set(queries)
+            start = time.perf_counter()
+            try:
+                response = get_response(request)
+            finally:
+                _queries.reset(token)
+            _observe(request, queries, time.perf_counter() - start)
+            return response
+
+    return middleware
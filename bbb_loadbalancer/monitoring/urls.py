@@ -1,9 +1,12 @@
 from django.urls import path
 
 from api.views import *
-from monitoring.views import GetServers
+from monitoring.views import GetMetrics, GetServerLoad, GetServers, GetUpstreamPool
 
 urlpatterns = [
     path("getServers", GetServers.as_view(endpoint="getServers")),
+    path("getServerLoad", GetServerLoad.as_view(endpoint="getServerLoad")),
+    path("getUpstreamPool", GetUpstreamPool.as_view(endpoint="getUpstreamPool")),
+    path("metrics", GetMetrics.as_view()),
 ]
 
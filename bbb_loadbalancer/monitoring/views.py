@@ -1,14 +1,23 @@
+import hmac
 import json
 
 from django.conf import settings
-from django.http import JsonResponse
+from django.core.cache import cache
+from django.db.models import Count
+from django.http import HttpResponse, JsonResponse
 from django.utils.decorators import method_decorator
 from django.views import View
 from django.views.decorators.csrf import csrf_exempt
+from prometheus_client import CONTENT_TYPE_LATEST
 from rc_protocol import validate_checksum
 
+from api.bbb_api import get_pool_statistics
+from common_files import metrics
+from common_files.config import LoadBalancerConfig
 from common_files.models import BBBServer
 
+config = LoadBalancerConfig.from_json("../config.json")
+
 
 @method_decorator(csrf_exempt, name='dispatch')
 class RcpApi(View):
@@ -52,15 +61,83 @@ class RcpApi(View):
         raise NotImplementedError
 
 
+def _cached(key: str, compute):
+    """
+    Get a result shared by all workers for monitoring.cache_ttl seconds, so frequent scrapes don't hit the database
+    """
+    result = cache.get(key)
+    if result is None:
+        result = compute()
+        cache.set(key, result, config.monitoring.cache_ttl)
+    return result
+
+
+def _count_servers() -> dict:
+    counts = dict(BBBServer.objects.values_list("state").annotate(count=Count("id")))
+    return {
+        "disabled": counts.get(BBBServer.DISABLED, 0),
+        "enabled": counts.get(BBBServer.ENABLED, 0),
+        "panic": counts.get(BBBServer.PANIC, 0),
+        "total": sum(counts.values()),
+    }
+
+
+def _server_load() -> list:
+    servers = BBBServer.with_running_meetings().order_by("server_id")
+    return [{
+        "serverID": server.server_id,
+        "state": server.state,
+        "unreachable": server.unreachable,
+        "runningMeetings": server.running_meetings,
+        "load": server.running_load,
+        "capacity": server.capacity,
+        "participants": server.participants,
+        "videoStreams": server.video_streams,
+        "cpuLoad": server.cpu_load,
+        "usageUpdated": server.usage_updated,
+        "lastPoll": server.last_poll,
+        "lastPollResult": server.last_poll_result,
+    } for server in servers]
+
+
 class GetServers(RcpApi):
 
     def inner_get(self, request, params):
-        return JsonResponse({"success": True, "info": "Ok", "servers": {
-            "disabled": BBBServer.objects.filter(state=BBBServer.DISABLED).count(),
-            "enabled": BBBServer.objects.filter(state=BBBServer.ENABLED).count(),
-            "panic": BBBServer.objects.filter(state=BBBServer.PANIC).count(),
-            "total": BBBServer.objects.count(),
-        }})
+        return JsonResponse({"success": True, "info": "Ok", "servers": _cached("monitoring:servers", _count_servers)})
+
+    def inner_post(self, request, params):
+        raise NotImplementedError
+
+
+class GetServerLoad(RcpApi):
+
+    def inner_get(self, request, params):
+        return JsonResponse({"success": True, "info": "Ok",
+                             "servers": _cached("monitoring:server_load", _server_load)})
+
+    def inner_post(self, request, params):
+        raise NotImplementedError
+
+
+class GetUpstreamPool(RcpApi):
+
+    def inner_get(self, request, params):
+        return JsonResponse({"success": True, "info": "Ok", "pool": get_pool_statistics()})
 
     def inner_post(self, request, params):
         raise NotImplementedError
+
+
+class GetMetrics(View):
+    """
+    Prometheus' exposition of common_files.metrics
+
+    Prometheus can't compute rc-protocol checksums, so this endpoint uses a bearer token instead.
+    """
+
+    def get(self, request, *args, **kwargs):
+        authorization = request.headers.get("Authorization", "")
+        if not hmac.compare_digest(authorization.encode(), f"Bearer {settings.MONITORING_METRICS_TOKEN}".encode()):
+            return JsonResponse({"success": False, "info": "Authentication failed"}, status=401)
+
+        return HttpResponse(metrics.generate(), content_type=CONTENT_TYPE_LATEST)
@@ -0,0 +1,119 @@
+"""
+Compare placement strategies offline
+
+Places a synthetic or exported workload with every strategy and reports per strategy:
+the peak load of the busiest server, the imbalance between the enabled servers
+(how far the busiest server's weighted load is above the average, averaged over time and at its peak),
+meetings moved because of panic events and the time get_next_server took per decision.
+
+Usage (from the bbb_loadbalancer directory):
+    python -m simulator --servers 10 --meetings 5000 --hours 24
+    python -m simulator --workload workload.jsonl --event 9h:panic:3 --event 12h:enable:3
+
+Strategies from other modules can be added with --strategy-module,
+they register themselves with api.placement's strategy decorator.
+"""
+import os
+import django
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'benchmarks.settings')
+django.setup()
+
+import argparse
+import importlib
+import json
+import sys
+import time
+
+from django.db import connection
+
+from api import placement
+from simulator import workload
+from simulator.engine import ACTIONS, Event, Simulation
+
+
+def seconds(string: str) -> float:
+    """
+    Parse a point in time like 90, 90s, 15m or 2.5h
+    """
+    units = {"s": 1, "m": 60, "h": 3600}
+    if string[-1:] in units:
+        return float(string[:-1]) * units[string[-1]]
+    return float(string)
+
+
+def event(string: str) -> Event:
+    """
+    Parse an event like 9h:panic:3
+    """
+    try:
+        at, action, server_id = string.split(":")
+        if action not in ACTIONS:
+            raise ValueError
+        return Event(seconds(at), action, int(server_id))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected TIME:{'|'.join(ACTIONS)}:SERVER_ID, got '{string}'")
+
+
+def print_report(results: list):
+    print(f"{'strategy':<22}{'placed':>8}{'rejected':>9}{'moves':>7}{'peak load':>10}{'peak wload':>11}"
+          f"{'imbalance':>10}{'peak imb':>9}{'p50 us':>9}{'p99 us':>9}")
+    for result in results:
+        print(f"{result['strategy']:<22}{result['placed']:>8}{result['rejected']:>9}{result['moves']:>7}"
+              f"{result['peak_load']:>10}{result['peak_weighted_load']:>11}{result['imbalance']:>10}"
+              f"{result['peak_imbalance']:>9}{result['decision_p50_us']:>9}{result['decision_p99_us']:>9}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate placing meetings with different strategies")
+    parser.add_argument("--workload", help="workload file (see simulator/workload.py) instead of a synthetic one")
+    parser.add_argument("--meetings", type=int, default=2000, help="number of synthetic meetings")
+    parser.add_argument("--hours", type=float, default=24, help="hours the synthetic meetings arrive in")
+    parser.add_argument("--servers", type=int, help="number of servers (defaults to the workload's or 10)")
+    parser.add_argument("--capacities", type=lambda string: [float(part) for part in string.split(",")],
+                        help="comma separated capacities the servers cycle through, e.g. 1,1,2")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the synthetic workload and the strategies")
+    parser.add_argument("--save", help="write the simulated workload to this file")
+    parser.add_argument("--event", type=event, action="append", default=[], metavar="TIME:ACTION:SERVER_ID",
+                        help=f"change a server's state, action is one of {', '.join(ACTIONS)} (e.g. 2h:panic:3)")
+    parser.add_argument("--strategy", action="append", help="strategy to simulate (defaults to all)")
+    parser.add_argument("--strategy-module", action="append", default=[],
+                        help="import this module to register additional strategies")
+    parser.add_argument("--json", action="store_true", help="print the results as json")
+    args = parser.parse_args()
+
+    for module in args.strategy_module:
+        importlib.import_module(module)
+    strategies = args.strategy or list(placement.strategies)
+    for name in strategies:
+        if name not in placement.strategies:
+            parser.error(f"unknown strategy '{name}', known are: {', '.join(placement.strategies)}")
+
+    if args.workload:
+        servers, arrivals = workload.load(args.workload)
+    else:
+        servers, arrivals = [], workload.synthetic(args.meetings, args.hours, args.seed)
+    if args.servers is not None or not servers:
+        servers = workload.uniform_servers(args.servers or 10, args.capacities)
+    if args.save:
+        workload.save(args.save, servers, arrivals)
+
+    connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    results = []
+    try:
+        for name in strategies:
+            start = time.perf_counter()
+            results.append(Simulation(servers, arrivals, sorted(args.event), name, args.seed).run())
+            print(f"Simulated {name} in {time.perf_counter() - start:.1f}s", file=sys.stderr)
+    finally:
+        connection.creation.destroy_test_db(connection.settings_dict["NAME"], verbosity=0)
+
+    if args.json:
+        print(json.dumps({"servers": len(servers), "meetings": len(arrivals), "events": args.event,
+                          "results": results}, indent=2))
+    else:
+        print_report(results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,214 @@
+"""
+Discrete-event simulation of meeting placement
+
+The servers are real BBBServer rows (in the database of benchmarks/settings.py) and every meeting
+is placed by api.logic.get_next_server, like create does, with placement.strategy set to the simulated strategy.
+The meetings themselves are only kept in memory. Live usage (participants and video streams)
+is updated immediately instead of on the next poll.
+
+Events change a server's state at a point in time:
+    panic   the server is set to PANIC and its meetings are moved to other servers (like cli panic)
+    disable the server is set to DISABLED, its meetings keep running
+    enable  the server is set to ENABLED
+"""
+import heapq
+import random
+import time
+from typing import Dict, List, NamedTuple, Optional
+
+from api import placement
+from api.logic import get_next_server
+from common_files.models import BBBServer
+from simulator.workload import MeetingArrival, Server
+
+ACTIONS = {
+    "panic": BBBServer.PANIC,
+    "disable": BBBServer.DISABLED,
+    "enable": BBBServer.ENABLED,
+}
+
+# Order of simultaneous events: state changes before meetings ending before meetings arriving
+_EVENT, _END, _ARRIVAL = range(3)
+
+
+class Event(NamedTuple):
+    time: float
+    action: str
+    server_id: int
+
+
+class _RunningMeeting:
+    __slots__ = ("arrival", "server", "ended")
+
+    def __init__(self, arrival: MeetingArrival, server: BBBServer):
+        self.arrival = arrival
+        self.server = server
+        self.ended = False
+
+
+def _percentile(values: List[float], percent: float) -> float:
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(percent / 100 * len(values)))]
+
+
+class Simulation:
+    """
+    Simulate placing a workload's meetings with one strategy
+
+    :param servers: the servers' ids and capacities
+    :param arrivals: the meetings in order of their arrival
+    :param events: state changes of servers
+    :param strategy: name of a strategy registered in api.placement
+    :param seed: seed of the strategies' random numbers
+    """
+
+    def __init__(self, servers: List[Server], arrivals: List[MeetingArrival], events: List[Event],
+                 strategy: str, seed: int = 0):
+        self.arrivals = arrivals
+        self.events = events
+        self.strategy = strategy
+        self.seed = seed
+
+        BBBServer.objects.all().delete()
+        BBBServer.objects.bulk_create([BBBServer(server_id=server_id, url=f"https://bbb{server_id}.example.org/",
+                                                 capacity=capacity)
+                                       for server_id, capacity in servers])
+        self.servers: Dict[int, BBBServer] = {server.server_id: server for server in BBBServer.objects.all()}
+        self.meetings: Dict[int, List[_RunningMeeting]] = {server_id: [] for server_id in self.servers}
+        self.dirty = set()
+
+        # Statistics
+        self.decisions: List[float] = []
+        self.placed = 0
+        self.rejected = 0
+        self.moves = 0
+        self.failed_moves = 0
+        self.peak_load = {server_id: 0 for server_id in self.servers}
+        self.peak_weighted_load = {server_id: 0.0 for server_id in self.servers}
+        self.imbalance_time = 0.0
+        self.weighted_imbalance = 0.0
+        self.peak_imbalance = 0.0
+        self.now = 0.0
+
+    def _place(self, load: int) -> Optional[BBBServer]:
+        # Write the servers changed since the last decision, get_next_server reads them from the database
+        for server in self.dirty:
+            BBBServer.objects.filter(id=server.id).update(running_load=server.running_load, state=server.state,
+                                                          participants=server.participants,
+                                                          video_streams=server.video_streams)
+        self.dirty.clear()
+
+        start = time.perf_counter()
+        try:
+            server = get_next_server(load=load)
+        except IndexError:
+            server = None
+        self.decisions.append(time.perf_counter() - start)
+        return None if server is None else self.servers[server.server_id]
+
+    def _add(self, meeting: _RunningMeeting, server: BBBServer):
+        meeting.server = server
+        self.meetings[server.server_id].append(meeting)
+        server.running_load += meeting.arrival.load
+        server.participants += meeting.arrival.participants
+        server.video_streams += meeting.arrival.video_streams
+        self.dirty.add(server)
+
+        self.peak_load[server.server_id] = max(self.peak_load[server.server_id], server.running_load)
+        self.peak_weighted_load[server.server_id] = max(self.peak_weighted_load[server.server_id],
+                                                        placement.weighted_load(server))
+
+    def _remove(self, meeting: _RunningMeeting):
+        server = meeting.server
+        self.meetings[server.server_id].remove(meeting)
+        server.running_load -= meeting.arrival.load
+        server.participants -= meeting.arrival.participants
+        server.video_streams -= meeting.arrival.video_streams
+        self.dirty.add(server)
+
+    def _advance(self, now: float):
+        """Add the imbalance between the enabled servers since the last event to the time weighted average"""
+        loads = [placement.weighted_load(server) for server in self.servers.values()
+                 if server.state == BBBServer.ENABLED]
+        if loads and now > self.now:
+            imbalance = max(loads) - sum(loads) / len(loads)
+            self.weighted_imbalance += imbalance * (now - self.now)
+            self.imbalance_time += now - self.now
+            self.peak_imbalance = max(self.peak_imbalance, imbalance)
+        self.now = now
+
+    def _set_state(self, event: Event):
+        server = self.servers.get(event.server_id)
+        if server is None:
+            return
+        server.state = ACTIONS[event.action]
+        self.dirty.add(server)
+
+        # Move away all meetings on panic
+        if event.action == "panic":
+            for meeting in list(self.meetings[server.server_id]):
+                self._remove(meeting)
+                new_server = self._place(meeting.arrival.load)
+                if new_server is None:
+                    meeting.ended = True
+                    self.failed_moves += 1
+                else:
+                    self._add(meeting, new_server)
+                    self.moves += 1
+
+    def run(self) -> dict:
+        """
+        Run the simulation
+
+        :return: the simulation's statistics
+        :rtype: dict
+        """
+        old_strategy = placement.config.placement.strategy
+        placement.config.placement.strategy = self.strategy
+        random.seed(self.seed)
+
+        queue = [(event.time, _EVENT, i, event) for i, event in enumerate(self.events)]
+        queue += [(arrival.time, _ARRIVAL, i, arrival) for i, arrival in enumerate(self.arrivals)]
+        heapq.heapify(queue)
+        counter = len(queue)
+        try:
+            while queue:
+                now, kind, _, item = heapq.heappop(queue)
+                self._advance(now)
+                if kind == _EVENT:
+                    self._set_state(item)
+                elif kind == _END:
+                    if not item.ended:
+                        item.ended = True
+                        self._remove(item)
+                else:
+                    server = self._place(item.load)
+                    if server is None:
+                        self.rejected += 1
+                        continue
+                    meeting = _RunningMeeting(item, server)
+                    self._add(meeting, server)
+                    self.placed += 1
+                    counter += 1
+                    heapq.heappush(queue, (now + item.duration, _END, counter, meeting))
+        finally:
+            placement.config.placement.strategy = old_strategy
+
+        decisions = sorted(self.decisions)
+        return {
+            "strategy": self.strategy,
+            "meetings": len(self.arrivals),
+            "placed": self.placed,
+            "rejected": self.rejected,
+            "moves": self.moves,
+            "failed_moves": self.failed_moves,
+            "peak_load": max(self.peak_load.values(), default=0),
+            "peak_weighted_load": round(max(self.peak_weighted_load.values(), default=0), 2),
+            "imbalance": round(self.weighted_imbalance / self.imbalance_time, 3) if self.imbalance_time else 0.0,
+            "peak_imbalance": round(self.peak_imbalance, 3),
+            "decision_p50_us": round(_percentile(decisions, 50) * 1e6, 1),
+            "decision_p99_us": round(_percentile(decisions, 99) * 1e6, 1),
+            "decision_max_us": round(decisions[-1] * 1e6, 1) if decisions else 0.0,
+            "peak_load_per_server": {server_id: load for server_id, load in self.peak_load.items()},
+        }
@@ -0,0 +1,67 @@
+"""
+Export the servers and meetings of the loadbalancer's database as workload for the simulator
+
+The meeting table knows when a meeting was created and its load, but not how long it ran
+or how many participants it had, so these are drawn like in synthetic workloads.
+
+Usage (from the bbb_loadbalancer directory):
+    python -m simulator.export --days 7 --output workload.jsonl
+"""
+import os
+import django
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'bbb_loadbalancer.settings')
+django.setup()
+
+import argparse
+import random
+from datetime import datetime, timedelta, timezone
+
+from common_files.models import ArchivedMeeting, BBBServer, Meeting
+from simulator.workload import MeetingArrival, draw_duration, draw_usage, save
+
+
+def export(days: float, seed: int = 0) -> tuple:
+    """
+    Read the servers and the meetings created in the last days
+
+    :return: the servers and the meetings sorted by their arrival
+    """
+    rng = random.Random(seed)
+    since = datetime.now(tz=timezone.utc) - timedelta(days=days)
+    servers = list(BBBServer.objects.order_by("server_id").values_list("server_id", "capacity"))
+
+    # Meetings something was moved to are only the continuation of an earlier one
+    moved_to = set()
+    for model in (Meeting, ArchivedMeeting):
+        moved_to.update(model.objects.filter(created__gte=since, moved_to_id__isnull=False)
+                        .values_list("moved_to_id", flat=True).iterator())
+    created = []
+    for model in (Meeting, ArchivedMeeting):
+        created += [(timestamp, load) for pk, timestamp, load
+                    in model.objects.filter(created__gte=since).values_list("id", "created", "load").iterator()
+                    if pk not in moved_to]
+    created.sort()
+
+    arrivals = []
+    for timestamp, load in created:
+        participants, video_streams = draw_usage(rng, load)
+        arrivals.append(MeetingArrival((timestamp - created[0][0]).total_seconds(), draw_duration(rng),
+                                       load, participants, video_streams))
+    return servers, arrivals
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export meetings as workload for the placement simulator")
+    parser.add_argument("--days", type=float, default=7, help="export the meetings created in the last days")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the drawn durations and participants")
+    parser.add_argument("--output", required=True, help="workload file to write")
+    args = parser.parse_args()
+
+    servers, arrivals = export(args.days, args.seed)
+    save(args.output, servers, arrivals)
+    print(f"Exported {len(servers)} servers and {len(arrivals)} meetings to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+"""
+Workloads for the placement simulator
+
+A workload is a list of servers and a list of meetings arriving over time.
+Workload files contain one json object per line, either a server or a meeting:
+    {"server": 3, "capacity": 2.0}
+    {"time": 120.5, "duration": 2700, "load": 1, "participants": 12, "video_streams": 3}
+where time is the second the meeting arrives at relative to the start and duration how many seconds it runs.
+"""
+import json
+import math
+import random
+from typing import List, NamedTuple, Tuple
+
+# Relative number of meetings created per hour of the day
+HOURLY_RATES = (1, 0.5, 0.3, 0.3, 0.5, 1, 3, 8, 14, 16, 15, 12, 9, 12, 15, 14, 11, 8, 6, 5, 4, 3, 2, 1.5)
+
+
+class MeetingArrival(NamedTuple):
+    time: float
+    duration: float
+    load: int
+    participants: int
+    video_streams: int
+
+
+Server = Tuple[int, float]
+
+
+def draw_duration(rng: random.Random) -> float:
+    """
+    Draw a meeting's duration in seconds (log-normal around 45 minutes, between 1 minute and 8 hours)
+    """
+    return min(max(rng.lognormvariate(math.log(45 * 60), 0.7), 60), 8 * 60 * 60)
+
+
+def draw_usage(rng: random.Random, load: int) -> Tuple[int, int]:
+    """
+    Draw a meeting's number of participants and video streams, larger loads having more participants
+
+    :return: participants and video streams
+    """
+    participants = max(1, round(rng.lognormvariate(math.log(6 * load), 0.8)))
+    return participants, round(participants * rng.uniform(0, 0.3))
+
+
+def synthetic(meetings: int, hours: float, seed: int = 0) -> List[MeetingArrival]:
+    """
+    Generate meetings arriving over some hours, with more meetings during the working hours
+
+    :param meetings: number of meetings
+    :param hours: hours the arrivals are spread over
+    :param seed: seed of the random numbers, the same seed generates the same workload
+    :return: the meetings sorted by their arrival
+    """
+    rng = random.Random(seed)
+    hour_count = max(1, math.ceil(hours))
+    weights = [HOURLY_RATES[hour % 24] for hour in range(hour_count)]
+
+    arrivals = []
+    for hour in rng.choices(range(hour_count), weights, k=meetings):
+        time = min((hour + rng.random()) * 3600, hours * 3600)
+        load = rng.choice((1, 1, 1, 1, 2, 2, 5))
+        participants, video_streams = draw_usage(rng, load)
+        arrivals.append(MeetingArrival(time, draw_duration(rng), load, participants, video_streams))
+    arrivals.sort()
+    return arrivals
+
+
+def uniform_servers(count: int, capacities: List[float] = None) -> List[Server]:
+    """
+    Create servers numbered from 0, cycling through the capacities
+
+    :param count: number of servers
+    :param capacities: the servers' capacities (defaults to 1 for all)
+    """
+    capacities = capacities or [1]
+    return [(server_id, capacities[server_id % len(capacities)]) for server_id in range(count)]
+
+
+def load(path: str) -> Tuple[List[Server], List[MeetingArrival]]:
+    """
+    Read a workload file
+
+    :return: the servers and the meetings sorted by their arrival
+    """
+    servers, arrivals = [], []
+    with open(path) as file:
+        for line in file:
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            if "server" in entry:
+                servers.append((entry["server"], entry.get("capacity", 1)))
+            else:
+                arrivals.append(MeetingArrival(entry["time"], entry["duration"], entry.get("load", 1),
+                                               entry.get("participants", 0), entry.get("video_streams", 0)))
+    arrivals.sort()
+    return servers, arrivals
+
+
+def save(path: str, servers: List[Server], arrivals: List[MeetingArrival]):
+    """
+    Write a workload file
+    """
+    with open(path, "w") as file:
+        for server_id, capacity in servers:
+            file.write(json.dumps({"server": server_id, "capacity": capacity}) + "\n")
+        for arrival in arrivals:
+            file.write(json.dumps({**arrival._asdict(), "time": round(arrival.time, 3),
+                                   "duration": round(arrival.duration, 1)}) + "\n")
@@ -1,9 +1,14 @@
 import asyncio
 import logging
 import os
+import signal
+import time
 
-from bigbluebutton_api_python import BigBlueButton
-from bigbluebutton_api_python.exception import BBBException
+from asgiref.sync import sync_to_async
+
+from api.bbb_api import build_api_url
+from api.xml_stream import ItemsParser
+from common_files import health
 
 logger = logging.getLogger("poller")
 
@@ -24,18 +29,105 @@ class CheckResult:
         self.message = message
 
 
-def bbb_api_check(client, server_id, server_url, server_secret, unreachable):
+class Usage:
+    def __init__(self, *, participants=0, video_streams=0, cpu_load=None, meetings=None):
+        self.participants = participants
+        self.video_streams = video_streams
+        self.cpu_load = cpu_load
+        # Meetings running on the server, internal meeting ids mapped to meeting ids
+        self.meetings = meetings if meetings is not None else {}
+
+
+async def _run_shell(cmd):
+    """Run a shell command and return its return code and output, killing it if the check is cancelled"""
+    # In its own process group, so the ssh started by the script is killed together with the shell
+    proc = await asyncio.create_subprocess_shell(cmd, stdout=asyncio.subprocess.PIPE, start_new_session=True)
+    try:
+        stdout, _ = await proc.communicate()
+    except asyncio.CancelledError:
+        if proc.returncode is None:
+            os.killpg(proc.pid, signal.SIGKILL)
+            await proc.wait()
+        raise
+    return proc.returncode, stdout
+
+
+def _count(server, meeting, field):
+    """Read a count of a getMeetings meeting, counting values which aren't numbers as 0"""
+    value = meeting.get(field) or 0
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        logger.warning(f"Usage: #{server.server_id}: Invalid {field} of {meeting.get('meetingID')}: {value!r}")
+        return 0
+
+
+def usage_probe(client, server):
+
+    async def collect_usage():
+        usage = Usage()
+
+        try:
+            parser = ItemsParser(["meetingID", "internalMeetingID", "participantCount", "videoCount"])
+            async with client.stream("GET", build_api_url(server, "getMeetings")) as ret:
+                async for chunk in ret.aiter_bytes():
+                    parser.feed(chunk)
+            response = parser.close()
+        except Exception as exc:
+            logger.error(f"Usage: #{server.server_id}: Exception during getMeetings: {exc.__repr__()}")
+            return None
+        if response.get("returncode") != "SUCCESS":
+            logger.error(f"Usage: #{server.server_id}: getMeetings failed: {response.get('messageKey')}")
+            return None
+
+        for meeting in response.get("meetings", {}).get("meeting", []):
+            usage.participants += _count(server, meeting, "participantCount")
+            usage.video_streams += _count(server, meeting, "videoCount")
+            usage.meetings[meeting.get("internalMeetingID", "")] = meeting.get("meetingID", "")
+
+        return usage
+
+    return collect_usage
+
+
+def cpu_probe(server, cmd, timeout):
+
+    async def read_cpu_load():
+        """Get the server's cpu load in percent or None if it couldn't be read within timeout seconds"""
+        try:
+            _, stdout = await asyncio.wait_for(_run_shell(cmd), timeout)
+        except asyncio.TimeoutError:
+            logger.error(f"Usage: #{server.server_id}: Reading the cpu load timed out after {timeout}s")
+            return None
+
+        output = stdout.decode("utf-8", "replace")
+        try:
+            load_average, cpus = output.split()
+            return float(load_average) / int(cpus) * 100
+        except (ValueError, ZeroDivisionError):
+            logger.error(f"Usage: #{server.server_id}: Couldn't read cpu load: {output.strip()}")
+            return None
+
+    return read_cpu_load
+
+
+def bbb_api_check(client, server_id, server_url, server_secret, unreachable, server_pk):
 
     async def check_api_reachability():
+        start = time.monotonic()
         try:
             ret = await client.request("GET", os.path.join(server_url, "api"))
-            if ret.status_code == 200:
-                return CheckResult(0, "API is reachable")
-            else:
-                return CheckResult(1, f"Status code: {ret.status_code}")
         except Exception as exc:
+            await sync_to_async(health.record_error, thread_sensitive=False)(server_pk)
             return CheckResult(1, f"Exception during request: {exc.__repr__()}")
 
+        if ret.status_code == 200:
+            await sync_to_async(health.record_latency, thread_sensitive=False)(server_pk, time.monotonic() - start)
+            return CheckResult(0, "API is reachable")
+        else:
+            await sync_to_async(health.record_error, thread_sensitive=False)(server_pk)
+            return CheckResult(1, f"Status code: {ret.status_code}")
+
     return Check(
         check_name="API Reachability",
         server_id=server_id,
@@ -49,10 +141,9 @@ def bbb_api_check(client, server_id, server_url, server_secret, unreachable):
 def process_check(file, cmd, server_id, server_url, server_secret, unreachable):
 
     async def execute_file_check():
-        proc = await asyncio.create_subprocess_shell(cmd, stdout=asyncio.subprocess.PIPE)
-        stdout, _ = await proc.communicate()
+        return_code, stdout = await _run_shell(cmd)
         return CheckResult(
-            proc.returncode,
+            return_code,
             stdout.decode("utf-8").strip()
         )
 
@@ -64,19 +155,3 @@ def process_check(file, cmd, server_id, server_url, server_secret, unreachable):
         unreachable=unreachable,
         task=execute_file_check
     )
-
-
-def get_running_meetings(meeting_id, server):
-    async def execute_request():
-        b = BigBlueButton(server.url, server.secret)
-        try:
-            await asyncio.sleep(0.01)
-            b.get_meeting_info(meeting_id)
-        except BBBException as exc:
-            logger.info(f"BBBException while get meeting info: {exc.__repr__()}")
-            return False
-        except Exception as exc:
-            logger.error(f"Exception while retrieving running meeting: {exc.__repr__()}")
-            return True
-        return True
-    return execute_request
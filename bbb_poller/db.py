@@ -1,37 +1,33 @@
-import concurrent.futures
 import logging
 import multiprocessing
-from datetime import datetime, timedelta
+from datetime import datetime, timezone
+
+from asgiref.sync import sync_to_async
 
 from cli.set_state import set_state
+from common_files.archive import archive_ended_meetings
 from common_files.models import *
 
 logger = logging.getLogger(__name__)
 
 
-def execute_task(task):
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        future = executor.submit(task)
-        return future.result()
+async def execute_task(task):
+    """Run a task in the database thread without blocking the event loop"""
+    return await sync_to_async(task)()
 
 
 def get_servers():
     return [x for x in BBBServer.objects.all()]
 
 
-def get_meetings():
-    return [x for x in Meeting.objects.filter(ended=False)
-            .exclude(internal_id=Meeting.TEMP_INTERNAL_ID)
-            .exclude(created__gt=datetime.utcnow() - timedelta(seconds=10))]
-
+def get_running_meetings(server_pk):
+    def read_from_db():
+        return list(Meeting.running.filter(server_id=server_pk)
+                    .values_list("id", "meeting_id", "internal_id", "created"))
+    return read_from_db
 
-def get_server_for_meeting(meeting_id):
-    def get_from_db():
-        return Meeting.objects.get(meeting_id=meeting_id, ended=False).server
-    return get_from_db
 
-
-def set_server_reachability(reachability: bool, server_id):
+def set_server_reachability(reachability: bool, server_id, result=""):
     def write_to_db():
         try:
             server = BBBServer.objects.get(server_id=server_id)
@@ -57,18 +53,37 @@ def set_server_reachability(reachability: bool, server_id):
                 if server.state == server.PANIC and server.reachable == 20:
                     server.state = server.ENABLED
                     logger.info(f"Server #{server.server_id} is enabled again")
-            server.save(force_update=True)
+            server.last_poll = datetime.now(tz=timezone.utc)
+            server.last_poll_result = result[:255]
+            # Only the poller's fields, the api keeps running_load up to date concurrently
+            server.save(update_fields=["reachable", "unreachable", "state", "last_poll", "last_poll_result"])
         except BBBServer.DoesNotExist:
             pass
     return write_to_db
 
 
-def set_meeting_ended(meeting_id):
+def set_server_usage(server_id, usage):
     def write_to_db():
-        try:
-            meeting = Meeting.objects.get(meeting_id=meeting_id, ended=False)
-            meeting.ended = True
-            meeting.save(force_update=True)
-        except Meeting.DoesNotExist:
-            pass
+        BBBServer.objects.filter(server_id=server_id).update(
+            participants=usage.participants,
+            video_streams=usage.video_streams,
+            cpu_load=usage.cpu_load,
+            usage_updated=datetime.now(tz=timezone.utc),
+        )
+    return write_to_db
+
+
+def set_meetings_ended(meeting_pks):
+    def write_to_db():
+        return Meeting.running.filter(id__in=meeting_pks).mark_ended()
+    return write_to_db
+
+
+def reconcile_running_load():
+    return BBBServer.reconcile_running_load()
+
+
+def archive_meetings(batch_size, max_batches):
+    def write_to_db():
+        return archive_ended_meetings(batch_size=batch_size, max_batches=max_batches)
     return write_to_db
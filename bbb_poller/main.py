@@ -2,7 +2,6 @@ import asyncio
 import logging
 import logging.handlers
 import os
-import zlib
 import socket
 
 import django
@@ -12,21 +11,12 @@ import settings
 logger = logging.getLogger(__name__)
 
 
-def namer(name):
-    return name + ".gz"
-
-
-def rotator(source, dest):
-    with open(source, "rb") as sf:
-        data = sf.read()
-        compressed = zlib.compress(data, 9)
-        with open(dest, "wb") as df:
-            df.write(compressed)
-    os.remove(source)
-
-
 async def main():
-    rotating_handler = logging.handlers.TimedRotatingFileHandler(
+    from common_files.log import JsonFormatter, QueuedHandler, gzip_namer, gzip_rotator
+
+    # Written in a background thread, rotated files are gzipped in another one
+    handler = QueuedHandler(
+        "logging.handlers.TimedRotatingFileHandler",
         filename=os.path.join(settings.config.log_dir, "poller.log"),
         # sunday
         when="W6",
@@ -34,14 +24,16 @@ async def main():
         utc=True,
         encoding="utf-8"
     )
-    rotating_handler.rotator = rotator
-    rotating_handler.namer = namer
+    handler.target.rotator = gzip_rotator
+    handler.target.namer = gzip_namer
+    if settings.config.log_format == "json":
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter('%(asctime)s :: %(levelname)s: %(message)s', '%d-%m-%Y %H:%M:%S'))
 
     logging.basicConfig(
-        format='%(asctime)s :: %(levelname)s: %(message)s',
-        datefmt='%d-%m-%Y %H:%M:%S',
         level=logging.INFO,
-        handlers=[rotating_handler]
+        handlers=[handler]
     )
 
     from scheduler import Scheduler
@@ -0,0 +1,7 @@
+#!/bin/bash
+
+SSH_SERVER=$1
+SSH_USER=$2
+
+# Prints the 1 minute load average and the number of cpus
+ssh -o ConnectTimeout=5 $SSH_USER@$SSH_SERVER 'echo $(cut -d " " -f 1 /proc/loadavg) $(nproc)'
\ No newline at end of file
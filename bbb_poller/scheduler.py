@@ -1,18 +1,24 @@
 import asyncio
 import logging
 import os
+import random
+import time
+from datetime import datetime, timedelta, timezone
 
 import httpx
 
 import checks
 import db
 import settings
+from common_files import metrics
+from common_files.models import Meeting
 
 logger = logging.getLogger(__name__)
 
 
 async def _execute_checks(server_id, check_list):
     server_online = True
+    result = "OK"
     for check in check_list:
         for i in range(1, 4):
             ret: checks.CheckResult = await check.task()
@@ -24,32 +30,83 @@ async def _execute_checks(server_id, check_list):
                 await asyncio.sleep(1)
         else:
             server_online = False
+            result = f"{check.check_name}: {ret.message}"
             logger.error(f"{check.check_name}: #{check.server_id}: failed")
             logger.error(f"Skipping all remaining checks")
             logger.debug("Writing to db...")
             break
     if not server_online:
         logger.debug("Writing to db...")
-    db.execute_task(db.set_server_reachability(server_online, server_id))
+    await db.execute_task(db.set_server_reachability(server_online, server_id, result))
 
 
-async def _execute_meeting(meeting):
-    server = db.execute_task(db.get_server_for_meeting(meeting.meeting_id))
-    ret = await checks.get_running_meetings(meeting.meeting_id, server)()
-    if not ret:
-        logger.info(f"Meeting {meeting.meeting_id} ended on server {server.server_id}")
-        logger.debug(f"Writing to db...")
-        db.execute_task(db.set_meeting_ended(meeting.meeting_id))
+async def _execute_usage(server, probe, cpu_probe):
+    started = datetime.now(tz=timezone.utc)
+    usage = await probe()
+    if usage is None:
+        return
+    # Before reading the cpu load over ssh, so an unreachable ssh doesn't keep ended meetings running
+    await _reconcile_meetings(server, usage.meetings, started)
+
+    usage.cpu_load = await cpu_probe()
+    logger.info(f"Usage: #{server.server_id}: {usage.participants} participants, {usage.video_streams} videos, "
+                f"cpu {usage.cpu_load}%")
+    await db.execute_task(db.set_server_usage(server.server_id, usage))
+
+
+async def _reconcile_meetings(server, found, started):
+    """
+    Compare the meetings running on a server with the database
+
+    Meetings the server doesn't know anymore are marked as ended in one update,
+    meetings the loadbalancer doesn't know are logged.
+
+    :param server: the server
+    :param found: the meetings getMeetings returned, internal meeting ids mapped to meeting ids
+    :param started: when getMeetings was sent
+    """
+    running = await db.execute_task(db.get_running_meetings(server.id))
+
+    # Meetings still being created or created shortly before the call might not be listed yet
+    created_before = started - timedelta(seconds=10)
+    vanished = [(pk, meeting_id) for pk, meeting_id, internal_id, created in running
+                if internal_id not in found and internal_id != Meeting.TEMP_INTERNAL_ID and created < created_before]
+    if vanished:
+        ended = await db.execute_task(db.set_meetings_ended([pk for pk, _ in vanished]))
+        metrics.poller_meetings_ended.labels(str(server.server_id)).inc(ended)
+        logger.info(f"Meetings: #{server.server_id}: {ended} meetings ended: "
+                    f"{', '.join(meeting_id for _, meeting_id in vanished)}")
+
+    internal_ids = {internal_id for _, _, internal_id, _ in running}
+    meeting_ids = {meeting_id for _, meeting_id, _, _ in running}
+    unknown = [meeting_id for internal_id, meeting_id in found.items()
+               if internal_id not in internal_ids and meeting_id not in meeting_ids]
+    metrics.poller_unknown_meetings.labels(str(server.server_id)).set(len(unknown))
+    if unknown:
+        logger.warning(f"Meetings: #{server.server_id}: {len(unknown)} meetings not created by the loadbalancer: "
+                       f"{', '.join(unknown)}")
 
 
 class Scheduler:
     """Executes tasks.
 
     Tasks have to be Checks in every case.
+
+    Every cycle starts the checks and the usage probe of each server. The usage probe's getMeetings call
+    is also used to end the meetings which aren't running on the server anymore.
+    At most poller.concurrency of them run at the same time, each starts after a random delay
+    of up to poller.jitter seconds and is cancelled if it hasn't finished poller.deadline seconds
+    after the cycle started. The next cycle starts poller.interval seconds after the current one.
+    A task which is still running then (because it ignored its cancellation) is left behind
+    and the same task is skipped in the next cycle, so checks of the same server never overlap.
     """
     def __init__(self):
         self.checks = {}
-        self.meetings = []
+        self.usage_probes = {}
+        self.last_archive = None
+        self.semaphore = None
+        # Tasks by kind and server which haven't finished yet
+        self.running = {}
 
     def schedule_tasks(self, server, client):
         # File Checks
@@ -86,31 +143,111 @@ class Scheduler:
                 server.secret,
                 server.unreachable
             ))
-        self.checks[server.server_id].append(checks.bbb_api_check(client, server.server_id, server.url, server.secret, server.unreachable))
-
-    async def run(self, interval=30):
+        self.checks[server.server_id].append(checks.bbb_api_check(client, server.server_id, server.url, server.secret, server.unreachable, server.id))
+
+        # Live usage for the placement strategies
+        file = os.path.join(settings.PLUGIN_PATH, "get_cpu_load.sh")
+        self.usage_probes[server.server_id] = (
+            checks.usage_probe(client, server),
+            checks.cpu_probe(
+                server,
+                f"/bin/bash {file} {server.url.lstrip('https://').split('/')[0]} {settings.SSH_USER}",
+                settings.config.poller.cpu_timeout
+            ),
+        )
+
+    async def _run_task(self, key, coroutine_function, *args):
+        try:
+            await asyncio.sleep(random.uniform(0, settings.config.poller.jitter))
+            async with self.semaphore:
+                await coroutine_function(*args)
+        except Exception:
+            logger.exception(f"{key[0]}: #{key[1]}: failed")
+        finally:
+            del self.running[key]
+
+    def _start(self, key, deadline, coroutine_function, *args):
+        """
+        Start a task unless the previous cycle's one with the same key is still running
+
+        :param key: the task's kind and the server_id it is for
+        :param deadline: event loop time the task is cancelled at
+        :return: the task or None if it was skipped
+        """
+        if key in self.running:
+            logger.warning(f"{key[0]}: #{key[1]}: skipped, the previous one is still running")
+            metrics.poller_tasks_skipped.labels(key[0]).inc()
+            return None
+        task = asyncio.create_task(self._run_task(key, coroutine_function, *args))
+        self.running[key] = task
+        asyncio.get_running_loop().call_at(deadline, self._cancel_late, key, task)
+        return task
+
+    def _cancel_late(self, key, task):
+        if not task.done():
+            logger.error(f"{key[0]}: #{key[1]}: cancelled, it didn't finish before the cycle's deadline")
+            metrics.poller_tasks_timed_out.labels(key[0]).inc()
+            task.cancel()
+
+    async def _maintain(self):
+        """Repair the servers' running load and archive a part of the old ended meetings"""
+        drift = await db.execute_task(db.reconcile_running_load)
+        for server_id, amount in drift.items():
+            logger.warning(f"Running load of #{server_id} was off by {amount}, repaired")
+
+        archive = settings.config.archive
+        if archive.enabled and (self.last_archive is None
+                                or time.monotonic() - self.last_archive >= archive.interval):
+            archived = await db.execute_task(db.archive_meetings(archive.batch_size, archive.max_batches))
+            logger.info(f"Archived {archived} ended meetings")
+            # Go on in the next cycle if there might be more
+            if archived < archive.batch_size * archive.max_batches:
+                self.last_archive = time.monotonic()
+
+    async def run(self, interval=None):
+        if interval is None:
+            interval = settings.config.poller.interval
         client = httpx.AsyncClient()
+        self.semaphore = asyncio.Semaphore(settings.config.poller.concurrency)
+        loop = asyncio.get_running_loop()
 
+        due = loop.time()
         while True:
-            logger.info("Clearing checks and running meetings")
+            start = loop.time()
+            lag = start - due
+            metrics.poller_cycle_lag.set(lag)
+            metrics.poller_last_cycle.set_to_current_time()
+            if lag > 1:
+                logger.warning(f"Cycle started {lag:.1f}s late")
+            deadline = start + settings.config.poller.deadline
+
+            logger.info("Clearing checks")
             self.checks = {}
-            self.meetings = []
+            self.usage_probes = {}
             logger.info("Reloading server")
-            server_list = db.execute_task(db.get_servers)
+            server_list = await db.execute_task(db.get_servers)
             logger.debug(f"Loaded servers: {server_list}")
             for server in server_list:
                 self.checks[server.server_id] = []
                 self.schedule_tasks(server, client)
 
-            meeting_list = db.execute_task(db.get_meetings)
-            logger.debug(f"Running meeting to check: {meeting_list}")
-            for meeting in meeting_list:
-                self.meetings.append(meeting)
-
+            # The checks don't wait for the database maintenance
+            tasks = [self._start(("maintenance", "all"), deadline, self._maintain)]
             for server in self.checks:
-                asyncio.create_task(_execute_checks(server, self.checks[server]))
-
-            for meeting in self.meetings:
-                asyncio.create_task(_execute_meeting(meeting))
+                tasks.append(self._start(("checks", server), deadline, _execute_checks, server, self.checks[server]))
 
-            await asyncio.sleep(interval)
+            for server in server_list:
+                tasks.append(self._start(("usage", server.server_id), deadline, _execute_usage, server,
+                                         *self.usage_probes[server.server_id]))
+
+            # Tasks still running when the next cycle is due are skipped by it
+            due = start + interval
+            tasks = [task for task in tasks if task is not None]
+            pending = set()
+            if tasks:
+                _, pending = await asyncio.wait(tasks, timeout=max(0, due - loop.time()))
+            duration = loop.time() - start
+            metrics.poller_cycle_duration.observe(duration)
+            logger.info(f"Cycle finished {len(tasks) - len(pending)}/{len(tasks)} tasks in {duration:.1f}s")
+
+            await asyncio.sleep(max(0, due - loop.time()))
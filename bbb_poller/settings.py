@@ -20,7 +20,26 @@ DATABASES = {
     }
 }
 
+CACHES = {
+    'default': {
+        'BACKEND': config.cache.backend,
+        'LOCATION': config.cache.location,
+    }
+}
+# Memcached passes OPTIONS to its client, only django's own stores are limited in size.
+# A full store drops every cull_frequency-th entry, so max_entries should stay well above the
+# entries in use (about three per running meeting plus a few per server).
+if config.cache.backend.startswith(("django.core.cache.backends.filebased.",
+                                    "django.core.cache.backends.locmem.",
+                                    "django.core.cache.backends.db.")):
+    CACHES['default']['OPTIONS'] = {
+        'MAX_ENTRIES': config.cache.max_entries,
+        'CULL_FREQUENCY': config.cache.cull_frequency,
+    }
+
 TIME_ZONE = 'UTC'
+# Like the loadbalancer, both share the database
+USE_TZ = True
 
 INSTALLED_APPS = [
     "common_files.apps.CommonFilesConfig",
@@ -0,0 +1,157 @@
+"""
+Tests of the poller
+
+Run them from the bbb_loadbalancer directory with the loadbalancer's test runner:
+    python manage.py test ../bbb_poller
+"""
+import asyncio
+from datetime import datetime, timedelta, timezone
+from unittest import mock
+
+from asgiref.sync import async_to_sync
+from django.test import SimpleTestCase, TransactionTestCase
+
+import checks
+import scheduler
+from common_files import metrics
+from common_files.models import BBBServer, Meeting
+
+
+class ReconcileMeetingsTest(TransactionTestCase):
+
+    def setUp(self):
+        self.server = BBBServer.objects.create(server_id=1, url="https://bbb1.example.org/bigbluebutton/")
+        self.other = BBBServer.objects.create(server_id=2, url="https://bbb2.example.org/bigbluebutton/")
+        self.started = datetime.now(tz=timezone.utc)
+
+    def _create(self, meeting_id, internal_id, server=None, age=60):
+        meeting = Meeting.objects.create_running(meeting_id=meeting_id, internal_id=internal_id,
+                                                 server=server or self.server, load=1)
+        Meeting.objects.filter(id=meeting.id).update(created=self.started - timedelta(seconds=age))
+        return meeting
+
+    def _running(self):
+        return set(Meeting.running.values_list("meeting_id", flat=True))
+
+    def test_ends_only_vanished_meetings(self):
+        self._create("listed", "internal-listed")
+        self._create("vanished", "internal-vanished")
+        self._create("creating", Meeting.TEMP_INTERNAL_ID)
+        self._create("new", "internal-new", age=1)
+        self._create("elsewhere", "internal-elsewhere", server=self.other)
+
+        async_to_sync(scheduler._reconcile_meetings)(self.server, {"internal-listed": "listed"}, self.started)
+
+        self.assertEqual(self._running(), {"listed", "creating", "new", "elsewhere"})
+        self.server.refresh_from_db()
+        self.assertEqual(self.server.running_load, 3)
+
+    def test_reconciles_before_reading_the_cpu_load(self):
+        self._create("vanished", "internal-vanished")
+        usage = checks.Usage(participants=3, meetings={})
+
+        async def probe():
+            return usage
+
+        async def hanging_cpu_probe():
+            await asyncio.sleep(10)
+
+        async def execute_usage():
+            task = asyncio.ensure_future(scheduler._execute_usage(self.server, probe, hanging_cpu_probe))
+            await asyncio.sleep(0.5)
+            task.cancel()
+
+        async_to_sync(execute_usage)()
+
+        self.assertEqual(self._running(), set())
+
+    def test_counts_unknown_meetings(self):
+        self._create("listed", "internal-listed")
+        found = {"internal-listed": "listed", "internal-foreign": "foreign"}
+
+        async_to_sync(scheduler._reconcile_meetings)(self.server, found, self.started)
+
+        self.assertEqual(self._running(), {"listed"})
+        self.assertEqual(metrics.poller_unknown_meetings.labels("1")._value.get(), 1)
+
+
+class UsageProbeTest(SimpleTestCase):
+
+    def _probe(self, xml: bytes) -> checks.Usage:
+        client = mock.MagicMock()
+        response = client.stream().__aenter__.return_value
+
+        async def aiter_bytes():
+            yield xml
+        response.aiter_bytes = aiter_bytes
+
+        return async_to_sync(checks.usage_probe(client, _fake_server()))()
+
+    def _cpu_load(self, stdout: bytes):
+        with mock.patch("checks._run_shell", return_value=(0, stdout)):
+            return async_to_sync(checks.cpu_probe(_fake_server(), "get_cpu_load", 1))()
+
+    def test_reads_usage(self):
+        usage = self._probe(b"<response><returncode>SUCCESS</returncode><meetings>"
+                            b"<meeting><meetingID>a</meetingID><internalMeetingID>ia</internalMeetingID>"
+                            b"<participantCount>3</participantCount><videoCount>1</videoCount></meeting>"
+                            b"<meeting><meetingID>b</meetingID><internalMeetingID>ib</internalMeetingID>"
+                            b"<participantCount>2</participantCount><videoCount>0</videoCount></meeting>"
+                            b"</meetings></response>")
+
+        self.assertEqual((usage.participants, usage.video_streams), (5, 1))
+        self.assertEqual(usage.meetings, {"ia": "a", "ib": "b"})
+
+    def test_skips_invalid_counts(self):
+        usage = self._probe(b"<response><returncode>SUCCESS</returncode><meetings>"
+                            b"<meeting><meetingID>a</meetingID><internalMeetingID>ia</internalMeetingID>"
+                            b"<participantCount>many</participantCount><videoCount></videoCount></meeting>"
+                            b"<meeting><meetingID>b</meetingID><internalMeetingID>ib</internalMeetingID>"
+                            b"<participantCount>2</participantCount><videoCount>1</videoCount></meeting>"
+                            b"</meetings></response>")
+
+        self.assertEqual((usage.participants, usage.video_streams), (2, 1))
+        self.assertEqual(usage.meetings, {"ia": "a", "ib": "b"})
+
+    def test_reads_cpu_load(self):
+        self.assertEqual(self._cpu_load(b"2.0 4\n"), 50.0)
+        self.assertIsNone(self._cpu_load(b"2.0 0\n"))
+        self.assertIsNone(self._cpu_load(b"ssh: connect to host bbb1 port 22: Connection refused\n"))
+
+    def test_cpu_load_times_out(self):
+        async def hanging_shell(cmd):
+            await asyncio.sleep(10)
+
+        with mock.patch("checks._run_shell", side_effect=hanging_shell):
+            self.assertIsNone(async_to_sync(checks.cpu_probe(_fake_server(), "get_cpu_load", 0.05))())
+
+
+def _fake_server():
+    return mock.Mock(server_id=1, api_url="https://bbb1.example.org/bigbluebutton/api/", secret="secret")
+
+
+class MaintenanceTest(TransactionTestCase):
+
+    def setUp(self):
+        self.server = BBBServer.objects.create(server_id=1, url="https://bbb1.example.org/bigbluebutton/")
+        created = datetime.now(tz=timezone.utc) - timedelta(days=60)
+        for meeting_id in ("a", "b", "c", "newest"):
+            meeting = Meeting.objects.create_running(meeting_id=meeting_id, internal_id=meeting_id,
+                                                     server=self.server, load=1)
+            meeting.mark_ended()
+            Meeting.objects.filter(id=meeting.id).update(created=created)
+        BBBServer.objects.filter(id=self.server.id).update(running_load=5)
+
+    @mock.patch.dict(scheduler.settings.config.archive, {"batch_size": 1, "max_batches": 2})
+    def test_archives_a_few_batches_per_cycle(self):
+        poller = scheduler.Scheduler()
+
+        async_to_sync(poller._maintain)()
+        self.assertEqual(Meeting.objects.count(), 2)
+        self.assertIsNone(poller.last_archive)
+        self.server.refresh_from_db()
+        self.assertEqual(self.server.running_load, 0)
+
+        async_to_sync(poller._maintain)()
+        self.assertEqual(Meeting.objects.count(), 1)
+        self.assertIsNotNone(poller.last_archive)
@@ -1,6 +1,13 @@
+import glob
+import os
+
+
 # [ SERVER HOOKS ]
 def on_starting(server):
-    pass
+    # Drop metrics of workers from a previous run (see common_files/metrics.py)
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        for file in glob.glob(os.path.join(os.environ["PROMETHEUS_MULTIPROC_DIR"], "*.db")):
+            os.remove(file)
 
 
 def on_reload(server):
@@ -15,6 +22,12 @@ def on_exit(server):
     pass
 
 
+def child_exit(server, worker):
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
+
+
 # [ DEVELOPMENT ]
 reload = False
 reload_extra_files = []
@@ -25,7 +38,9 @@ capture_output = False
 # handle with care
 import multiprocessing
 workers = 2 * multiprocessing.cpu_count()
-worker_class = "sync"
+# The asgi worker serves the async endpoints (create, getMeetingInfo, getRecordings) concurrently
+# while they wait for bbb servers. All other endpoints still run one at a time per worker.
+worker_class = "uvicorn.workers.UvicornWorker"
 threads = 1
 
 # [ LOGGING ]